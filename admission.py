@@ -0,0 +1,196 @@
+import asyncio
+import itertools
+from enum import IntEnum
+from typing import Dict, List, Optional
+
+
+class Priority(IntEnum):
+    """
+    Admission priority of a route, lower value goes first
+    """
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is shed instead of being admitted
+
+    :param route: name of the route which was shed
+    :param reason: why the request was shed ('queue_full', 'timeout', 'evicted')
+    :param retry_after: seconds a client should wait before a retry
+    """
+
+    def __init__(self, route: str, reason: str, retry_after: int):
+        super().__init__(f'route "{route}" is overloaded ({reason}), retry after {retry_after}s')
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('route', 'priority', 'seq', 'future')
+
+    def __init__(self, route: str, priority: int, seq: int, future: asyncio.Future):
+        self.route = route
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+    def sort_key(self):
+        return self.priority, self.seq
+
+
+class AdmissionController:
+    """
+    Limits count of requests that run concurrently and keeps a bounded priority queue of the waiting ones.
+    Requests which can't be queued (or which wait longer than the queue_timeout) are shed with Overloaded
+
+    Must be used from the event loop only (acquire and release aren't thread-safe)
+
+    Example::
+
+        controller = AdmissionController(max_concurrency=8, route_limits={'post_user': 2})
+
+        await controller.acquire('post_user', Priority.LOW)
+        try:
+            ...
+        finally:
+            controller.release('post_user')
+
+    :param max_concurrency: count of requests which are allowed to run at the same time
+    :param max_queue: count of requests which are allowed to wait for a free slot
+    :param queue_timeout: seconds a request can wait in the queue
+    :param retry_after: value of the Retry-After header of shed requests
+    :param route_limits: optional concurrency limits of separate routes {route: limit}
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 8,
+                 max_queue: int = 64,
+                 queue_timeout: float = 2.0,
+                 retry_after: int = 1,
+                 route_limits: Optional[Dict[str, int]] = None):
+        if max_concurrency < 1:
+            raise ValueError(max_concurrency, 'max_concurrency must be positive')
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.route_limits: Dict[str, int] = dict(route_limits or {})
+
+        self._in_flight = 0
+        self._route_in_flight: Dict[str, int] = {}
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+
+        self._admitted: Dict[str, int] = {}
+        self._shed: Dict[str, int] = {}
+
+    def _can_admit(self, route: str) -> bool:
+        if self._in_flight >= self.max_concurrency:
+            return False
+        route_limit = self.route_limits.get(route)
+        return route_limit is None or self._route_in_flight.get(route, 0) < route_limit
+
+    def _take_slot(self, route: str) -> None:
+        self._in_flight += 1
+        self._route_in_flight[route] = self._route_in_flight.get(route, 0) + 1
+        self._admitted[route] = self._admitted.get(route, 0) + 1
+
+    def _count_shed(self, route: str) -> None:
+        self._shed[route] = self._shed.get(route, 0) + 1
+
+    def _dispatch(self) -> None:
+        """
+        Wakes up waiters in the priority order while there are free slots
+        """
+        self._waiters = [waiter for waiter in self._waiters if not waiter.future.done()]
+        self._waiters.sort(key=_Waiter.sort_key)
+
+        for waiter in list(self._waiters):
+            if self._in_flight >= self.max_concurrency:
+                break
+            if self._can_admit(waiter.route):
+                self._waiters.remove(waiter)
+                self._take_slot(waiter.route)
+                waiter.future.set_result(True)
+
+    def _shed_waiter(self, waiter: _Waiter, reason: str) -> None:
+        self._waiters.remove(waiter)
+        self._count_shed(waiter.route)
+        waiter.future.set_exception(Overloaded(waiter.route, reason, self.retry_after))
+
+    async def acquire(self, route: str, priority: int = Priority.NORMAL) -> None:
+        """
+        Waits for a free slot of the route
+
+        :param route: name of the route
+        :param priority: the Priority of the request
+        :except Overloaded: occurs if the request is shed
+        """
+        if not self._waiters and self._can_admit(route):
+            self._take_slot(route)
+            return
+
+        queued = [waiter for waiter in self._waiters if not waiter.future.done()]
+        if len(queued) >= self.max_queue:
+            # The queue is full: the request either replaces the worst waiter or is shed itself
+            worst = max(queued, key=_Waiter.sort_key, default=None)
+            if worst is None or worst.priority <= priority:
+                self._count_shed(route)
+                raise Overloaded(route, 'queue_full', self.retry_after)
+            self._shed_waiter(worst, 'evicted')
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(_Waiter(route, int(priority), next(self._seq), future))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._count_shed(route)
+            raise Overloaded(route, 'timeout', self.retry_after)
+        except asyncio.CancelledError:
+            # The slot could have been granted right before the cancellation
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(route)
+            raise
+
+    def release(self, route: str) -> None:
+        """
+        Returns the slot taken by acquire and wakes up the next waiter
+
+        :param route: name of the route
+        """
+        self._in_flight -= 1
+        self._route_in_flight[route] -= 1
+        self._dispatch()
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Returns current state of the controller: in flight and queued requests, admitted and shed counters
+        """
+        queued: Dict[str, int] = {}
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                queued[waiter.route] = queued.get(waiter.route, 0) + 1
+
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'in_flight': self._in_flight,
+            'queue_depth': sum(queued.values()),
+            'routes': {
+                route: {
+                    'in_flight': self._route_in_flight.get(route, 0),
+                    'queued': queued.get(route, 0),
+                    'admitted': self._admitted.get(route, 0),
+                    'shed': self._shed.get(route, 0),
+                    'limit': self.route_limits.get(route),
+                }
+                for route in sorted(set(self._admitted) | set(self._shed) | set(queued))
+            }
+        }
@@ -0,0 +1,286 @@
+"""
+Online snapshots and restores of the database (sqlite online backup API)
+
+    python backup.py snapshot [target path]
+    python backup.py restore <snapshot path>
+"""
+import argparse
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from typing import IO, Callable, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+import database
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _fsync_file(path: str) -> None:
+    with open(path, 'rb') as file:
+        os.fsync(file.fileno())
+
+
+def _copy(source: sqlite3.Connection,
+          target: sqlite3.Connection,
+          pages: int,
+          pause: float,
+          max_restarts: int) -> int:
+    """
+    Copies the source into the target by pages per step, pausing between steps, so writers of the source
+    get the database between steps. A write into the source by another connection restarts the copy,
+    after max_restarts restarts the rest is copied in one step (WAL writers are not blocked by it,
+    other writers wait for the step)
+
+    :return: count of restarts
+    """
+    restarts = 0
+    last_remaining = [None]
+
+    def progress(_, remaining: int, total: int) -> None:
+        nonlocal restarts
+        if last_remaining[0] is not None and remaining >= last_remaining[0]:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _TooManyRestarts()
+        last_remaining[0] = remaining
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=pause)
+    except _TooManyRestarts:
+        source.backup(target, pages=-1)
+    return restarts
+
+
+def _check(connection: sqlite3.Connection, path: str) -> None:
+    result = connection.execute('PRAGMA quick_check').fetchone()[0]
+    if result != 'ok':
+        raise ValueError(path, f'database is damaged: {result}')
+
+
+def snapshot(bind: Engine,
+             target_path: str,
+             pages: int = 256,
+             pause: float = 0.005,
+             max_restarts: int = 10) -> dict:
+    """
+    Writes a consistent snapshot of the database while the app keeps serving.
+    The snapshot is copied into a temporary file, fsynced and renamed to target_path,
+    so target_path is never a torn copy
+
+    Example::
+
+        snapshot(database.engine, 'dbs/backups/snapshot.sqlite3')
+
+    :param bind: engine of the (sqlite file) database
+    :param target_path: path of the snapshot file, replaced if exists
+    :param pages: pages copied per step
+    :param pause: seconds between steps
+    :param max_restarts: restarts of the copy by writes before the rest is copied in one step
+    :return: path, size in pages, count of restarts and duration of the snapshot
+    """
+    directory = os.path.dirname(target_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = target_path + '.tmp'
+    started_at = time.monotonic()
+
+    source = sqlite3.connect(bind.url.database)
+    target = sqlite3.connect(temporary_path)
+    try:
+        restarts = _copy(source, target, pages, pause, max_restarts)
+        target.execute('PRAGMA journal_mode=DELETE')
+        _check(target, temporary_path)
+        size = target.execute('PRAGMA page_count').fetchone()[0]
+    except Exception:
+        target.close()
+        os.remove(temporary_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+
+    _fsync_file(temporary_path)
+    os.replace(temporary_path, target_path)
+    return {
+        'path': target_path,
+        'pages': size,
+        'restarts': restarts,
+        'seconds': round(time.monotonic() - started_at, 3)
+    }
+
+
+def snapshot_path(directory: str = database.BACKUP_DIR) -> str:
+    """
+    Returns a path of a new snapshot in the directory named by the current time
+    """
+    return os.path.join(directory, time.strftime('snapshot-%Y%m%d-%H%M%S.sqlite3'))
+
+
+_restore_lock = threading.Lock()
+
+
+def _fresh_database_path(database_path: str) -> str:
+    base, extension = os.path.splitext(database_path)
+    path = base + time.strftime('-%Y%m%d-%H%M%S') + extension
+    number = 1
+    while os.path.exists(path):
+        path = base + time.strftime('-%Y%m%d-%H%M%S') + f'-{number}' + extension
+        number += 1
+    return path
+
+
+def restore(source_path: str,
+            prepare: Optional[Callable[[Engine], None]] = None,
+            pages: int = 256,
+            pause: float = 0.0) -> dict:
+    """
+    Restores the database from the snapshot into a fresh file next to the current database
+    and atomically swaps the engine of the app to it (see database.swap_engine).
+    Sessions opened before the swap finish on the previous file, which is kept as is
+
+    Example::
+
+        restore('dbs/backups/snapshot.sqlite3', prepare=init_database)
+
+    :param source_path: path of the snapshot
+    :param prepare: called with the engine of the fresh file before the swap (migrations of an old snapshot)
+    :param pages: pages copied per step
+    :param pause: seconds between steps
+    :except ValueError: occurs if the snapshot is not found or damaged
+    :return: url of the restored database, its size in pages and duration of the restore
+    """
+    if not os.path.isfile(source_path):
+        raise ValueError(source_path, 'snapshot is not found')
+
+    with _restore_lock:
+        started_at = time.monotonic()
+        restored_path = _fresh_database_path(database.engine.url.database)
+
+        source = sqlite3.connect(f'file:{source_path}?mode=ro', uri=True)
+        target = sqlite3.connect(restored_path)
+        try:
+            _check(source, source_path)
+            _copy(source, target, pages, pause, max_restarts=0)
+            size = target.execute('PRAGMA page_count').fetchone()[0]
+        except Exception:
+            target.close()
+            os.remove(restored_path)
+            raise
+        finally:
+            source.close()
+        target.close()
+        _fsync_file(restored_path)
+
+        url = f'sqlite:///{restored_path}'
+        restored_engine = create_engine(url, connect_args={'check_same_thread': False})
+        if prepare is not None:
+            prepare(restored_engine)
+        database.swap_engine(restored_engine)
+
+    return {
+        'url': url,
+        'pages': size,
+        'seconds': round(time.monotonic() - started_at, 3)
+    }
+
+
+def hold_app_lock(lock_path: str = database.APP_LOCK_PATH) -> IO:
+    """
+    Locks the app lock file (shared) for the running app, waiting for a command line restore to finish.
+    The lock is held until the returned file is closed
+    """
+    lock_file = open(lock_path, 'a+b')
+    fcntl.flock(lock_file, fcntl.LOCK_SH)
+    return lock_file
+
+
+def restore_online(source_path: str,
+                   app_lock: Optional[IO],
+                   prepare: Optional[Callable[[Engine], None]] = None,
+                   pages: int = 256,
+                   lock_path: str = database.APP_LOCK_PATH) -> dict:
+    """
+    Restores the database through the running app (POST /admin/restore). The engine is swapped only in the
+    process of the restore, so the app lock of the process is made exclusive for the restore: it fails while
+    other worker processes hold the lock (they would keep writing into the previous file), and workers started
+    meanwhile wait for the restore and open the restored file
+
+    :param app_lock: app lock file held by the process (see hold_app_lock), None if the process doesn't hold it
+    :except RuntimeError: occurs if other worker processes are running
+    :except ValueError: occurs if the snapshot is not found or damaged
+    """
+    lock_file = app_lock if app_lock is not None else open(lock_path, 'a+b')
+    # The lock held after the restore (the worker keeps its shared lock)
+    held = fcntl.LOCK_SH if app_lock is not None else fcntl.LOCK_UN
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # A failed conversion of the lock drops the shared lock (conversions are not atomic)
+            fcntl.flock(lock_file, held)
+            raise RuntimeError(lock_path, 'other worker processes are running, restore with one worker '
+                                          'or stop the app and restore from the command line')
+        try:
+            return restore(source_path, prepare=prepare, pages=pages)
+        finally:
+            fcntl.flock(lock_file, held)
+    finally:
+        if app_lock is None:
+            lock_file.close()
+
+
+def restore_offline(source_path: str,
+                    prepare: Optional[Callable[[Engine], None]] = None,
+                    pages: int = 256,
+                    lock_path: str = database.APP_LOCK_PATH) -> dict:
+    """
+    Restores the database while the app is stopped (the command line restore): the app lock file is locked
+    for the restore, so the app doesn't start meanwhile
+
+    :except RuntimeError: occurs if the app is running
+    :except ValueError: occurs if the snapshot is not found or damaged
+    """
+    with open(lock_path, 'a+b') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(lock_path, 'the app is running, restore through POST /admin/restore')
+        try:
+            return restore(source_path, prepare=prepare, pages=pages)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online snapshot and restore of the database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    snapshot_parser = commands.add_parser('snapshot', help='write a snapshot of the database')
+    snapshot_parser.add_argument('target', nargs='?', help='path of the snapshot (default: in BACKUP_DIR)')
+    snapshot_parser.add_argument('--pages', type=int, default=database.BACKUP_PAGES_PER_STEP)
+    snapshot_parser.add_argument('--pause', type=float, default=database.BACKUP_STEP_PAUSE)
+
+    restore_parser = commands.add_parser('restore', help='restore the database from a snapshot')
+    restore_parser.add_argument('source', help='path of the snapshot')
+    restore_parser.add_argument('--pages', type=int, default=database.BACKUP_PAGES_PER_STEP)
+
+    arguments = parser.parse_args()
+    try:
+        if arguments.command == 'snapshot':
+            print(snapshot(database.engine, arguments.target or snapshot_path(), arguments.pages, arguments.pause))
+        else:
+            # Migrations of the app are applied to old snapshots as on a restore through the app
+            from main import init_database
+            print(restore_offline(arguments.source, prepare=init_database, pages=arguments.pages))
+    except Exception as e:
+        print(e)
+        raise SystemExit(1)
@@ -0,0 +1,211 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _compressors(level: int) -> Dict[str, Callable[[bytes], bytes]]:
+    """
+    Returns available compressors by encodings, preferred first
+    """
+    compressors: Dict[str, Callable[[bytes], bytes]] = {}
+    if brotli is not None:
+        # Brotli quality is 0..11, gzip and zstd levels around 6 are comparable to quality 5
+        compressors['br'] = lambda data: brotli.compress(data, quality=min(max(level - 1, 0), 11))
+    if zstandard is not None:
+        compressors['zstd'] = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    compressors['gzip'] = lambda data: gzip.compress(data, compresslevel=min(max(level, 1), 9), mtime=0)
+    return compressors
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """
+    Returns q values of encodings of the Accept-Encoding header
+
+    Example::
+
+        parse_accept_encoding('gzip, br;q=0.8, *;q=0') == {'gzip': 1.0, 'br': 0.8, '*': 0.0}
+    """
+    encodings: Dict[str, float] = {}
+    for item in header.split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        encodings[name.lower()] = q
+    return encodings
+
+
+class CompressedCache:
+    """
+    Thread-safe LRU cache of compressed bodies by (encoding, digest of the body) bounded by their total size
+
+    :param max_bytes: max total size of cached compressed bodies in bytes
+    """
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: 'OrderedDict[Tuple[str, bytes], bytes]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key: Tuple[str, bytes], value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self.size -= len(self._items.popitem(last=False)[1])
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with the best encoding accepted by the client (br, zstd if their modules are installed,
+    gzip). Streaming responses (without a Content-Length, e.g. server-sent events), responses with
+    a Content-Encoding, of other than json and text types and smaller than minimum_size are sent as they are,
+    their start is not delayed. Compressed bodies are cached by a digest of the body, so hot payloads are compressed
+    once (bodies larger than cache_max_body are not cached), bodies of threadpool_size bytes and more
+    are compressed in the threadpool to keep the event loop free
+
+    Example::
+
+        app.add_middleware(CompressionMiddleware, minimum_size=1024, level=6)
+
+    :param app: wrapped application
+    :param minimum_size: min size of a body in bytes to compress
+    :param level: compression level (gzip and zstd levels, brotli quality is level - 1)
+    :param cache_bytes: max total size of cached compressed bodies in bytes, 0 disables the cache
+    :param cache_max_body: max size of a body in bytes to cache its compressed copies
+    :param threadpool_size: min size of a body in bytes to compress it in the threadpool
+    """
+
+    COMPRESSIBLE_TYPES = ('application/json', 'text/')
+    STREAMING_TYPES = ('text/event-stream',)
+
+    def __init__(self,
+                 app: ASGIApp,
+                 minimum_size: int = 1024,
+                 level: int = 6,
+                 cache_bytes: int = 8 * 1024 * 1024,
+                 cache_max_body: int = 256 * 1024,
+                 threadpool_size: int = 64 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_size = threadpool_size
+        self.cache_max_body = cache_max_body
+        self.compressors = _compressors(level)
+        self.cache: Optional[CompressedCache] = CompressedCache(cache_bytes) if cache_bytes > 0 else None
+
+    def choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        accepted = parse_accept_encoding(accept_encoding)
+        any_q = accepted.get('*', 0.0)
+        best, best_q = None, 0.0
+        for encoding in self.compressors:
+            q = accepted.get(encoding, any_q)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def compress(self, encoding: str, body: bytes) -> bytes:
+        if self.cache is None or len(body) > self.cache_max_body:
+            return self.compressors[encoding](body)
+
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = self.compressors[encoding](body)
+            self.cache.put(key, compressed)
+        return compressed
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.choose_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        response_start: List[Message] = []
+        passing = False
+
+        async def compressing_send(message: Message) -> None:
+            nonlocal passing
+            if passing:
+                await send(message)
+                return
+
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message.get('headers', []))
+                content_type = headers.get('content-type', '')
+                content_length = headers.get('content-length', '')
+                if 'content-encoding' in headers \
+                        or not content_type.startswith(self.COMPRESSIBLE_TYPES) \
+                        or content_type.startswith(self.STREAMING_TYPES) \
+                        or not content_length.isdigit() \
+                        or int(content_length) < self.minimum_size:
+                    passing = True
+                    await send(message)
+                else:
+                    response_start.append(message)
+                return
+
+            body = message.get('body', b'')
+            if message.get('more_body', False) or len(body) < self.minimum_size:
+                # Streaming responses and small bodies are sent as they are
+                passing = True
+                await send(response_start[0])
+                await send(message)
+                return
+
+            if len(body) >= self.threadpool_size:
+                compressed = await run_in_threadpool(self.compress, encoding, body)
+            else:
+                compressed = self.compress(encoding, body)
+            start = response_start[0]
+            headers = MutableHeaders(raw=list(start.get('headers', [])))
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(compressed))
+            headers.add_vary_header('Accept-Encoding')
+            await send({**start, 'headers': headers.raw})
+            await send({**message, 'body': compressed})
+
+        await self.app(scope, receive, compressing_send)
@@ -0,0 +1,176 @@
+import json
+import time
+import zlib
+from itertools import groupby
+from typing import List, Optional
+
+from sqlalchemy import func, or_, text
+from sqlalchemy.orm import Session
+
+import models
+import schemas
+from crud import search_crud
+from crud.message_crud import UNREAD_STATUS, add_user_stats
+
+
+COMPRESSION_LEVEL = 6
+
+
+def _pack(rows: List[list]) -> bytes:
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), COMPRESSION_LEVEL)
+
+
+def _unpack(block: models.MessageArchiveBlock) -> List[schemas.Message.Get]:
+    return [
+        schemas.Message.Get(id=message_id, sender_id=block.sender_id, receiver_id=block.receiver_id,
+                            text=message_text, status=message_status)
+        for message_id, message_text, message_status, _ in json.loads(zlib.decompress(block.data))
+    ]
+
+
+def archive_messages(db: Session, max_age: int, batch_size: int = 1000) -> int:
+    """
+    Moves one batch of read messages older than max_age seconds from the messages table
+    into compressed blocks (one block per conversation in the batch) and commits it.
+    Unread messages stay in the messages table, so unread counters are not affected.
+    Archived messages are removed from the full-text index, search covers only the messages table
+
+    :param db: current session
+    :param max_age: age in seconds of messages to archive (messages without created_at are always old enough)
+    :param batch_size: max count of messages to move
+    :return: count of archived messages (0 if there is nothing to archive)
+    """
+    cutoff = int(time.time()) - max_age
+    messages = db.query(models.Message.id, models.Message.sender_id, models.Message.receiver_id,
+                        models.Message.text, models.Message.status, models.Message.created_at) \
+        .filter(models.Message.status != UNREAD_STATUS,
+                or_(models.Message.created_at == None, models.Message.created_at < cutoff)) \
+        .order_by(models.Message.id) \
+        .limit(batch_size) \
+        .all()
+
+    if not messages:
+        return 0
+
+    conversation = lambda message: (message.receiver_id, message.sender_id)
+    for (receiver_id, sender_id), conversation_messages in groupby(sorted(messages, key=conversation), conversation):
+        conversation_messages = list(conversation_messages)
+        db.add(models.MessageArchiveBlock(
+            receiver_id=receiver_id,
+            sender_id=sender_id,
+            first_id=conversation_messages[0].id,
+            last_id=conversation_messages[-1].id,
+            count=len(conversation_messages),
+            data=_pack([[message.id, message.text, message.status, message.created_at]
+                        for message in conversation_messages])
+        ))
+
+    search_crud.unindex_messages(db, [(message.id, message.text) for message in messages])
+    db.query(models.Message) \
+        .filter(models.Message.id.in_([message.id for message in messages])) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return len(messages)
+
+
+def init_message_id_sequence(db: Session, first_id: int = 0) -> None:
+    """
+    Moves the AUTOINCREMENT sequence of messages past ids of archived messages and commits it
+    (ids of a database created before messages had AUTOINCREMENT could be reused after the newest message was deleted)
+
+    :param db: current session
+    :param first_id: ids of new messages are greater than it (start of the id range of a shard)
+    """
+    archive_last_id = db.query(func.max(models.MessageArchiveBlock.last_id)).scalar()
+    last_id = max(archive_last_id or 0, first_id)
+    if last_id == 0:
+        return
+    sequence = db.execute(text('SELECT seq FROM sqlite_sequence WHERE name = :name'),
+                          {'name': models.Message.__tablename__}).scalar()
+    if sequence is None:
+        db.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                   {'name': models.Message.__tablename__, 'seq': last_id})
+    elif sequence < last_id:
+        db.execute(text('UPDATE sqlite_sequence SET seq = :seq WHERE name = :name'),
+                   {'name': models.Message.__tablename__, 'seq': last_id})
+    db.commit()
+
+
+def get_archived_messages(db: Session,
+                          receiver_id: int,
+                          before_id: Optional[int] = None,
+                          limit: int = 50) -> List[schemas.Message.Get]:
+    """
+    Returns archived messages of the receiver with ids less than before_id, newest first
+
+    :param db: current session
+    :param receiver_id: id of the receiver
+    :param before_id: upper bound (exclusive) of ids, None for no bound
+    :param limit: max count of messages
+    :return: list of messages ordered by id descending
+    """
+    query = db.query(models.MessageArchiveBlock).filter(models.MessageArchiveBlock.receiver_id == receiver_id)
+    if before_id is not None:
+        query = query.filter(models.MessageArchiveBlock.first_id < before_id)
+
+    messages: List[schemas.Message.Get] = []
+    # Blocks of different senders overlap by ids: read blocks until the next one can't contain newer messages
+    for block in query.order_by(models.MessageArchiveBlock.last_id.desc()).yield_per(16):
+        if len(messages) >= limit and block.last_id < messages[limit - 1].id:
+            break
+        messages += [message for message in _unpack(block) if before_id is None or message.id < before_id]
+        messages.sort(key=lambda message: message.id, reverse=True)
+
+    return messages[:limit]
+
+
+def get_archive_last_id(db: Session, receiver_id: int) -> Optional[int]:
+    """
+    Returns id of the newest archived message of the receiver (None if there are no archived messages)
+    """
+    return db.query(func.max(models.MessageArchiveBlock.last_id)) \
+        .filter(models.MessageArchiveBlock.receiver_id == receiver_id) \
+        .scalar()
+
+
+def get_inbox(db: Session, receiver_id: int, before_id: Optional[int] = None, limit: int = 50) \
+        -> List[schemas.Message.Get]:
+    """
+    Returns messages of the receiver newest first. Reads the messages table and falls through
+    to the archive only if the page goes deeper than the newest archived message
+
+    :param db: current session
+    :param receiver_id: id of the receiver
+    :param before_id: upper bound (exclusive) of ids, None for the newest messages
+    :param limit: max count of messages
+    :return: list of messages ordered by id descending
+    """
+    query = db.query(models.Message).filter(models.Message.receiver_id == receiver_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    messages = [schemas.Message.Get.from_orm(message)
+                for message in query.order_by(models.Message.id.desc()).limit(limit)]
+
+    if len(messages) == limit:
+        archive_last_id = get_archive_last_id(db, receiver_id)
+        if archive_last_id is None or archive_last_id < messages[-1].id:
+            return messages
+
+    messages += get_archived_messages(db, receiver_id, before_id, limit)
+    messages.sort(key=lambda message: message.id, reverse=True)
+    return messages[:limit]
+
+
+def delete_user_archive(db: Session, user_id: int) -> None:
+    """
+    Deletes archived messages sent or received by the user (doesn't commit)
+    """
+    user_blocks = or_(models.MessageArchiveBlock.receiver_id == user_id, models.MessageArchiveBlock.sender_id == user_id)
+    blocks = db.query(models.MessageArchiveBlock.sender_id, models.MessageArchiveBlock.receiver_id,
+                      func.sum(models.MessageArchiveBlock.count).label('count')) \
+        .filter(user_blocks) \
+        .group_by(models.MessageArchiveBlock.sender_id, models.MessageArchiveBlock.receiver_id) \
+        .all()
+    add_user_stats(db, [(block.sender_id, block.receiver_id, None, None) for block in blocks],
+                   [-block.count for block in blocks])
+    db.query(models.MessageArchiveBlock).filter(user_blocks).delete(synchronize_session=False)
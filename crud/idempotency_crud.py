@@ -0,0 +1,91 @@
+import time
+from typing import Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+
+def claim_key(db: Session, key: str, fingerprint: bytes, pending_ttl: int, now: Optional[int] = None) \
+        -> Optional[models.IdempotencyRecord]:
+    """
+    Inserts a pending record of the key and commits it, unless there is a live record of the key already
+
+    :param db: current session
+    :param key: scoped idempotency key
+    :param fingerprint: digest of the request
+    :param pending_ttl: seconds the claim is valid without renewals (a crashed worker doesn't block the key longer)
+    :param now: unix time of the claim, the current time if None
+    :return: None if the key is claimed by the caller, otherwise the stored record (completed or pending)
+    """
+    now = int(time.time()) if now is None else now
+    record = db.get(models.IdempotencyRecord, key)
+    if record is not None:
+        if record.expires_at > now:
+            return record
+        db.delete(record)
+        db.flush()
+
+    db.add(models.IdempotencyRecord(key=key, fingerprint=fingerprint, expires_at=now + pending_ttl))
+    try:
+        db.commit()
+    except IntegrityError as e:  # Claimed by another worker at the same time
+        print(e)
+        db.rollback()
+        return db.get(models.IdempotencyRecord, key)
+    return None
+
+
+def complete_key(db: Session,
+                 key: str,
+                 status_code: int,
+                 content_type: Optional[str],
+                 body: bytes,
+                 ttl: int,
+                 now: Optional[int] = None) -> None:
+    """
+    Stores the response of the claimed key for ttl seconds (from now, the current unix time if None)
+    """
+    now = int(time.time()) if now is None else now
+    db.query(models.IdempotencyRecord) \
+        .filter(models.IdempotencyRecord.key == key) \
+        .update({'status_code': status_code, 'content_type': content_type, 'body': body,
+                 'expires_at': now + ttl}, synchronize_session=False)
+    db.commit()
+
+
+def renew_key(db: Session, key: str, pending_ttl: int, now: Optional[int] = None) -> None:
+    """
+    Extends the pending record of the key for pending_ttl seconds (from now, the current unix time if None)
+    while its request runs
+    """
+    now = int(time.time()) if now is None else now
+    db.query(models.IdempotencyRecord) \
+        .filter(models.IdempotencyRecord.key == key, models.IdempotencyRecord.status_code == None) \
+        .update({'expires_at': now + pending_ttl}, synchronize_session=False)
+    db.commit()
+
+
+def release_key(db: Session, key: str) -> None:
+    """
+    Deletes the pending record of the key, so the request can be retried
+    """
+    db.query(models.IdempotencyRecord) \
+        .filter(models.IdempotencyRecord.key == key, models.IdempotencyRecord.status_code == None) \
+        .delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_expired_keys(db: Session, now: Optional[int] = None) -> int:
+    """
+    Deletes records expired by now (the current unix time if None)
+
+    :return: count of deleted records
+    """
+    now = int(time.time()) if now is None else now
+    count = db.query(models.IdempotencyRecord) \
+        .filter(models.IdempotencyRecord.expires_at <= now) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return count
@@ -0,0 +1,335 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Dict, List, Optional, Set, Union
+
+import schemas
+from crud.message_crud import READ_STATUS, UNREAD_STATUS, notify_committed
+from crud.storage import Storage
+
+
+class _UserRecord:
+    __slots__ = ('id', 'nik_name', 'fst_name', 'sec_name', 'status',
+                 'sent', 'received', 'unread', 'last_message_id', 'last_message_at')
+
+    def __init__(self, user_id: int, nik_name: str, fst_name: str, sec_name: str, status: int = 0):
+        self.id = user_id
+        self.nik_name = nik_name
+        self.fst_name = fst_name
+        self.sec_name = sec_name
+        self.status = status
+        self.sent = 0
+        self.received = 0
+        self.unread = 0
+        self.last_message_id = 0
+        self.last_message_at = 0
+
+
+class _MessageRecord:
+    __slots__ = ('id', 'sender_id', 'receiver_id', 'text', 'status', 'created_at')
+
+    def __init__(self, message_id: int, sender_id: int, receiver_id: int, text: str, status: int, created_at: int):
+        self.id = message_id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.text = text
+        self.status = status
+        self.created_at = created_at
+
+
+class MemoryStorage(Storage):
+    """
+    Storage keeping users and messages in process memory: records with __slots__ in dicts ordered by id,
+    indexes of nick names, of received, of sent and of unread messages by conversations (ids in ascending arrays).
+    Only the core routes and the inbox work with it, routes querying the whole database are not available
+    With log_path every change is appended to a log of json lines, which is replayed on start
+
+    Example::
+
+        storage = MemoryStorage(log_path='dbs/memory.log')
+        user = storage.post_user(schemas.User.Create(nik_name='@user', fst_name='Fst', sec_name='Sec'))
+
+    :param log_path: path of the append-only log, None to keep data in memory only
+    :param fsync: fsync the log after every change (otherwise the log is flushed to the OS only)
+    """
+
+    def __init__(self, log_path: Optional[str] = None, fsync: bool = False):
+        self.fsync = fsync
+
+        self._users: Dict[int, _UserRecord] = {}
+        self._messages: Dict[int, _MessageRecord] = {}
+        self._user_ids_by_nik_name: Dict[str, int] = {}
+        self._received: Dict[int, List[int]] = {}
+        self._sent: Dict[int, List[int]] = {}
+        # receiver_id: {sender_id: ids of unread messages}
+        self._unread: Dict[int, Dict[int, List[int]]] = {}
+        self._last_user_id = 0
+        self._last_message_id = 0
+        self._lock = threading.RLock()
+
+        self._log = None
+        if log_path is not None:
+            if os.path.exists(log_path):
+                self._replay(log_path)
+            self._log = open(log_path, 'a', encoding='utf-8')
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    # -----
+    #  Log
+    # -----
+    def _write_log(self, record: dict) -> None:
+        if self._log is None:
+            return
+        self._log.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+    def _replay(self, log_path: str) -> None:
+        """
+        Applies records of the log. A torn last line of a crashed process is cut off the log,
+        so records appended after the restart don't continue it
+        """
+        good_size = 0
+        with open(log_path, 'rb') as log:
+            for line in log:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError(log_path, 'log line is not finished')
+                    record = json.loads(line)
+                except ValueError as e:  # Torn last line of a crashed process
+                    print(e)
+                    break
+                good_size += len(line)
+                operation = record.pop('op')
+                if operation == 'user':
+                    self._add_user(**record)
+                elif operation == 'put_user':
+                    self._update_user(**record)
+                elif operation == 'del_user':
+                    self._delete_user(**record)
+                elif operation == 'message':
+                    self._add_message(**record)
+                elif operation == 'read':
+                    self._mark_read(**record)
+
+        if good_size < os.path.getsize(log_path):
+            with open(log_path, 'r+b') as log:
+                log.truncate(good_size)
+
+    # ---------
+    #  Schemas
+    # ---------
+    def _message_get(self, message: _MessageRecord) -> schemas.Message.Get:
+        return schemas.Message.Get(id=message.id, sender_id=message.sender_id, receiver_id=message.receiver_id,
+                                   text=message.text, status=message.status)
+
+    def _user_get(self, user: _UserRecord) -> schemas.User.Get:
+        return schemas.User.Get(
+            id=user.id, nik_name=user.nik_name, fst_name=user.fst_name, sec_name=user.sec_name, status=user.status,
+            received_messages=[self._message_get(self._messages[message_id])
+                               for message_id in self._received.get(user.id, ())],
+            sent_messages=[self._message_get(self._messages[message_id])
+                           for message_id in self._sent.get(user.id, ())],
+            sent_count=user.sent, received_count=user.received, unread_count=user.unread,
+            last_message_id=user.last_message_id, last_message_at=user.last_message_at
+        )
+
+    def _find_user(self, user_id: int) -> _UserRecord:
+        user = self._users.get(user_id)
+        if user is None:
+            raise ValueError(user_id, f'user is not found by id')
+        return user
+
+    # ---------
+    #  Changes
+    # ---------
+    def _add_user(self, id: int, nik_name: str, fst_name: str, sec_name: str, status: int = 0) -> _UserRecord:
+        user = self._users[id] = _UserRecord(id, nik_name, fst_name, sec_name, status)
+        self._user_ids_by_nik_name[nik_name] = id
+        self._last_user_id = max(self._last_user_id, id)
+        return user
+
+    def _update_user(self, id: int, nik_name: str, fst_name: str, sec_name: str, status: int) -> _UserRecord:
+        user = self._users[id]
+        del self._user_ids_by_nik_name[user.nik_name]
+        self._user_ids_by_nik_name[nik_name] = id
+        user.nik_name, user.fst_name, user.sec_name, user.status = nik_name, fst_name, sec_name, status
+        return user
+
+    def _delete_user(self, id: int) -> _UserRecord:
+        user = self._users.pop(id)
+        del self._user_ids_by_nik_name[user.nik_name]
+        self._unread.pop(id, None)
+
+        # Ids of removed messages by other users, their arrays are filtered once per user
+        removed_sent: Dict[int, Set[int]] = {}
+        removed_received: Dict[int, Set[int]] = {}
+        for message_id in self._received.pop(id, []) + self._sent.pop(id, []):
+            message = self._messages.pop(message_id, None)
+            if message is None:  # A message to itself
+                continue
+            if message.sender_id != id:
+                self._users[message.sender_id].sent -= 1
+                removed_sent.setdefault(message.sender_id, set()).add(message_id)
+            if message.receiver_id != id:
+                self._users[message.receiver_id].received -= 1
+                removed_received.setdefault(message.receiver_id, set()).add(message_id)
+
+        for index, removed in ((self._sent, removed_sent), (self._received, removed_received)):
+            for user_id, message_ids in removed.items():
+                index[user_id] = [message_id for message_id in index[user_id] if message_id not in message_ids]
+        for receiver_id in removed_received:
+            unread_ids = self._unread.get(receiver_id, {}).pop(id, [])
+            self._users[receiver_id].unread -= len(unread_ids)
+        return user
+
+    def _add_message(self, id: int, sender_id: int, receiver_id: int, text: str, status: int,
+                     created_at: int) -> _MessageRecord:
+        message = self._messages[id] = _MessageRecord(id, sender_id, receiver_id, text, status, created_at)
+        self._last_message_id = max(self._last_message_id, id)
+        self._received.setdefault(receiver_id, []).append(id)
+        self._sent.setdefault(sender_id, []).append(id)
+
+        sender, receiver = self._users[sender_id], self._users[receiver_id]
+        sender.sent += 1
+        receiver.received += 1
+        for user in (sender, receiver):
+            user.last_message_id, user.last_message_at = id, created_at
+        if status == UNREAD_STATUS:
+            receiver.unread += 1
+            self._unread.setdefault(receiver_id, {}).setdefault(sender_id, []).append(id)
+        return message
+
+    def _mark_read(self, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+        conversations = self._unread.get(receiver_id, {})
+        unread_ids = conversations.get(sender_id, [])
+        marked = bisect_right(unread_ids, up_to_id)
+        if not marked:
+            return 0
+
+        for message_id in unread_ids[:marked]:
+            self._messages[message_id].status = READ_STATUS
+        if marked == len(unread_ids):
+            del conversations[sender_id]
+        else:
+            conversations[sender_id] = unread_ids[marked:]
+        self._users[receiver_id].unread -= marked
+        return marked
+
+    # -------
+    #  Users
+    # -------
+    def get_user(self, user_id: int) -> schemas.User.Get:
+        with self._lock:
+            return self._user_get(self._find_user(user_id))
+
+    def get_user_id(self, user_identifier: Union[int, str]) -> int:
+        with self._lock:
+            if type(user_identifier) is int:
+                return self._find_user(user_identifier).id
+            user_id = self._user_ids_by_nik_name.get(user_identifier)
+            if user_id is None:
+                raise ValueError(user_identifier, f'user is not found by nick name')
+            return user_id
+
+    def get_users(self, skip: int = 0, limit: int = 100) -> List[schemas.User.Get]:
+        with self._lock:
+            return [self._user_get(user) for user in islice(self._users.values(), skip, skip + limit)]
+
+    def get_users_count(self) -> int:
+        return len(self._users)
+
+    def post_user(self, new_user_data: schemas.User.Create) -> schemas.User.Get:
+        with self._lock:
+            if new_user_data.nik_name in self._user_ids_by_nik_name:
+                raise ValueError(new_user_data, f'user with that nick name is already created')
+            record = dict(id=self._last_user_id + 1, **new_user_data.dict())
+            user = self._add_user(**record)
+            self._write_log({'op': 'user', **record})
+            return self._user_get(user)
+
+    def put_user(self, user_id: int, new_user_data: schemas.User.Edit) -> schemas.User.Get:
+        with self._lock:
+            self._find_user(user_id)
+            owner_id = self._user_ids_by_nik_name.get(new_user_data.nik_name)
+            if owner_id is not None and owner_id != user_id:
+                raise ValueError((user_id, new_user_data,), f'update user with a data error')
+            record = dict(id=user_id, **new_user_data.dict())
+            user = self._update_user(**record)
+            self._write_log({'op': 'put_user', **record})
+            return self._user_get(user)
+
+    def del_user(self, user_id: int) -> schemas.UserBrief.Get:
+        with self._lock:
+            self._find_user(user_id)
+            user = self._delete_user(user_id)
+            self._write_log({'op': 'del_user', 'id': user_id})
+            return schemas.UserBrief.Get(id=user.id, nik_name=user.nik_name,
+                                         fst_name=user.fst_name, sec_name=user.sec_name)
+
+    def get_user_stats(self, user_id: int) -> schemas.UserStats.Get:
+        with self._lock:
+            user = self._find_user(user_id)
+            return schemas.UserStats.Get(user_id=user.id, sent=user.sent, received=user.received, unread=user.unread,
+                                         last_message_id=user.last_message_id,
+                                         last_message_at=user.last_message_at)
+
+    def get_user_messages(self, user_id: int) -> schemas.UserMessages.Get:
+        with self._lock:
+            user = self._find_user(user_id)
+            return schemas.UserMessages.Get(
+                user_id=user.id,
+                received_messages=[self._message_get(self._messages[message_id])
+                                   for message_id in self._received.get(user.id, ())],
+                sent_messages=[self._message_get(self._messages[message_id])
+                               for message_id in self._sent.get(user.id, ())]
+            )
+
+    # ----------
+    #  Messages
+    # ----------
+    def post_message(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        with self._lock:
+            if new_message_data.sender_id not in self._users or new_message_data.receiver_id not in self._users:
+                raise ValueError(new_message_data, f'sender or receiver is not found')
+            record = dict(id=self._last_message_id + 1, status=UNREAD_STATUS, created_at=int(time.time()),
+                          **new_message_data.dict())
+            message = self._message_get(self._add_message(**record))
+            self._write_log({'op': 'message', **record})
+
+        notify_committed([message])
+        return message
+
+    def get_unread_counts(self, receiver_id: int) -> Dict[int, int]:
+        with self._lock:
+            return {sender_id: len(unread_ids) for sender_id, unread_ids in self._unread.get(receiver_id, {}).items()}
+
+    def get_messages_after(self, receiver_id: int, after_id: int, limit: int = 100) -> List[schemas.Message.Get]:
+        with self._lock:
+            received = self._received.get(receiver_id, [])
+            start = bisect_right(received, after_id)
+            return [self._message_get(self._messages[message_id]) for message_id in received[start:start + limit]]
+
+    def get_inbox(self, receiver_id: int, before_id: Optional[int] = None, limit: int = 50) \
+            -> List[schemas.Message.Get]:
+        with self._lock:
+            received = self._received.get(receiver_id, [])
+            end = len(received) if before_id is None else bisect_left(received, before_id)
+            return [self._message_get(self._messages[message_id])
+                    for message_id in reversed(received[max(end - limit, 0):end])]
+
+    def mark_messages_read(self, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+        with self._lock:
+            marked = self._mark_read(receiver_id, sender_id, up_to_id)
+            if marked:
+                self._write_log({'op': 'read', 'receiver_id': receiver_id, 'sender_id': sender_id,
+                                 'up_to_id': up_to_id})
+            return marked
@@ -1,13 +1,38 @@
+import time
+from collections import Counter
+from itertools import repeat
+from sqlalchemy import bindparam, case, insert, lambda_stmt, select, text, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session, Query
-from typing import List, Union, Optional, Any
+from typing import List, Union, Optional, Any, Iterable, Set, Tuple, Dict, Callable
 
 import models
 import schemas
 
 from database import SessionLocal
 
+from crud import general_crud, search_crud
 from crud.crud_decorators import does_raise_error
-import general_crud
+
+
+UNREAD_STATUS = 0
+READ_STATUS = 1
+
+# Functions called with created messages after their transaction is committed
+committed_listeners: List[Callable[[List[schemas.Message.Get]], None]] = []
+
+
+def notify_committed(messages: List[schemas.Message.Get]) -> None:
+    """
+    Passes committed messages to every of committed_listeners (errors of listeners are printed only)
+    """
+    if not messages:
+        return
+    for listener in committed_listeners:
+        try:
+            listener(messages)
+        except Exception as e:
+            print(e)
 
 
 @does_raise_error('raise_error')
@@ -29,19 +54,411 @@ def get_message(db: Session, message_id, **_) -> models.Message:
         raise ValueError(message_id, f'message is not found by id')
 
 
+def add_unread(db: Session, conversations: Iterable[Tuple[int, int]], delta: int = 1) -> None:
+    """
+    Adds delta to unread counters of the conversations (doesn't commit)
+
+    :param db: current session
+    :param conversations: (receiver_id, sender_id) pairs, one pair per message
+    :param delta: value to add per message
+    """
+    counts = Counter(conversations)
+    if not counts:
+        return
+
+    stmt = sqlite_insert(models.UnreadCounter).values([
+        {'receiver_id': receiver_id, 'sender_id': sender_id, 'count': count * delta}
+        for (receiver_id, sender_id), count in counts.items()
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.UnreadCounter.receiver_id, models.UnreadCounter.sender_id],
+        set_={'count': models.UnreadCounter.count + stmt.excluded.count}
+    ))
+
+    receivers = Counter()
+    for (receiver_id, _), count in counts.items():
+        receivers[receiver_id] += count * delta
+    stats_stmt = sqlite_insert(models.UserStats).values([
+        {'user_id': receiver_id, 'sent': 0, 'received': 0, 'unread': unread}
+        for receiver_id, unread in receivers.items()
+    ])
+    db.execute(stats_stmt.on_conflict_do_update(
+        index_elements=[models.UserStats.user_id],
+        set_={'unread': models.UserStats.unread + stats_stmt.excluded.unread}
+    ))
+
+
+def add_user_stats(db: Session,
+                   messages: Iterable[Tuple[int, int, Optional[int], Optional[int]]],
+                   delta: Union[int, List[int]] = 1) -> None:
+    """
+    Adds delta per message to sent counters of senders and received counters of receivers (doesn't commit).
+    Unread counters are updated by add_unread
+
+    :param db: current session
+    :param messages: (sender_id, receiver_id, id, created_at) one per message,
+        id and created_at of new messages move last_message_id/at of both users (None to keep them)
+    :param delta: value to add per message, or values of every item of messages (e.g. counts of a conversation)
+    """
+    deltas = delta if isinstance(delta, list) else repeat(delta)
+    # user_id: [sent, received, last_message_id, last_message_at]
+    stats: Dict[int, list] = {}
+    for (sender_id, receiver_id, message_id, created_at), message_delta in zip(messages, deltas):
+        for user_id, column in ((sender_id, 0), (receiver_id, 1)):
+            row = stats.setdefault(user_id, [0, 0, None, None])
+            row[column] += message_delta
+            if message_id is not None and (row[2] is None or message_id > row[2]):
+                row[2], row[3] = message_id, created_at
+    if not stats:
+        return
+
+    stmt = sqlite_insert(models.UserStats).values([
+        {'user_id': user_id, 'sent': sent, 'received': received, 'unread': 0,
+         'last_message_id': last_message_id, 'last_message_at': last_message_at}
+        for user_id, (sent, received, last_message_id, last_message_at) in stats.items()
+    ])
+    # All expressions of the SET clause see old values of the row
+    is_newer = stmt.excluded.last_message_id > func.coalesce(models.UserStats.last_message_id, 0)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.UserStats.user_id],
+        set_={
+            'sent': models.UserStats.sent + stmt.excluded.sent,
+            'received': models.UserStats.received + stmt.excluded.received,
+            'last_message_id': case((is_newer, stmt.excluded.last_message_id),
+                                    else_=models.UserStats.last_message_id),
+            'last_message_at': case((is_newer, stmt.excluded.last_message_at),
+                                    else_=models.UserStats.last_message_at),
+        }
+    ))
+
+
+def rebuild_user_stats(db: Session) -> None:
+    """
+    Recounts statistics of users from the messages table, the archive and unread counters
+    """
+    db.query(models.UserStats).delete()
+    # user_id: [sent, received, unread, last_message_id, last_message_at]
+    stats: Dict[int, list] = {}
+
+    def row(user_id: int) -> list:
+        return stats.setdefault(user_id, [0, 0, 0, None, None])
+
+    for table in (models.Message, models.MessageArchiveBlock):
+        count = func.count(table.id) if table is models.Message else func.sum(table.count)
+        for column, index in ((table.sender_id, 0), (table.receiver_id, 1)):
+            for user_id, user_count in db.query(column, count).group_by(column):
+                row(user_id)[index] += user_count
+
+    for receiver_id, unread in db.query(models.UnreadCounter.receiver_id, func.sum(models.UnreadCounter.count)) \
+            .group_by(models.UnreadCounter.receiver_id):
+        row(receiver_id)[2] = unread
+
+    last_ids = {}
+    for table, last_id in ((models.Message, models.Message.id),
+                           (models.MessageArchiveBlock, models.MessageArchiveBlock.last_id)):
+        for column in (table.sender_id, table.receiver_id):
+            for user_id, message_id in db.query(column, func.max(last_id)).group_by(column):
+                last_ids[user_id] = max(last_ids.get(user_id, 0), message_id)
+    created = dict(db.query(models.Message.id, models.Message.created_at)
+                   .filter(models.Message.id.in_(list(set(last_ids.values())))))
+    for user_id, message_id in last_ids.items():
+        row(user_id)[3:] = [message_id, created.get(message_id)]
+
+    if stats:
+        db.execute(insert(models.UserStats.__table__), [
+            {'user_id': user_id, 'sent': sent, 'received': received, 'unread': unread,
+             'last_message_id': last_message_id, 'last_message_at': last_message_at}
+            for user_id, (sent, received, unread, last_message_id, last_message_at) in stats.items()
+        ])
+    db.commit()
+
+
+def get_user_stats(db: Session, user_id: int) -> schemas.UserStats.Get:
+    """
+    Returns precomputed message statistics of the user (one primary key read)
+    """
+    stats = db.execute(lambda_stmt(
+        lambda: select(models.UserStats).where(models.UserStats.user_id == user_id)
+    )).scalar()
+    if stats is None:
+        return schemas.UserStats.Get(user_id=user_id)
+    return schemas.UserStats.Get(user_id=user_id, sent=stats.sent, received=stats.received, unread=stats.unread,
+                                 last_message_id=stats.last_message_id or 0,
+                                 last_message_at=stats.last_message_at or 0)
+
+
+def rebuild_unread_counters(db: Session) -> None:
+    """
+    Recounts unread counters from the messages table
+    """
+    db.query(models.UnreadCounter).delete()
+    rows = db.query(models.Message.receiver_id, models.Message.sender_id, func.count(models.Message.id)) \
+        .filter(models.Message.status == UNREAD_STATUS) \
+        .group_by(models.Message.receiver_id, models.Message.sender_id) \
+        .all()
+    if rows:
+        db.execute(insert(models.UnreadCounter.__table__), [
+            {'receiver_id': receiver_id, 'sender_id': sender_id, 'count': count}
+            for receiver_id, sender_id, count in rows
+        ])
+    db.commit()
+
+
+def get_unread_counts(db: Session, receiver_id: int) -> Dict[int, int]:
+    """
+    Returns counts of unread messages of the receiver
+
+    :param db: current session
+    :param receiver_id: id of the receiver
+    :return: {sender_id: count of unread messages} of senders with unread messages
+    """
+    rows = db.execute(lambda_stmt(
+        lambda: select(models.UnreadCounter.sender_id, models.UnreadCounter.count)
+        .where(models.UnreadCounter.receiver_id == receiver_id, models.UnreadCounter.count > 0)
+    )).all()
+    return {sender_id: count for sender_id, count in rows}
+
+
+# Built once: parameters of a DML lambda statement are not refreshed on a cache hit in the ORM session
+_MARK_MESSAGES_READ = update(models.Message) \
+    .where(models.Message.receiver_id == bindparam('receiver'),
+           models.Message.sender_id == bindparam('sender'),
+           models.Message.id <= bindparam('up_to'),
+           models.Message.status == UNREAD_STATUS) \
+    .values(status=READ_STATUS) \
+    .execution_options(synchronize_session=False)
+
+
+def mark_messages_read(db: Session, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+    """
+    Marks all unread messages of the conversation up to the message id (inclusive) as read with one UPDATE
+
+    :param db: current session
+    :param receiver_id: id of the receiver
+    :param sender_id: id of the sender
+    :param up_to_id: id of the last message to mark
+    :return: count of marked messages
+    """
+    marked = db.execute(_MARK_MESSAGES_READ,
+                        {'receiver': receiver_id, 'sender': sender_id, 'up_to': up_to_id}).rowcount
+
+    if marked:
+        add_unread(db, [(receiver_id, sender_id)], -marked)
+    db.commit()
+    return marked
+
+
+def get_messages_after(db: Session, receiver_id: int, after_id: int, limit: int = 100) -> List[models.Message]:
+    """
+    Returns messages of the receiver with ids greater than after_id in the id order
+
+    :param db: current session
+    :param receiver_id: id of the receiver
+    :param after_id: id of the last known message
+    :param limit: max count of messages to return
+    :return: list of messages
+    """
+    return db.execute(lambda_stmt(
+        lambda: select(models.Message)
+        .where(models.Message.receiver_id == receiver_id, models.Message.id > after_id)
+        .order_by(models.Message.id)
+        .limit(limit)
+    )).scalars().all()
+
+
+def delete_user_messages(db: Session, user_id: int, batch_size: int = 500) -> int:
+    """
+    Deletes one batch of messages sent or received by the user and commits it.
+    Unread counters of other receivers and the search index are updated in the same transaction
+
+    :param db: current session
+    :param user_id: id of the user
+    :param batch_size: max count of messages to delete
+    :return: count of deleted messages (0 if the user has no messages left)
+    """
+    messages = []
+    for column in (models.Message.receiver_id, models.Message.sender_id):
+        messages += db.query(models.Message.id, models.Message.sender_id, models.Message.receiver_id,
+                             models.Message.text, models.Message.status) \
+            .filter(column == user_id) \
+            .limit(batch_size - len(messages)) \
+            .all()
+        if len(messages) >= batch_size:
+            break
+
+    if not messages:
+        return 0
+
+    add_unread(db, [(message.receiver_id, message.sender_id) for message in messages
+                    if message.status == UNREAD_STATUS and message.receiver_id != user_id], -1)
+    add_user_stats(db, [(message.sender_id, message.receiver_id, None, None) for message in messages], -1)
+    search_crud.unindex_messages(db, [(message.id, message.text) for message in messages])
+    db.query(models.Message) \
+        .filter(models.Message.id.in_([message.id for message in messages])) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return len(messages)
+
+
+def get_existing_user_ids(db: Session, user_ids: Iterable[int]) -> Set[int]:
+    """
+    Returns those of the user_ids which belong to existing users (uses one query)
+
+    :param db: current session
+    :param user_ids: ids to check
+    :return: set of found ids
+    """
+    user_ids = list(set(user_ids))
+    if not user_ids:
+        return set()
+    return set(db.execute(lambda_stmt(
+        lambda: select(models.User.id).where(models.User.id.in_(user_ids), models.User.deleted == False)
+    )).scalars())
+
+
 @does_raise_error('raise_error')
 def post_message(db: Session, new_message_data: schemas.Message.Create, **_) -> models.Message:
+    found_ids = get_existing_user_ids(db, (new_message_data.sender_id, new_message_data.receiver_id))
+    if {new_message_data.sender_id, new_message_data.receiver_id} - found_ids:
+        raise ValueError(new_message_data, f'sender or receiver is not found')
+
     try:
-        return general_crud.post_item(db, models.Message, new_message_data)
+        message = models.Message(**new_message_data.dict())
+        db.add(message)
+        add_unread(db, [(message.receiver_id, message.sender_id)])
+        db.flush()
+        add_user_stats(db, [(message.sender_id, message.receiver_id, message.id, message.created_at)])
+        search_crud.index_messages(db, [(message.id, message.text)])
+        db.commit()
+        db.refresh(message)
     except Exception as e:
         print(e)
+        db.rollback()
         raise ValueError(new_message_data, f'message creation error')
 
+    notify_committed([schemas.Message.Get.from_orm(message)])
+    return message
+
+
+def post_messages(db: Session,
+                  new_messages_data: List[schemas.Message.Create],
+                  check_senders: bool = True) -> List[Optional[models.Message]]:
+    """
+    Posts the messages in one transaction (one commit for the whole list)
+
+    :param db: current session
+    :param new_messages_data: data of messages to create
+    :param check_senders: check that senders exist in this database
+        (False if senders are checked by the caller, e.g. they are stored on another shard)
+    :return: created messages in the same order, None stands in place of a message
+        whose sender or receiver is not found
+    """
+    found_ids = get_existing_user_ids(
+        db,
+        ([data.sender_id for data in new_messages_data] if check_senders else []) +
+        [data.receiver_id for data in new_messages_data]
+    )
+
+    messages: List[Optional[models.Message]] = []
+    for data in new_messages_data:
+        if (not check_senders or data.sender_id in found_ids) and data.receiver_id in found_ids:
+            message = models.Message(**data.dict())
+            db.add(message)
+            messages.append(message)
+        else:
+            messages.append(None)
+
+    add_unread(db, [(message.receiver_id, message.sender_id) for message in messages if message is not None])
+    db.flush()
+    add_user_stats(db, [(message.sender_id, message.receiver_id, message.id, message.created_at)
+                        for message in messages if message is not None])
+    committed = [schemas.Message.Get.from_orm(message) for message in messages if message is not None]
+    search_crud.index_messages(db, [(message.id, message.text) for message in committed])
+    db.commit()
+    notify_committed(committed)
+    return messages
+
+
+@does_raise_error('raise_error')
+def broadcast_message(db: Session,
+                      broadcast_data: schemas.Broadcast.Create,
+                      to_all: bool = False,
+                      receiver_status: Optional[int] = None,
+                      **_) -> schemas.Broadcast.Get:
+    """
+    Sends one text to many receivers: receivers are checked with one query
+    and all messages are inserted with one executemany in one transaction
+
+    :param db: current session
+    :param broadcast_data: sender, text and receivers of the message
+    :param to_all: send the message to all users (except the sender) instead of broadcast_data.receiver_ids
+    :param receiver_status: if to_all, send the message only to users with that status
+    :return: sent broadcast with ids of created messages and receivers which are not found
+    :except ValueError: occurs if the sender is not found
+    """
+    sender_id = broadcast_data.sender_id
+
+    if to_all:
+        query = db.query(models.User.id).filter(models.User.id != sender_id, models.User.deleted == False)
+        if receiver_status is not None:
+            query = query.filter(models.User.status == receiver_status)
+        receiver_ids = [row.id for row in query.order_by(models.User.id)]
+        found_ids = get_existing_user_ids(db, (sender_id,))
+        missing_ids = []
+    else:
+        receiver_ids = list(dict.fromkeys(broadcast_data.receiver_ids))
+        found_ids = get_existing_user_ids(db, receiver_ids + [sender_id])
+        missing_ids = [receiver_id for receiver_id in receiver_ids if receiver_id not in found_ids]
+        receiver_ids = [receiver_id for receiver_id in receiver_ids if receiver_id in found_ids]
+
+    if sender_id not in found_ids:
+        raise ValueError(sender_id, f'sender is not found')
+
+    message_ids: List[int] = []
+    if receiver_ids:
+        created_at = int(time.time())
+        db.execute(
+            insert(models.Message.__table__),
+            [
+                {'sender_id': sender_id, 'receiver_id': receiver_id, 'text': broadcast_data.text, 'status': 0,
+                 'created_at': created_at}
+                for receiver_id in receiver_ids
+            ]
+        )
+        # The transaction holds the sqlite write lock, so rowids of the inserted rows are consecutive
+        last_id = db.execute(text('SELECT last_insert_rowid()')).scalar()
+        message_ids = list(range(last_id - len(receiver_ids) + 1, last_id + 1))
+        add_unread(db, [(receiver_id, sender_id) for receiver_id in receiver_ids])
+        add_user_stats(db, [(sender_id, receiver_id, message_id, created_at)
+                            for message_id, receiver_id in zip(message_ids, receiver_ids)])
+        search_crud.index_messages(db, [(message_id, broadcast_data.text) for message_id in message_ids])
+        db.commit()
+        notify_committed([
+            schemas.Message.Get(id=message_id, sender_id=sender_id, receiver_id=receiver_id,
+                                text=broadcast_data.text, status=UNREAD_STATUS)
+            for message_id, receiver_id in zip(message_ids, receiver_ids)
+        ])
+
+    return schemas.Broadcast.Get(
+        sender_id=sender_id,
+        text=broadcast_data.text,
+        receiver_ids=receiver_ids,
+        message_ids=message_ids,
+        missing_receiver_ids=missing_ids
+    )
+
 
 @does_raise_error('raise_error')
 def put_message(db: Session, message: models.Message, new_message_data: schemas.Message.Edit, **_) -> models.Message:
     found_message = get_message(db, message.id, raise_error=True)
     try:
+        was_unread = found_message.status == UNREAD_STATUS
+        is_unread = new_message_data.status == UNREAD_STATUS
+        if was_unread != is_unread:
+            add_unread(db, [(found_message.receiver_id, found_message.sender_id)], 1 if is_unread else -1)
+        if found_message.text != new_message_data.text:
+            search_crud.unindex_messages(db, [(found_message.id, found_message.text)])
+            search_crud.index_messages(db, [(found_message.id, new_message_data.text)])
         return general_crud.put_item(db, found_message, new_message_data)
     except Exception as e:
         print(e)
@@ -51,6 +468,10 @@ def put_message(db: Session, message: models.Message, new_message_data: schemas.
 @does_raise_error('raise_error')
 def del_message(db: Session, message: models.Message) -> models.Message:
     found_message = get_message(db, message.id, raise_error=True)
+    if found_message.status == UNREAD_STATUS:
+        add_unread(db, [(found_message.receiver_id, found_message.sender_id)], -1)
+    add_user_stats(db, [(found_message.sender_id, found_message.receiver_id, None, None)], -1)
+    search_crud.unindex_messages(db, [(found_message.id, found_message.text)])
     db.delete(found_message)
     db.commit()
     return found_message
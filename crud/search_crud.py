@@ -0,0 +1,335 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import models
+
+
+MESSAGES_FTS_TABLE = 'messages_fts'
+USERS_FTS_TABLE = 'users_trigram_fts'
+
+# False if sqlite is built without FTS5, then indexing is skipped and search raises an error
+fts_enabled = False
+# False if sqlite doesn't support the trigram tokenizer (3.34+), then fuzzy user search falls back to the prefix one
+users_fts_enabled = False
+
+
+def _table_exists(db_or_bind, name: str) -> bool:
+    return db_or_bind.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': name}
+    ).first() is not None
+
+
+def _init_fts(bind: Engine, fts_table: str, content_table: str, columns: str, tokenize: str) -> bool:
+    try:
+        with bind.begin() as connection:
+            if not _table_exists(connection, fts_table):
+                connection.execute(text(
+                    f"CREATE VIRTUAL TABLE {fts_table} USING fts5("
+                    f"{columns}, content='{content_table}', content_rowid='id', tokenize='{tokenize}')"
+                ))
+                connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES('rebuild')"))
+        return True
+    except OperationalError as e:
+        print(e)
+        return False
+
+
+def init_message_fts(bind: Engine) -> bool:
+    """
+    Creates the FTS5 index of message texts (external content table over messages)
+    and fills it from existing messages when it is created
+
+    :param bind: engine of the database
+    :return: True if full-text search is available
+    """
+    global fts_enabled
+    fts_enabled = _init_fts(bind, MESSAGES_FTS_TABLE, models.Message.__tablename__, 'text', 'unicode61')
+    return fts_enabled
+
+
+def init_users_fts(bind: Engine) -> bool:
+    """
+    Creates the trigram FTS5 index of nick names and names of users (external content table over users)
+    and fills it from existing users when it is created
+
+    :param bind: engine of the database
+    :return: True if fuzzy user search is available
+    """
+    global users_fts_enabled
+    users_fts_enabled = _init_fts(bind, USERS_FTS_TABLE, models.User.__tablename__,
+                                  'nik_name, fst_name, sec_name', 'trigram')
+    return users_fts_enabled
+
+
+def index_messages(db: Session, messages: Iterable[Tuple[int, str]]) -> None:
+    """
+    Adds texts of new messages to the index (doesn't commit)
+
+    :param db: current session
+    :param messages: (id, text) of messages
+    """
+    rows = [{'id': message_id, 'text': message_text} for message_id, message_text in messages]
+    if fts_enabled and rows:
+        db.execute(text(f"INSERT INTO {MESSAGES_FTS_TABLE}(rowid, text) VALUES (:id, :text)"), rows)
+
+
+def unindex_messages(db: Session, messages: Iterable[Tuple[int, str]]) -> None:
+    """
+    Removes texts of messages from the index (doesn't commit).
+    The texts must be equal to the indexed ones (external content tables require old values)
+
+    :param db: current session
+    :param messages: (id, text) of messages
+    """
+    rows = [{'id': message_id, 'text': message_text} for message_id, message_text in messages]
+    if fts_enabled and rows:
+        db.execute(text(
+            f"INSERT INTO {MESSAGES_FTS_TABLE}({MESSAGES_FTS_TABLE}, rowid, text) VALUES ('delete', :id, :text)"
+        ), rows)
+
+
+def build_match_query(query: str, prefix: bool = True) -> str:
+    """
+    Converts user input to an FTS5 query: every word must be found, with prefix=True a word matches
+    any word starting with it. Syntax of FTS5 in the input is not interpreted
+
+    Example::
+
+        build_match_query('hello wor') == '"hello"* "wor"*'
+    """
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' if prefix else f'"{word}"' for word in words)
+
+
+def _parse_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        score, message_id = cursor.split('_')
+        return float(score), int(message_id)
+    except ValueError:
+        raise ValueError(cursor, f'wrong cursor')
+
+
+def search_messages(db: Session,
+                    query: str,
+                    receiver_id: Optional[int] = None,
+                    prefix: bool = True,
+                    limit: int = 20,
+                    cursor: Optional[str] = None) -> Tuple[List[models.Message], Optional[str]]:
+    """
+    Returns messages matching the query ordered by relevance (bm25), paged with keyset cursors
+    (archived messages are not indexed, see archive_crud.archive_messages)
+
+    :param db: current session
+    :param query: words to search
+    :param receiver_id: search only messages of that receiver
+    :param prefix: match words by prefix
+    :param limit: count of messages on a page
+    :param cursor: next_cursor returned with the previous page
+    :return: (messages, next_cursor), next_cursor is None on the last page
+    :except ValueError: occurs if the cursor is wrong or full-text search is not available
+    """
+    if not fts_enabled:
+        raise ValueError(query, f'full-text search is not available')
+
+    match = build_match_query(query, prefix)
+    if not match:
+        return [], None
+
+    conditions = [f"{MESSAGES_FTS_TABLE} MATCH :match"]
+    params = {'match': match, 'limit': limit + 1}
+    if receiver_id is not None:
+        conditions.append('m.receiver_id = :receiver_id')
+        params['receiver_id'] = receiver_id
+    if cursor:
+        params['score'], params['after_id'] = _parse_cursor(cursor)
+        conditions.append('(score > :score OR (score = :score AND m.id > :after_id))')
+
+    rows = db.execute(text(
+        f"SELECT m.id AS id, bm25({MESSAGES_FTS_TABLE}) AS score "
+        f"FROM {MESSAGES_FTS_TABLE} JOIN {models.Message.__tablename__} m ON m.id = {MESSAGES_FTS_TABLE}.rowid "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ORDER BY score, m.id "
+        f"LIMIT :limit"
+    ), params).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1].score!r}_{rows[-1].id}'
+
+    messages = {
+        message.id: message
+        for message in db.query(models.Message).filter(models.Message.id.in_([row.id for row in rows]))
+    }
+    return [messages[row.id] for row in rows if row.id in messages], next_cursor
+
+
+# ------------------
+#  Users typeahead
+# ------------------
+class TypeaheadCache:
+    """
+    Small thread-safe LRU cache of typeahead results with a time to live.
+    It is cleared by user_crud on every change of users
+
+    :param max_size: max count of cached queries
+    :param ttl: seconds a result is valid
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+typeahead_cache = TypeaheadCache()
+
+
+def index_users(db: Session, users: Iterable[Tuple[int, str, str, str]]) -> None:
+    """
+    Adds nick names and names of users to the trigram index (doesn't commit)
+
+    :param db: current session
+    :param users: (id, nik_name, fst_name, sec_name) of users
+    """
+    rows = [{'id': user_id, 'nik_name': nik_name, 'fst_name': fst_name, 'sec_name': sec_name}
+            for user_id, nik_name, fst_name, sec_name in users]
+    if users_fts_enabled and rows:
+        db.execute(text(
+            f"INSERT INTO {USERS_FTS_TABLE}(rowid, nik_name, fst_name, sec_name) "
+            f"VALUES (:id, :nik_name, :fst_name, :sec_name)"
+        ), rows)
+
+
+def unindex_users(db: Session, users: Iterable[Tuple[int, str, str, str]]) -> None:
+    """
+    Removes users from the trigram index (doesn't commit)
+
+    :param db: current session
+    :param users: (id, nik_name, fst_name, sec_name) equal to the indexed values
+    """
+    rows = [{'id': user_id, 'nik_name': nik_name, 'fst_name': fst_name, 'sec_name': sec_name}
+            for user_id, nik_name, fst_name, sec_name in users]
+    if users_fts_enabled and rows:
+        db.execute(text(
+            f"INSERT INTO {USERS_FTS_TABLE}({USERS_FTS_TABLE}, rowid, nik_name, fst_name, sec_name) "
+            f"VALUES ('delete', :id, :nik_name, :fst_name, :sec_name)"
+        ), rows)
+
+
+def _brief_query(db: Session):
+    return db.query(models.User.id, models.User.nik_name, models.User.fst_name, models.User.sec_name) \
+        .filter(models.User.deleted == False)
+
+
+def search_users_by_prefix(db: Session, prefix: str, limit: int = 10) -> List[Any]:
+    """
+    Returns users whose nick names start with the prefix, using a range scan of the nik_name index
+
+    :param db: current session
+    :param prefix: beginning of a nick name (with or without "@")
+    :param limit: max count of users
+    :return: rows of (id, nik_name, fst_name, sec_name) ordered by nick name
+    """
+    prefix = '@' + prefix.lstrip('@')
+    try:
+        prefix.encode('utf-8')
+    except UnicodeEncodeError:  # Lone surrogates are never stored
+        return []
+
+    query = _brief_query(db).filter(models.User.nik_name >= prefix)
+    upper = _prefix_upper_bound(prefix)
+    if upper is not None:
+        query = query.filter(models.User.nik_name < upper)
+    return query.order_by(models.User.nik_name).limit(limit).all()
+
+
+def _prefix_upper_bound(prefix: str) -> Optional[str]:
+    """
+    Returns the smallest string greater than every string starting with the prefix in the binary (UTF-8,
+    code point) order of sqlite, or None if there is no such string
+    """
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:  # Surrogates are not characters of UTF-8
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
+def search_users_fuzzy(db: Session, query: str, limit: int = 10) -> List[Any]:
+    """
+    Returns users whose nick name, first or second name contains the query (trigram index),
+    ordered by relevance. Falls back to the prefix search for queries shorter than 3 symbols
+
+    :param db: current session
+    :param query: part of a nick name or a name
+    :param limit: max count of users
+    :return: rows of (id, nik_name, fst_name, sec_name)
+    """
+    query = query.lstrip('@')
+    if not users_fts_enabled or len(query) < 3:
+        return search_users_by_prefix(db, query, limit) if query else []
+
+    match = '"' + query.replace('"', '""') + '"'
+    ids = [row.id for row in db.execute(text(
+        f"SELECT rowid AS id FROM {USERS_FTS_TABLE} WHERE {USERS_FTS_TABLE} MATCH :match "
+        f"ORDER BY bm25({USERS_FTS_TABLE}), rowid LIMIT :limit"
+    ), {'match': match, 'limit': limit})]
+
+    users = {user.id: user for user in _brief_query(db).filter(models.User.id.in_(ids))}
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+def search_users(db: Session, query: str, fuzzy: bool = False, limit: int = 10) -> List[Any]:
+    """
+    Typeahead search of users with a cache of hot queries
+
+    :param db: current session
+    :param query: typed text
+    :param fuzzy: search substrings of nick names and names instead of nick name prefixes
+    :param limit: max count of users
+    :return: rows of (id, nik_name, fst_name, sec_name)
+    """
+    if not query.lstrip('@'):
+        return []
+
+    key = (fuzzy, query, limit)
+    users = typeahead_cache.get(key)
+    if users is None:
+        users = search_users_fuzzy(db, query, limit) if fuzzy else search_users_by_prefix(db, query, limit)
+        typeahead_cache.put(key, users)
+    return users
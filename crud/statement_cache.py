@@ -0,0 +1,59 @@
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+
+class StatementCacheStats:
+    """
+    Counts hits of the compiled statement cache of engines (after_cursor_execute event).
+    Statements of hot crud lookups are lambda statements (lambda_stmt), so on a hit neither
+    the statement is built nor its SQL is compiled again.
+    Raw SQL (exec_driver_sql, text without a cache key) is counted as uncached
+
+    Example::
+
+        statement_cache_stats.listen()
+        statement_cache_stats.stats()  # {'hits': ..., 'misses': ..., 'uncached': ..., 'hit_rate': ...}
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self._lock = threading.Lock()
+
+    def listen(self, target=Engine) -> None:
+        """
+        :param target: engine to count, all engines by default
+        """
+        if not event.contains(target, 'after_cursor_execute', self._after_cursor_execute):
+            event.listen(target, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany) -> None:
+        cache_hit = getattr(context, 'cache_hit', None)
+        with self._lock:
+            if cache_hit is CACHE_HIT:
+                self.hits += 1
+            elif cache_hit is CACHE_MISS:
+                self.misses += 1
+            else:
+                self.uncached += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            cached = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncached': self.uncached,
+                'hit_rate': round(self.hits / cached, 4) if cached else 0.0
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = self.misses = self.uncached = 0
+
+
+statement_cache_stats = StatementCacheStats()
@@ -0,0 +1,182 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Union
+
+from sqlalchemy.orm import Session
+
+import schemas
+from crud import archive_crud, message_crud, user_crud
+
+
+class Storage(ABC):
+    """
+    Storage of users and messages used by the core routes. Methods take and return schemas,
+    so routes don't depend on a backend (see SQLAlchemyStorage, memory_storage.MemoryStorage
+    and sharding.ShardedStorage)
+
+    Errors of methods are ValueError (user is not found, nick name is taken and so on)
+    """
+
+    # -------
+    #  Users
+    # -------
+    @abstractmethod
+    def get_user(self, user_id: int) -> schemas.User.Get:
+        """
+        :except ValueError: occurs if user is not found by id
+        """
+
+    @abstractmethod
+    def get_user_id(self, user_identifier: Union[int, str]) -> int:
+        """
+        Returns id of the user found by id or nick name
+
+        :except ValueError: occurs if user is not found
+        """
+
+    @abstractmethod
+    def get_users(self, skip: int = 0, limit: int = 100) -> List[schemas.User.Get]:
+        """
+        Returns users ordered by id in range of the skip and the limit
+        """
+
+    @abstractmethod
+    def get_users_count(self) -> int:
+        pass
+
+    @abstractmethod
+    def post_user(self, new_user_data: schemas.User.Create) -> schemas.User.Get:
+        """
+        :except ValueError: occurs if user with the given nick name is already taken
+        """
+
+    @abstractmethod
+    def put_user(self, user_id: int, new_user_data: schemas.User.Edit) -> schemas.User.Get:
+        """
+        :except ValueError: occurs if user is not found or the nick name is taken
+        """
+
+    @abstractmethod
+    def del_user(self, user_id: int) -> schemas.UserBrief.Get:
+        """
+        Deletes the user with its messages (right away or later in the background)
+
+        :except ValueError: occurs if user is not found
+        """
+
+    @abstractmethod
+    def get_user_stats(self, user_id: int) -> schemas.UserStats.Get:
+        pass
+
+    @abstractmethod
+    def get_user_messages(self, user_id: int) -> schemas.UserMessages.Get:
+        """
+        Returns received and sent messages of the user (not archived ones)
+
+        :except ValueError: occurs if user is not found by id
+        """
+
+    # ----------
+    #  Messages
+    # ----------
+    @abstractmethod
+    def post_message(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        """
+        :except ValueError: occurs if the sender or the receiver is not found
+        """
+
+    @abstractmethod
+    def get_unread_counts(self, receiver_id: int) -> Dict[int, int]:
+        """
+        Returns {sender_id: count of unread messages} of senders with unread messages
+        """
+
+    @abstractmethod
+    def mark_messages_read(self, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+        """
+        Marks unread messages of the conversation up to the message id (inclusive) as read
+
+        :return: count of marked messages
+        """
+
+    @abstractmethod
+    def get_messages_after(self, receiver_id: int, after_id: int, limit: int = 100) -> List[schemas.Message.Get]:
+        """
+        Returns messages of the receiver with ids greater than after_id ordered by id (for streams and long polling)
+        """
+
+    @abstractmethod
+    def get_inbox(self, receiver_id: int, before_id: Optional[int] = None, limit: int = 50) \
+            -> List[schemas.Message.Get]:
+        """
+        Returns messages of the receiver with ids less than before_id (None for no bound), newest first
+        """
+
+
+class SQLAlchemyStorage(Storage):
+    """
+    Storage over the crud functions and a SQLAlchemy session
+
+    :param db: current session
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def get_user(self, user_id: int) -> schemas.User.Get:
+        return schemas.User.Get.from_orm(user_crud.get_user(self.db, user_id))
+
+    def get_user_id(self, user_identifier: Union[int, str]) -> int:
+        user = user_crud.get_user(self.db, user_identifier) \
+            if type(user_identifier) is int \
+            else user_crud.get_user_by_nik_name(self.db, user_identifier)
+        return user.id
+
+    def get_users(self, skip: int = 0, limit: int = 100) -> List[schemas.User.Get]:
+        return [schemas.User.Get.from_orm(user) for user in user_crud.get_users(self.db, skip, limit)]
+
+    def get_users_count(self) -> int:
+        return user_crud.get_users_count(self.db)
+
+    def post_user(self, new_user_data: schemas.User.Create) -> schemas.User.Get:
+        return schemas.User.Get.from_orm(user_crud.post_user(self.db, new_user_data=new_user_data))
+
+    def put_user(self, user_id: int, new_user_data: schemas.User.Edit) -> schemas.User.Get:
+        user = user_crud.get_user(self.db, user_id)
+        return schemas.User.Get.from_orm(user_crud.put_user(self.db, user=user, new_user_data=new_user_data))
+
+    def del_user(self, user_id: int) -> schemas.UserBrief.Get:
+        user = user_crud.get_user(self.db, user_id)
+        # The nick name is replaced with the tombstone one by the deletion
+        deleted_user = schemas.UserBrief.Get.from_orm(user)
+        user_crud.del_user(self.db, user)
+        return deleted_user
+
+    def get_user_stats(self, user_id: int) -> schemas.UserStats.Get:
+        return message_crud.get_user_stats(self.db, user_id)
+
+    def get_user_messages(self, user_id: int) -> schemas.UserMessages.Get:
+        user = user_crud.get_user(self.db, user_id)
+        return schemas.UserMessages.Get(
+            user_id=user.id,
+            received_messages=[schemas.Message.Get.from_orm(message)
+                               for message in sorted(user.received_messages, key=lambda message: message.id)],
+            sent_messages=[schemas.Message.Get.from_orm(message)
+                           for message in sorted(user.sent_messages, key=lambda message: message.id)]
+        )
+
+    def post_message(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        return schemas.Message.Get.from_orm(message_crud.post_message(self.db, new_message_data))
+
+    def get_unread_counts(self, receiver_id: int) -> Dict[int, int]:
+        return message_crud.get_unread_counts(self.db, receiver_id)
+
+    def mark_messages_read(self, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+        return message_crud.mark_messages_read(self.db, receiver_id, sender_id, up_to_id)
+
+    def get_messages_after(self, receiver_id: int, after_id: int, limit: int = 100) -> List[schemas.Message.Get]:
+        return [schemas.Message.Get.from_orm(message)
+                for message in message_crud.get_messages_after(self.db, receiver_id, after_id, limit)]
+
+    def get_inbox(self, receiver_id: int, before_id: Optional[int] = None, limit: int = 50) \
+            -> List[schemas.Message.Get]:
+        return archive_crud.get_inbox(self.db, receiver_id, before_id, limit)
@@ -1,9 +1,10 @@
+from sqlalchemy import func, lambda_stmt, or_, select
 from sqlalchemy.orm import Session
 from typing import List, Union
 
 import models
 import schemas
-from crud import general_crud
+from crud import archive_crud, general_crud, message_crud, search_crud
 
 from crud.crud_decorators import does_raise_error
 
@@ -18,9 +19,9 @@ def get_user(db: Session, user_id: int, **_) -> models.User:
     :return: sought user from model
     :except ValueError: occurs if user is not found by id
     """
-    user = general_crud.get_item(db, models.User, user_id)
+    user = db.execute(lambda_stmt(lambda: select(models.User).where(models.User.id == user_id))).scalar()
 
-    if user is not None:
+    if user is not None and not user.deleted:
         return user
     else:
         raise ValueError(user, f'user is not found by id')
@@ -41,7 +42,9 @@ def get_user_by_nik_name(db: Session, nik_name: str, **_) -> models.User:
     :return: sought user from model
     :except ValueError: occurs if user is not found by nick name
     """
-    user = db.query(models.User).filter(models.User.nik_name == nik_name).first()
+    user = db.execute(lambda_stmt(
+        lambda: select(models.User).where(models.User.nik_name == nik_name, models.User.deleted == False).limit(1)
+    )).scalar()
     if user:
         return user
     else:
@@ -58,7 +61,9 @@ def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[models.User]
     :return: list of sought users from model (or empty list if there is no users)
     """
 
-    return db.query(models.User).offset(skip).limit(limit).all()
+    return db.execute(lambda_stmt(
+        lambda: select(models.User).where(models.User.deleted == False).offset(skip).limit(limit)
+    )).scalars().all()
 
 
 def get_users_count(db: Session) -> int:
@@ -68,7 +73,9 @@ def get_users_count(db: Session) -> int:
     :param db: current session
     :return: count of users
     """
-    return db.query(models.User).count()
+    return db.execute(lambda_stmt(
+        lambda: select(func.count(models.User.id)).where(models.User.deleted == False)
+    )).scalar()
 
 
 @does_raise_error('raise_error')
@@ -83,11 +90,20 @@ def post_user(db: Session, new_user_data: schemas.User.Create, **_) -> models.Us
     """
 
     try:
-        return general_crud.post_item(db, models.User, new_user_data)
+        user = models.User(**new_user_data.dict())
+        db.add(user)
+        db.flush()
+        search_crud.index_users(db, [(user.id, user.nik_name, user.fst_name, user.sec_name)])
+        db.commit()
+        db.refresh(user)
     except Exception as e:
         print(e)
+        db.rollback()
         raise ValueError(new_user_data, f'user with that nick name is already created')
 
+    search_crud.typeahead_cache.clear()
+    return user
+
 
 @does_raise_error('raise_error')
 def put_user(db: Session, user: models.User, new_user_data: schemas.User.Edit, **_) -> models.User:
@@ -103,25 +119,76 @@ def put_user(db: Session, user: models.User, new_user_data: schemas.User.Edit, *
 
     found_user = get_user(db, user.id, raise_error=True)
     try:
-        return general_crud.put_item(db, found_user, new_user_data)
+        search_crud.unindex_users(db, [(found_user.id, found_user.nik_name, found_user.fst_name, found_user.sec_name)])
+        search_crud.index_users(db, [(found_user.id, new_user_data.nik_name, new_user_data.fst_name,
+                                      new_user_data.sec_name)])
+        updated_user = general_crud.put_item(db, found_user, new_user_data)
     except Exception as e:
         print(e)
+        db.rollback()
         raise ValueError((user, new_user_data,), f'update user with a data error')
 
+    search_crud.typeahead_cache.clear()
+    return updated_user
+
+
+def tombstone_nik_name(user_id: int) -> str:
+    """
+    Returns the unique nick name of a soft deleted user, which is never valid for a live user ("#" is not accepted)
+    """
+    return f'#deleted_{user_id}'
+
 
 @does_raise_error('raise_error')
 def del_user(db: Session, user: models.User) -> models.User:
     """
-    Deletes user
+    Soft deletes user: marks it with the tombstone, so it is not found anymore,
+    and releases its nick name right away (see tombstone_nik_name).
+    The user and its messages are removed later by the reaper (see purge_deleted_user)
 
     :param db: current session
     :param user: user to delete
-    :return: None
+    :return: deleted user (with the tombstone nick name)
     :except ValueError: occurs if a user is not found in the database
     """
 
     found_user = get_user(db, user.id, raise_error=True)
-    db.delete(found_user)
+    search_crud.unindex_users(db, [(found_user.id, found_user.nik_name, found_user.fst_name, found_user.sec_name)])
+    found_user.nik_name = tombstone_nik_name(found_user.id)
+    found_user.deleted = True
     db.commit()
+    search_crud.typeahead_cache.clear()
     return found_user
 
+
+def get_deleted_user_ids(db: Session, limit: int = 10) -> List[int]:
+    """
+    Returns ids of soft deleted users waiting for the reaper
+    """
+    return [row.id for row in db.query(models.User.id).filter(models.User.deleted == True).limit(limit)]
+
+
+def purge_deleted_user(db: Session, user_id: int, batch_size: int = 500) -> bool:
+    """
+    Removes one batch of messages of the soft deleted user (in its own transaction),
+    and the user itself when there are no messages left
+
+    :param db: current session
+    :param user_id: id of the soft deleted user
+    :param batch_size: max count of messages to remove
+    :return: True if the user is removed completely
+    """
+    if message_crud.delete_user_messages(db, user_id, batch_size):
+        return False
+
+    db.query(models.UnreadCounter) \
+        .filter(or_(models.UnreadCounter.receiver_id == user_id, models.UnreadCounter.sender_id == user_id)) \
+        .delete(synchronize_session=False)
+    archive_crud.delete_user_archive(db, user_id)
+    db.query(models.UserStats).filter(models.UserStats.user_id == user_id).delete(synchronize_session=False)
+    db.query(models.User) \
+        .filter(models.User.id == user_id, models.User.deleted == True) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return True
+
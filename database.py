@@ -1,13 +1,167 @@
-from sqlalchemy import create_engine
+import os
+import secrets
+from typing import List, Optional, Set
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 
 
 SQLALCHEMY_DATABASE_URL = 'sqlite:///dbs/test_db.sqlite3'
+# Restores (see backup.restore) write the database into a fresh file and put its url into this file,
+# which overrides SQLALCHEMY_DATABASE_URL
+DATABASE_URL_POINTER_PATH = 'dbs/current_database'
+
+# Snapshots of the database (see backup.snapshot) are copied by pages per step with pauses between steps
+BACKUP_DIR = 'dbs/backups'
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005
+# Every process of the running app holds this file locked (shared), the command line restore refuses while it is
+APP_LOCK_PATH = 'dbs/app.lock'
+# Token of admin routes (snapshots and restores) expected in the X-Admin-Token header,
+# admin routes are refused while it is not set
+ADMIN_TOKEN: Optional[str] = os.environ.get('FASTAPI_TEST_ADMIN_TOKEN')
+
+# Users and their received messages are partitioned across these databases (see sharding.ShardRouter),
+# the order must never change. Empty list disables sharding
+SHARD_DATABASE_URLS: List[str] = []
+# Global directory of user ids and nick names used with sharding
+DIRECTORY_DATABASE_URL = 'sqlite:///dbs/directory.sqlite3'
+
+# Read-only routes are spread across these databases (see replicas.ReplicaRouter). Empty list disables replicas.
+# WAL readers of the primary file: 'sqlite:///file:dbs/test_db.sqlite3?mode=ro&uri=true',
+# or snapshot files (all of them refreshed from REPLICA_SNAPSHOT_SOURCE): 'sqlite:///dbs/replica_0.sqlite3'
+REPLICA_DATABASE_URLS: List[str] = []
+# Path of the primary database file copied into snapshot replicas, None if replicas are WAL readers
+REPLICA_SNAPSHOT_SOURCE: Optional[str] = None
+REPLICA_SNAPSHOT_INTERVAL = 30.0
+# Seconds a client reads from the primary after its write (read-your-writes)
+READ_YOUR_WRITES_WINDOW = 5.0
+# Key signing the read-your-writes cookie: the FASTAPI_TEST_PIN_SECRET environment variable
+# or a random key kept in this file (shared by worker processes)
+READ_YOUR_WRITES_SECRET_PATH = 'dbs/pin_secret'
+
+# Storage of the core user and message routes: 'sqlalchemy' or 'memory' (crud.memory_storage.MemoryStorage,
+# other routes keep using the database)
+STORAGE_BACKEND = 'sqlalchemy'
+# Append-only log of the memory storage, None to keep data in memory only
+MEMORY_STORAGE_LOG_PATH: Optional[str] = None
+
 
+def read_your_writes_secret() -> bytes:
+    """
+    Returns the key signing the read-your-writes cookie, creates the key file on the first call
+    """
+    secret = os.environ.get('FASTAPI_TEST_PIN_SECRET')
+    if secret:
+        return secret.encode()
+    # The key is written into a temporary file and linked to the path, so other workers never read a partial key
+    temporary_path = f'{READ_YOUR_WRITES_SECRET_PATH}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as secret_file:
+        secret_file.write(secrets.token_bytes(32))
+    try:
+        os.link(temporary_path, READ_YOUR_WRITES_SECRET_PATH)
+    except FileExistsError:  # Created by another worker
+        pass
+    finally:
+        os.remove(temporary_path)
+    with open(READ_YOUR_WRITES_SECRET_PATH, 'rb') as secret_file:
+        return secret_file.read()
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={'check_same_thread': False})
+
+def current_database_url() -> str:
+    """
+    Returns url of the restored database if the database was restored, otherwise SQLALCHEMY_DATABASE_URL
+    """
+    try:
+        with open(DATABASE_URL_POINTER_PATH, encoding='utf-8') as pointer:
+            return pointer.read().strip() or SQLALCHEMY_DATABASE_URL
+    except FileNotFoundError:
+        return SQLALCHEMY_DATABASE_URL
+
+
+engine = create_engine(current_database_url(), connect_args={'check_same_thread': False})
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def swap_engine(new_engine: Engine) -> None:
+    """
+    Binds new sessions to the new engine and stores its url in DATABASE_URL_POINTER_PATH,
+    so the app opens it after a restart. Sessions opened before finish on the previous engine
+
+    :param new_engine: engine of the new database
+    """
+    global engine
+
+    temporary_path = DATABASE_URL_POINTER_PATH + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as pointer:
+        pointer.write(str(new_engine.url))
+        pointer.flush()
+        os.fsync(pointer.fileno())
+    os.replace(temporary_path, DATABASE_URL_POINTER_PATH)
+
+    previous_engine, engine = engine, new_engine
+    SessionLocal.configure(bind=new_engine)
+    previous_engine.dispose()
+
 Base = declarative_base()
+
+
+def _add_missing_columns(bind: Engine, table) -> None:
+    existing_columns = {column['name'] for column in inspect(bind).get_columns(table.name)}
+    with bind.begin() as connection:
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}'
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f' DEFAULT {default.text}' if hasattr(default, 'text') else f" DEFAULT '{default}'"
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            connection.exec_driver_sql(ddl)
+
+
+def _enable_autoincrement(bind: Engine, table) -> None:
+    # sqlite can't add AUTOINCREMENT to an existing table: the table is copied into a new one (ids are kept)
+    with bind.begin() as connection:
+        table_sql = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+        ).scalar()
+        if 'AUTOINCREMENT' in table_sql.upper():
+            return
+        new_name = f'{table.name}_autoincrement'
+        create_sql = str(CreateTable(table).compile(dialect=bind.dialect)) \
+            .replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {new_name} ', 1)
+        columns = ', '.join(column.name for column in table.columns)
+        connection.exec_driver_sql(create_sql)
+        connection.exec_driver_sql(f'INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}')
+        connection.exec_driver_sql(f'DROP TABLE {table.name}')
+        connection.exec_driver_sql(f'ALTER TABLE {new_name} RENAME TO {table.name}')
+
+
+def init_db(bind: Engine) -> Set[str]:
+    """
+    Creates missing tables, columns and indexes of the models
+    (create_all doesn't change existing tables).
+    A column added to an existing table must be nullable or have a server_default,
+    an existing table of a model with sqlite_autoincrement is rebuilt once
+
+    :param bind: engine of the database
+    :return: names of created tables
+    """
+    existing_tables = set(inspect(bind).get_table_names())
+    Base.metadata.create_all(bind=bind)
+
+    for table in Base.metadata.sorted_tables:
+        if table.name in existing_tables:
+            _add_missing_columns(bind, table)
+            if table.dialect_options['sqlite']['autoincrement']:
+                _enable_autoincrement(bind, table)
+            for index in table.indexes:
+                index.create(bind=bind, checkfirst=True)
+
+    return set(Base.metadata.tables) - existing_tables
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import models
+from crud import idempotency_crud
+
+
+IDEMPOTENCY_KEY_HEADER = 'idempotency-key'
+MAX_KEY_LENGTH = 255
+
+
+class DatabaseRecords:
+    """
+    Idempotency records in the database shared by worker processes (see idempotency_crud)
+
+    :param session_factory: creates sessions of the database
+    """
+
+    def __init__(self, session_factory: Callable[[], Session]):
+        self.session_factory = session_factory
+
+    def claim(self, key: str, fingerprint: bytes, pending_ttl: int, now: int) -> Optional[models.IdempotencyRecord]:
+        with self.session_factory() as db:
+            record = idempotency_crud.claim_key(db, key, fingerprint, pending_ttl, now)
+            if record is not None:
+                db.expunge(record)
+            return record
+
+    def complete(self, key: str, status_code: int, content_type: Optional[str], body: bytes, ttl: int, now: int) \
+            -> None:
+        with self.session_factory() as db:
+            idempotency_crud.complete_key(db, key, status_code, content_type, body, ttl, now)
+
+    def renew(self, key: str, pending_ttl: int, now: int) -> None:
+        with self.session_factory() as db:
+            idempotency_crud.renew_key(db, key, pending_ttl, now)
+
+    def release(self, key: str) -> None:
+        with self.session_factory() as db:
+            idempotency_crud.release_key(db, key)
+
+    def purge(self, now: int) -> None:
+        with self.session_factory() as db:
+            idempotency_crud.purge_expired_keys(db, now)
+
+
+class InProcessRecords:
+    """
+    Idempotency records of one process, for apps without a database (e.g. with the memory storage).
+    Records are transient IdempotencyRecord objects, the same rules as of idempotency_crud apply
+    """
+
+    def __init__(self):
+        self._records: Dict[str, models.IdempotencyRecord] = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, fingerprint: bytes, pending_ttl: int, now: int) -> Optional[models.IdempotencyRecord]:
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record.expires_at > now:
+                return record
+            self._records[key] = models.IdempotencyRecord(key=key, fingerprint=fingerprint,
+                                                          expires_at=now + pending_ttl)
+            return None
+
+    def complete(self, key: str, status_code: int, content_type: Optional[str], body: bytes, ttl: int, now: int) \
+            -> None:
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                record.status_code, record.content_type, record.body = status_code, content_type, body
+                record.expires_at = now + ttl
+
+    def renew(self, key: str, pending_ttl: int, now: int) -> None:
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record.status_code is None:
+                record.expires_at = now + pending_ttl
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record.status_code is None:
+                del self._records[key]
+
+    def purge(self, now: int) -> None:
+        with self._lock:
+            self._records = {key: record for key, record in self._records.items() if record.expires_at > now}
+
+
+class IdempotencyMiddleware:
+    """
+    Executes POST requests with the same "Idempotency-Key" header once: the response is stored for ttl seconds
+    and replayed to retries without running validation or inserts again (with the "Idempotent-Replayed" header).
+    Keys are scoped by the client ("X-Client-Id" header or address), the method and the path.
+    Concurrent duplicates wait for the first request in the worker, a duplicate processed by another worker
+    gets 409 while the first request runs, a key reused with another body gets 422.
+    Responses with 5xx status codes are not stored
+
+    Example::
+
+        app.add_middleware(IdempotencyMiddleware, session_factory=SessionLocal, paths=['/users/'])
+
+    :param app: wrapped application
+    :param session_factory: creates sessions to store responses, None to keep them in the process (InProcessRecords)
+    :param paths: paths of POST routes supporting idempotency keys
+    :param ttl: seconds a response is stored
+    :param pending_ttl: seconds a key stays locked by an unfinished request after its last renewal
+        (the lock is renewed while the request runs, so only a crashed worker loses it)
+    :param max_body_size: responses with a greater body are not stored
+    :param purge_every: expired records are purged once per that count of claimed keys
+    :param renew_interval: seconds between renewals of a pending key, pending_ttl / 3 if None
+    :param clock: returns the current unix time
+    """
+
+    def __init__(self,
+                 app: ASGIApp,
+                 session_factory: Optional[Callable[[], Session]],
+                 paths: Iterable[str] = ('/users/', '/messages/', '/messages/broadcast'),
+                 ttl: int = 24 * 3600,
+                 pending_ttl: int = 60,
+                 max_body_size: int = 64 * 1024,
+                 purge_every: int = 256,
+                 renew_interval: Optional[float] = None,
+                 clock: Callable[[], float] = time.time):
+        self.app = app
+        self.records = DatabaseRecords(session_factory) if session_factory is not None else InProcessRecords()
+        self.paths = frozenset(paths)
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.max_body_size = max_body_size
+        self.purge_every = purge_every
+        self.renew_interval = renew_interval if renew_interval is not None else pending_ttl / 3
+        self.clock = clock
+
+        self._locks: Dict[str, list] = {}
+        self._claims = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        idempotency_key = Headers(scope=scope).get(IDEMPOTENCY_KEY_HEADER)
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            response = JSONResponse(status_code=400,
+                                    content={'message': f'Idempotency-Key is longer than {MAX_KEY_LENGTH}'})
+            await response(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        key = self._scoped_key(scope, idempotency_key)
+        fingerprint = hashlib.blake2b(body, digest_size=16).digest()
+
+        async with self._lock(key):
+            record = await run_in_threadpool(self._claim, key, fingerprint)
+            if record is None:
+                await self._execute(key, body, scope, receive, send)
+            else:
+                await self._replay(record, fingerprint, scope, receive, send)
+
+    @staticmethod
+    def _scoped_key(scope: Scope, idempotency_key: str) -> str:
+        client_id = Headers(scope=scope).get('x-client-id') or (scope['client'][0] if scope.get('client') else '')
+        scoped_key = '\n'.join((client_id, scope['method'], scope['path'], idempotency_key))
+        return hashlib.blake2b(scoped_key.encode(), digest_size=16).hexdigest()
+
+    @asynccontextmanager
+    async def _lock(self, key: str):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    @staticmethod
+    async def _read_body(receive: Receive) -> bytes:
+        chunks: List[bytes] = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    # ---------
+    #  Records
+    # ---------
+    def _claim(self, key: str, fingerprint: bytes) -> Optional[models.IdempotencyRecord]:
+        self._claims += 1
+        if self._claims % self.purge_every == 0:
+            self.records.purge(int(self.clock()))
+        return self.records.claim(key, fingerprint, self.pending_ttl, int(self.clock()))
+
+    def _complete(self, key: str, status_code: int, content_type: Optional[str], body: bytes) -> None:
+        self.records.complete(key, status_code, content_type, body, self.ttl, int(self.clock()))
+
+    def _release(self, key: str) -> None:
+        self.records.release(key)
+
+    def _renew(self, key: str) -> None:
+        self.records.renew(key, self.pending_ttl, int(self.clock()))
+
+    async def _keep_claimed(self, key: str) -> None:
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                await run_in_threadpool(self._renew, key)
+            except Exception as e:
+                print(e)
+
+    # -----------
+    #  Responses
+    # -----------
+    async def _execute(self, key: str, body: bytes, scope: Scope, receive: Receive, send: Send) -> None:
+        body_sent = False
+        response_start: Dict[str, Message] = {}
+        response_body: List[bytes] = []
+
+        async def replay_receive() -> Message:
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def capture_send(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                response_start['message'] = message
+            elif message['type'] == 'http.response.body':
+                response_body.append(message.get('body', b''))
+            await send(message)
+
+        renewal = asyncio.ensure_future(self._keep_claimed(key))
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await run_in_threadpool(self._release, key)
+            raise
+        finally:
+            renewal.cancel()
+
+        status_code = response_start['message']['status'] if response_start else 500
+        stored_body = b''.join(response_body)
+        if status_code >= 500 or len(stored_body) > self.max_body_size:
+            await run_in_threadpool(self._release, key)
+            return
+
+        content_type = Headers(raw=response_start['message'].get('headers', [])).get('content-type')
+        await run_in_threadpool(self._complete, key, status_code, content_type, stored_body)
+
+    async def _replay(self,
+                      record: models.IdempotencyRecord,
+                      fingerprint: bytes,
+                      scope: Scope,
+                      receive: Receive,
+                      send: Send) -> None:
+        if record.fingerprint != fingerprint:
+            response = JSONResponse(status_code=422,
+                                    content={'message': 'Idempotency-Key is already used with another request'})
+        elif record.status_code is None:
+            response = JSONResponse(status_code=409,
+                                    content={'message': 'request with that Idempotency-Key is in progress'},
+                                    headers={'Retry-After': '1'})
+        else:
+            response = Response(content=record.body, status_code=record.status_code,
+                                media_type=record.content_type, headers={'Idempotent-Replayed': 'true'})
+        await response(scope, receive, send)
@@ -1,24 +1,292 @@
-from typing import List, Optional, Union, Dict, Callable, Generator, Any
+import hmac
+import os
+from typing import IO, List, Optional, Union, Dict, Callable, Generator, Any, AsyncGenerator
 
 from fastapi.responses import JSONResponse
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, status, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import ValidationError
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.orm import Session
 import uvicorn
 
+import backup
+import database
 import models
-from crud import user_crud, message_crud
+from admission import AdmissionController, Overloaded, Priority
+from crud import user_crud, message_crud, search_crud, archive_crud
+from crud.memory_storage import MemoryStorage
+from crud.statement_cache import statement_cache_stats
+from crud.storage import SQLAlchemyStorage, Storage
 # from schemas import Message, User
 import schemas
 
 
-from database import SessionLocal, engine
+from database import SessionLocal, init_db, SHARD_DATABASE_URLS, DIRECTORY_DATABASE_URL, \
+    REPLICA_DATABASE_URLS, REPLICA_SNAPSHOT_SOURCE, REPLICA_SNAPSHOT_INTERVAL, READ_YOUR_WRITES_WINDOW, \
+    STORAGE_BACKEND, MEMORY_STORAGE_LOG_PATH
+from compression import CompressionMiddleware
+from idempotency import IdempotencyMiddleware
+from message_archiver import MessageArchiver
+from pubsub import InboxNotifier, MessageHub, message_stream
+from rate_limit import InProcessBuckets, Limit, RateLimitMiddleware
+from replicas import ReplicaRouter, WritePin, enable_wal
+from sharding import ShardedStorage, ShardRouter
+from user_reaper import UserReaper
+from warmup import AccessSketch, ProfileCache, prebuild_schemas, prime_os_page_cache
+from write_batcher import MessageWriteBatcher
 
 
-models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
 
+# Storage of users and messages of the core routes, the database is used if it is None
+memory_storage: Optional[MemoryStorage] = None
+if STORAGE_BACKEND == 'memory':
+    memory_storage = MemoryStorage(log_path=MEMORY_STORAGE_LOG_PATH)
+
+# Replays responses of POST /users/, /messages/ and /messages/broadcast retried with the same Idempotency-Key
+# (responses are kept in the process with the memory storage)
+app.add_middleware(IdempotencyMiddleware, session_factory=SessionLocal if memory_storage is None else None,
+                   ttl=24 * 3600, pending_ttl=60)
+
+# Token buckets of routes and of client addresses.
+# Use SharedMemoryBuckets('fastapi_test_rate_limit', 'dbs/rate_limit.lock') to share limits between worker processes
+rate_limit_buckets = InProcessBuckets()
+app.add_middleware(
+    RateLimitMiddleware,
+    route_limits={
+        'get_users': Limit(rate=1.0, burst=10),
+        'get_users_count': Limit(rate=5.0, burst=20),
+        'search_users': Limit(rate=10.0, burst=30),
+        'search_messages': Limit(rate=2.0, burst=10),
+        'post_user': Limit(rate=0.5, burst=5),
+        'broadcast_message': Limit(rate=0.2, burst=2),
+    },
+    client_limit=Limit(rate=50.0, burst=100),
+    backend=rate_limit_buckets
+)
+
+# Outermost: responses stored by the idempotency middleware stay uncompressed
+app.add_middleware(CompressionMiddleware, minimum_size=1024, level=6, cache_bytes=8 * 1024 * 1024,
+                   cache_max_body=256 * 1024)
+
+# Routes users and messages to shards if SHARD_DATABASE_URLS are set (see ShardedStorage)
+shard_router: Optional[ShardRouter] = None
+if SHARD_DATABASE_URLS and memory_storage is None:
+    shard_router = ShardRouter(SHARD_DATABASE_URLS, DIRECTORY_DATABASE_URL)
+
+
+def init_database(bind: Engine) -> None:
+    """
+    Creates missing tables and indexes, fills unread counters of a new counters table and full-text indexes
+
+    :param bind: engine of the database
+    """
+    created_tables = init_db(bind)
+    if models.UnreadCounter.__tablename__ in created_tables:
+        with SessionLocal(bind=bind) as _db:
+            message_crud.rebuild_unread_counters(_db)
+    if models.UserStats.__tablename__ in created_tables:
+        with SessionLocal(bind=bind) as _db:
+            message_crud.rebuild_user_stats(_db)
+    with SessionLocal(bind=bind) as _db:
+        archive_crud.init_message_id_sequence(_db)
+    search_crud.init_message_fts(bind)
+    search_crud.init_users_fts(bind)
+
+
+# Held while the app runs, so the command line restore refuses (see backup.restore_offline)
+app_lock: Optional[IO] = None
+
+
+@app.on_event('startup')
+def start_database():
+    global app_lock
+    if memory_storage is not None:  # The memory storage doesn't use the database
+        return
+    # Waits for a running command line restore and opens the database it has restored
+    app_lock = backup.hold_app_lock()
+    if database.current_database_url() != str(database.engine.url):
+        database.swap_engine(create_engine(database.current_database_url(), connect_args={'check_same_thread': False}))
+
+    # The database is not touched at import, so tests can bind SessionLocal to another engine
+    init_database(database.engine)
+    if shard_router is not None:
+        shard_router.init_db()
+
+
+@app.on_event('shutdown')
+def stop_database():
+    if app_lock is not None:
+        app_lock.close()
+
+# Routes read-only requests to replicas if REPLICA_DATABASE_URLS are set
+replica_router: Optional[ReplicaRouter] = None
+if REPLICA_DATABASE_URLS and memory_storage is None:
+    replica_router = ReplicaRouter(
+        REPLICA_DATABASE_URLS,
+        pin_window=READ_YOUR_WRITES_WINDOW,
+        primary_path=REPLICA_SNAPSHOT_SOURCE,
+        snapshot_interval=REPLICA_SNAPSHOT_INTERVAL,
+        secret=database.read_your_writes_secret()
+    )
+
+# Clients which have written something read from the primary and skip the profile cache for READ_YOUR_WRITES_WINDOW
+write_pin = replica_router.write_pin if replica_router is not None \
+    else WritePin(READ_YOUR_WRITES_WINDOW, database.read_your_writes_secret())
+
+
+@app.on_event('startup')
+def start_replica_router():
+    if replica_router is not None:
+        enable_wal(database.engine)
+        # Replicas are configured for SQLALCHEMY_DATABASE_URL, the database may be restored into another file
+        configured_path = make_url(database.SQLALCHEMY_DATABASE_URL).database
+        if database.engine.url.database != configured_path:
+            replica_router.repoint(configured_path, database.engine.url.database)
+        replica_router.start()
+
+
+@app.on_event('shutdown')
+def stop_replica_router():
+    if replica_router is not None:
+        replica_router.stop()
+
+
+# Counts hits of the compiled statement cache of all engines (GET /admin/statements/stats)
+statement_cache_stats.listen()
+
+admission_controller = AdmissionController(
+    max_concurrency=8,
+    max_queue=64,
+    queue_timeout=2.0,
+    retry_after=1,
+    route_limits={
+        'get_users': 4,
+        'post_user': 2,
+        'put_user': 2,
+        'delete_user': 2,
+    }
+)
+
+# Set None to commit each message separately (shards and the memory storage write messages themselves)
+message_write_batcher: Optional[MessageWriteBatcher] = MessageWriteBatcher(
+    SessionLocal,
+    max_batch=256,
+    max_delay=0.005,
+    max_wait=2.0,
+    synchronous='FULL'
+) if memory_storage is None and shard_router is None else None
+
+
+@app.on_event('startup')
+def start_message_write_batcher():
+    if message_write_batcher is not None:
+        message_write_batcher.start()
+
+
+@app.on_event('shutdown')
+def stop_message_write_batcher():
+    if message_write_batcher is not None:
+        message_write_batcher.stop()
+
+
+# Removes messages and rows of soft deleted users in the background (the memory storage removes them at once)
+user_reaper: Optional[UserReaper] = UserReaper(
+    SessionLocal,
+    batch_size=500,
+    interval=1.0,
+    shard_router=shard_router
+) if memory_storage is None else None
+
+
+@app.on_event('startup')
+def start_user_reaper():
+    if user_reaper is not None:
+        user_reaper.start()
+
+
+@app.on_event('shutdown')
+def stop_user_reaper():
+    if user_reaper is not None:
+        user_reaper.stop()
+
+
+# Move read messages older than max_age seconds into the compressed archive (one archiver per shard,
+# none with the memory storage)
+message_archivers = [
+    MessageArchiver(session_factory, max_age=30 * 24 * 3600, batch_size=1000, interval=60.0)
+    for session_factory in (shard_router.sessions if shard_router is not None else [SessionLocal])
+] if memory_storage is None else []
+
+
+@app.on_event('startup')
+def start_message_archivers():
+    for message_archiver in message_archivers:
+        message_archiver.start()
+
+
+@app.on_event('shutdown')
+def stop_message_archivers():
+    for message_archiver in message_archivers:
+        message_archiver.stop()
+
+
+# Feeds WebSocket and SSE subscribers with committed messages
+message_hub = MessageHub(queue_size=256, peer_dir='dbs/hub')
+message_crud.committed_listeners.append(message_hub.publish)
+
+# Wakes up long-polling inbox requests
+inbox_notifier = InboxNotifier()
+message_hub.add_listener(inbox_notifier.notify)
+
+INBOX_WAIT_MAX_TIMEOUT = 60.0
+
+
+@app.on_event('startup')
+async def start_message_hub():
+    await message_hub.start()
+
+
+@app.on_event('shutdown')
+async def stop_message_hub():
+    await message_hub.stop()
+
+
+# Reads of GET /users/(user identifier) counted by user id, saved for the warmup of the next start
+access_sketch = AccessSketch('dbs/access_sketch.json', width=4096, depth=4, top_n=1000, save_interval=60.0)
+
+# Profiles of GET /users/(user identifier), invalidated on writes to the user and its messages
+profile_cache = ProfileCache(max_size=10000, ttl=30.0)
+message_crud.committed_listeners.append(profile_cache.invalidate_messages)
+message_hub.add_listener(profile_cache.invalidate_messages)
+
+WARMUP_TOP_USERS = 1000
+
+
+@app.on_event('startup')
+def warm_up():
+    # Startup events are finished before the server accepts connections
+    if memory_storage is None:
+        prime_os_page_cache(database.engine, max_bytes=64 * 1024 * 1024)
+    prebuild_schemas(app)
+
+    with Dependencies._SessionContextManager() as _db:
+        storage = Dependencies.open_storage(_db)
+        for user_id in access_sketch.top(WARMUP_TOP_USERS):
+            try:
+                profile_cache.put(user_id, storage.get_user(user_id))
+            except ValueError:  # The user is deleted
+                continue
+    access_sketch.start()
+
+
+@app.on_event('shutdown')
+def stop_access_sketch():
+    access_sketch.stop()
+
 
 class Dependencies:
     """
@@ -33,8 +301,9 @@ class Dependencies:
         user_identifier = "user_identifier"
 
     class _SessionContextManager:
-        def __init__(self, session: Session = SessionLocal()):
-            self.session = session
+        def __init__(self, session: Optional[Session] = None):
+            # A new session every time (a default argument would be one session shared by all requests)
+            self.session = session if session is not None else SessionLocal()
 
         def __enter__(self):
             return self.session
@@ -51,22 +320,155 @@ class Dependencies:
         with cls._SessionContextManager() as db:
             yield db
 
+    @classmethod
+    def single_database(cls) -> None:
+        """
+        Dependency of routes querying the whole SQL database at once,
+        they are not available with shards or with the memory storage
+
+        :except HTTPException: 501 (sharding or the memory storage is enabled)
+        """
+        if shard_router is not None or memory_storage is not None:
+            raise HTTPException(
+                status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                detail={'message': 'the route is not available with sharding or the memory storage'}
+            )
+
+    @classmethod
+    def require_admin(cls, x_admin_token: Optional[str] = Header(None)) -> None:
+        """
+        Dependency of admin routes: the X-Admin-Token header must match database.ADMIN_TOKEN
+
+        :except HTTPException: 403 (the token is not set or doesn't match)
+        """
+        if not database.ADMIN_TOKEN or x_admin_token is None \
+                or not hmac.compare_digest(x_admin_token.encode(), database.ADMIN_TOKEN.encode()):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail={'message': 'admin token is required'}
+            )
+
+    @classmethod
+    def messages_loader(cls, user_id: int) -> Callable[[int, int], List[schemas.Message.Get]]:
+        """
+        Returns a function loading messages of the user after an id from its storage (see pubsub.message_stream)
+        """
+
+        def load_after(after_id: int, limit: int) -> List[schemas.Message.Get]:
+            with cls._SessionContextManager() as db:
+                return cls.open_storage(db).get_messages_after(user_id, after_id, limit)
+
+        return load_after
+
+    @classmethod
+    def open_storage(cls, db: Session) -> Storage:
+        """
+        Returns the storage of the core routes working with the session
+        (the session is unused by the memory storage and by shards, they open sessions themselves)
+        """
+        if memory_storage is not None:
+            return memory_storage
+        if shard_router is not None:
+            return ShardedStorage(shard_router)
+        return SQLAlchemyStorage(db)
+
+    @classmethod
+    def storage(cls, get_session: Callable[..., Generator[Session, Any, None]]) -> Callable[[Session], Storage]:
+        """
+        Returns a dependency which opens the storage with a session of the get_session dependency
+
+        Example of use::
+
+            storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))
+
+        :param get_session: dependency returning a session (get_db or get_read_db)
+        :return: dependency returning a storage
+        """
+
+        def _storage(db: Session = Depends(get_session)) -> Storage:
+            return cls.open_storage(db)
+
+        return _storage
+
+    @classmethod
+    def get_read_db(cls, request: Request) -> Generator[Session, Any, None]:
+        """
+        The generator returning a session of a replica for read-only routes
+        (of the primary if there are no replicas or the client has written recently)
+        """
+        session = None
+        if replica_router is not None:
+            session = replica_router.read_session(request.cookies.get(ReplicaRouter.PIN_COOKIE))
+
+        with cls._SessionContextManager(session) as db:
+            yield db
+
+    @classmethod
+    def pin_to_primary(cls, response: Response) -> None:
+        """
+        Dependency of write routes: the client reads from the primary and skips the profile cache
+        for READ_YOUR_WRITES_WINDOW seconds. The time of the write is sent to the client in a cookie,
+        so the pin doesn't depend on the worker process
+        """
+        response.set_cookie(WritePin.COOKIE, write_pin.pin(), max_age=write_pin.pin_max_age(),
+                            httponly=True, samesite='lax')
+
+    @classmethod
+    def admit(cls, route: str, priority: Priority = Priority.NORMAL) -> Callable[[], AsyncGenerator[None, None]]:
+        """
+        Returns a dependency which holds a slot of the admission controller while a request is processed
+
+        Example of use::
+
+            @app.get('/some/', dependencies=[Depends(Dependencies.admit('some', Priority.HIGH))])
+
+        :param route: name of the route to count its limits and statistics
+        :param priority: requests with a higher priority leave the queue first
+        :return: async generator dependency
+        :except HTTPException: 503 (request is shed by the admission controller)
+        """
+
+        async def _admit():
+            try:
+                await admission_controller.acquire(route, priority)
+            except Overloaded as e:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail={'message': str(e)},
+                    headers={'Retry-After': str(e.retry_after)}
+                )
+            try:
+                yield
+            finally:
+                admission_controller.release(route)
+
+        return _admit
+
     @classmethod
     def try_to_get_user_id(cls, user_identifier: Union[int, str]) -> int:
         """
         Tries to return the user_id found by user_identifier, which is user_id or user_nick_name\n
         Otherwise raises a error
 
+        :param user_identifier: union[user_id: int, user_nick_name: string]
+        :return: found user_id
+        :except HTTPException: 404 (user is not found)
+        """
+        with cls._SessionContextManager() as _db:
+            return cls.find_user_id(cls.open_storage(_db), user_identifier)
+
+    @classmethod
+    def find_user_id(cls, storage: Storage, user_identifier: Union[int, str]) -> int:
+        """
+        Returns the user_id found by user_identifier in the storage (read routes pass the storage of their replica)
+
+        :param storage: storage to search in
         :param user_identifier: union[user_id: int, user_nick_name: string]
         :return: found user_id
         :except HTTPException: 404 (user is not found)
         """
         try:
-            with cls._SessionContextManager() as _db:
-                user = user_crud.get_user(_db, user_identifier) \
-                    if type(user_identifier) is int \
-                    else user_crud.get_user_by_nik_name(_db, user_identifier)
-                return user.id
+            return storage.get_user_id(user_identifier)
         except ValueError as e:  # User is not found exception
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -75,21 +477,21 @@ class Dependencies:
 
     @classmethod
     def complete_user_edit(cls, new_user_data: Union[schemas.User.Edit, dict]) -> \
-            Callable[[models.User], schemas.User.Edit]:
+            Callable[[schemas.User.Get], schemas.User.Edit]:
         """
         Returns a function that returns UserEdit independent of a value and both possible taken new_user_data types \n
         ____
 
         Example of use::
 
-            fun: Callable[[models.User], schemas.UserEdit]
+            fun: Callable[[schemas.User.Get], schemas.UserEdit]
             some_user_data: Union[schemas.UserEdit, dict] = {}
             fun = Depends(Dependencies.complete_user_edit(some_user_data))
 
         :param new_user_data: is a schema of UserEdit or dict with incomplete data of UserEdit
-        :return: fun(user: models.User) -> schemas.UserEdit
+        :return: fun(user: schemas.User.Get) -> schemas.UserEdit
         :except HTTPException: [raises form the returned function] occurs if passed
-            argument (user: models.User or new_user_data: as dict [from "parent" function]) will contain some
+            argument (user: schemas.User.Get or new_user_data: as dict [from "parent" function]) will contain some
             unacceptable to validate data
         """
         cls._new_user_data = new_user_data
@@ -107,7 +509,7 @@ class Dependencies:
 
             return new_data
 
-        def wrapper(user: models.User) -> schemas.User.Edit:
+        def wrapper(user: schemas.User.Get) -> schemas.User.Edit:
             try:
                 if cls._new_user_data.__class__ is dict:
                     return schemas.User.Edit(**_complete_user_edit(cls._new_user_data, user))
@@ -128,31 +530,130 @@ def root():
     return {'Main Page': True}
 
 
-@app.get('/users/', response_model=List[schemas.User.Get], status_code=status.HTTP_200_OK)
-def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(Dependencies.get_db)):
-    users = user_crud.get_users(db, skip, limit)
+@app.get('/admission/stats', response_model=dict)
+def get_admission_stats():
+    return admission_controller.stats()
+
+
+@app.get('/admin/statements/stats', response_model=dict, dependencies=[Depends(Dependencies.require_admin)])
+def get_statement_cache_stats():
+    return statement_cache_stats.stats()
+
+
+@app.get('/admin/profiles/stats', response_model=dict, dependencies=[Depends(Dependencies.require_admin)])
+def get_profile_cache_stats():
+    return {**profile_cache.stats(), 'top_users': access_sketch.top(10)}
+
+
+@app.post('/admin/snapshot',
+          response_model=dict,
+          status_code=status.HTTP_201_CREATED,
+          dependencies=[Depends(Dependencies.require_admin)])
+def post_snapshot():
+    return backup.snapshot(
+        database.engine,
+        backup.snapshot_path(),
+        pages=database.BACKUP_PAGES_PER_STEP,
+        pause=database.BACKUP_STEP_PAUSE
+    )
+
+
+@app.post('/admin/restore', response_model=dict, dependencies=[Depends(Dependencies.require_admin)])
+def post_restore(snapshot: str):
+    previous_path = database.engine.url.database
+    # Only snapshots of the backup directory can be restored
+    try:
+        result = backup.restore_online(os.path.join(database.BACKUP_DIR, os.path.basename(snapshot)),
+                                       app_lock,
+                                       prepare=init_database,
+                                       pages=database.BACKUP_PAGES_PER_STEP)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={'message': str(e)}
+        )
+    except RuntimeError as e:  # Other workers would keep the previous database
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={'message': str(e)}
+        )
+    if replica_router is not None:
+        enable_wal(database.engine)
+        replica_router.repoint(previous_path, database.engine.url.database)
+    search_crud.typeahead_cache.clear()
+    profile_cache.clear()
+    return result
+
+
+@app.get('/users/',
+         response_model=List[schemas.User.Get],
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_users', Priority.NORMAL))])
+def get_users(
+        skip: int = 0,
+        limit: int = 100,
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))
+):
+    users = storage.get_users(skip, limit)
     return users
 
 
-@app.get('/users/count', response_model=Dict[str, int], status_code=status.HTTP_200_OK)
-def get_users_count(db: Session = Depends(Dependencies.get_db)):
-    return {'Count of users': user_crud.get_users_count(db)}
+@app.get('/users/count',
+         response_model=Dict[str, int],
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_users_count', Priority.HIGH))])
+def get_users_count(storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))):
+    return {'Count of users': storage.get_users_count()}
+
+
+@app.get('/users/search',
+         response_model=List[schemas.UserBrief.Get],
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('search_users', Priority.HIGH)), Depends(Dependencies.single_database)])
+def search_users(q: str, fuzzy: bool = False, limit: int = 10, db: Session = Depends(Dependencies.get_db)):
+    return search_crud.search_users(db, q, fuzzy, min(max(limit, 1), 50))
 
 
 @app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}',
          response_model=schemas.User.Get,
-         status_code=status.HTTP_200_OK)
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_user', Priority.HIGH))])
 def get_user(
-        user_id: int = Depends(Dependencies.try_to_get_user_id),
-        db: Session = Depends(Dependencies.get_db)
+        request: Request,
+        user_identifier: Union[int, str],
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))
 ):
-    return user_crud.get_user(db, user_id)
-
-
-@app.post('/users/', response_model=schemas.User.Get, status_code=status.HTTP_201_CREATED)
-def post_user(user_data: schemas.User.Create, db: Session = Depends(Dependencies.get_db)):
+    user_id = Dependencies.find_user_id(storage, user_identifier)
+    access_sketch.record(user_id)
+    # The write of a pinned client may be served by another worker, which doesn't invalidate this cache
+    pinned = write_pin.is_pinned(request.cookies.get(WritePin.COOKIE))
+    profile = profile_cache.get(user_id) if not pinned else None
+    if profile is not None:
+        return profile
+
+    # Taken before the load, so a profile loaded before an invalidation is not put back
+    version = profile_cache.version()
+    try:
+        profile = storage.get_user(user_id)
+    except ValueError as e:  # The user is not on a snapshot replica yet
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={'message': str(e)}
+        )
+    # Profiles of replicas may be older than the last invalidation, only profiles of the primary are cached
+    if replica_router is None or pinned:
+        profile_cache.put(user_id, profile, version)
+    return profile
+
+
+@app.post('/users/',
+          response_model=schemas.User.Get,
+          status_code=status.HTTP_201_CREATED,
+          dependencies=[Depends(Dependencies.admit('post_user', Priority.LOW)),
+                        Depends(Dependencies.pin_to_primary)])
+def post_user(user_data: schemas.User.Create, storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))):
     try:
-        return user_crud.post_user(db, user_data=user_data)
+        return storage.post_user(user_data)
     except ValueError as e:
         return JSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -164,25 +665,266 @@ def post_user(user_data: schemas.User.Create, db: Session = Depends(Dependencies
 
 @app.put('/users/{' + Dependencies.RoutingConstants.user_identifier + '}',
          response_model=schemas.User.Get,
-         status_code=status.HTTP_200_OK)
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('put_user', Priority.LOW)),
+                       Depends(Dependencies.pin_to_primary)])
 def put_user(
         user_id: int = Depends(Dependencies.try_to_get_user_id),
-        fun_complete_user_edit: Callable[[models.User], schemas.User.Edit] = Depends(Dependencies.complete_user_edit),
-        db: Session = Depends(Dependencies.get_db)
+        fun_complete_user_edit: Callable[[schemas.User.Get], schemas.User.Edit] =
+        Depends(Dependencies.complete_user_edit),
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))
 ):
     # Try to update user
-    user = user_crud.get_user(db, user_id)
+    user = storage.get_user(user_id)
     new_user_data = fun_complete_user_edit(user)
-    return user_crud.put_user(db, user=user, new_user_data=new_user_data)
+    try:
+        user = storage.put_user(user_id, new_user_data)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={
+                'message': str(e)
+            }
+        )
+    profile_cache.invalidate([user_id])
+    return user
 
 
-@app.delete('/users/{user_identifier}', response_model=schemas.User.Get, status_code=status.HTTP_200_OK)
+@app.delete('/users/{user_identifier}',
+            response_model=schemas.UserBrief.Get,
+            status_code=status.HTTP_200_OK,
+            dependencies=[Depends(Dependencies.admit('delete_user', Priority.LOW)),
+                          Depends(Dependencies.pin_to_primary)])
 def delete_user(
         user_id: int = Depends(Dependencies.try_to_get_user_id),
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))
+):
+    deleted_user = storage.del_user(user_id)
+    profile_cache.invalidate([user_id])
+    if user_reaper is not None:
+        user_reaper.wake()
+    return deleted_user
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/unread',
+         response_model=dict,
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_unread', Priority.HIGH))])
+def get_unread(
+        user_id: int = Depends(Dependencies.try_to_get_user_id),
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))
+):
+    senders = storage.get_unread_counts(user_id)
+    return {'Count of unread messages': sum(senders.values()), 'Senders': senders}
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/stats',
+         response_model=schemas.UserStats.Get,
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_user_stats', Priority.HIGH))])
+def get_user_stats(
+        user_identifier: Union[int, str],
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))
+):
+    user_id = Dependencies.find_user_id(storage, user_identifier)
+    return storage.get_user_stats(user_id)
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/messages',
+         response_model=schemas.UserMessages.Get,
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_user_messages', Priority.NORMAL))])
+def get_user_messages(
+        user_identifier: Union[int, str],
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_read_db))
+):
+    user_id = Dependencies.find_user_id(storage, user_identifier)
+    try:
+        return storage.get_user_messages(user_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={'message': str(e)}
+        )
+
+
+@app.put('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/messages/read',
+         response_model=Dict[str, int],
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('mark_messages_read', Priority.LOW)),
+                       Depends(Dependencies.pin_to_primary)])
+def mark_messages_read(
+        sender_id: int,
+        up_to_id: int,
+        user_id: int = Depends(Dependencies.try_to_get_user_id),
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))
+):
+    marked = storage.mark_messages_read(user_id, sender_id, up_to_id)
+    if marked:
+        profile_cache.invalidate([user_id, sender_id])
+    return {'Count of read messages': marked}
+
+
+@app.post('/messages/',
+          response_model=schemas.Message.Get,
+          status_code=status.HTTP_201_CREATED,
+          dependencies=[Depends(Dependencies.admit('post_message', Priority.LOW)),
+                        Depends(Dependencies.pin_to_primary)])
+async def post_message(message_data: schemas.Message.Create):
+    try:
+        if message_write_batcher is not None:
+            return await message_write_batcher.send_async(message_data)
+        with Dependencies._SessionContextManager() as db:
+            return await run_in_threadpool(Dependencies.open_storage(db).post_message, message_data)
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={'message': str(e)},
+            headers={'Retry-After': str(e.retry_after)}
+        )
+    except TimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail={'message': str(e)})
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={
+                'message': str(e)
+            }
+        )
+
+
+@app.get('/messages/search',
+         response_model=schemas.MessageSearch.Get,
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('search_messages', Priority.NORMAL)),
+                       Depends(Dependencies.single_database)])
+def search_messages(
+        q: str,
+        receiver_id: Optional[int] = None,
+        prefix: bool = True,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        db: Session = Depends(Dependencies.get_db)
+):
+    try:
+        messages, next_cursor = search_crud.search_messages(db, q, receiver_id, prefix, min(max(limit, 1), 100), cursor)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={
+                'message': str(e)
+            }
+        )
+    return schemas.MessageSearch.Get(messages=messages, next_cursor=next_cursor or '')
+
+
+@app.post('/messages/broadcast',
+          response_model=schemas.Broadcast.Get,
+          status_code=status.HTTP_201_CREATED,
+          dependencies=[Depends(Dependencies.admit('broadcast_message', Priority.LOW)),
+                        Depends(Dependencies.single_database),
+                        Depends(Dependencies.pin_to_primary)])
+def broadcast_message(
+        broadcast_data: schemas.Broadcast.Create,
+        to_all: bool = False,
+        receiver_status: Optional[int] = None,
         db: Session = Depends(Dependencies.get_db)
 ):
-    user_to_del = user_crud.get_user(db, user_id)
-    user_crud.del_user(db, user_to_del)
+    try:
+        return message_crud.broadcast_message(db, broadcast_data, to_all=to_all, receiver_status=receiver_status)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={
+                'message': str(e)
+            }
+        )
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/inbox',
+         response_model=List[schemas.Message.Get],
+         status_code=status.HTTP_200_OK,
+         dependencies=[Depends(Dependencies.admit('get_inbox', Priority.NORMAL))])
+def get_inbox(
+        before: Optional[int] = None,
+        limit: int = 50,
+        user_id: int = Depends(Dependencies.try_to_get_user_id),
+        storage: Storage = Depends(Dependencies.storage(Dependencies.get_db))
+):
+    return storage.get_inbox(user_id, before, min(max(limit, 1), 100))
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/inbox/wait',
+         response_model=List[schemas.Message.Get],
+         status_code=status.HTTP_200_OK)
+async def wait_inbox(
+        after: int = 0,
+        timeout: float = 30.0,
+        user_id: int = Depends(Dependencies.try_to_get_user_id)
+):
+    """
+    Long polling: returns messages of the user with ids greater than "after" as soon as there are some,
+    or an empty list after the timeout (seconds, at most INBOX_WAIT_MAX_TIMEOUT)
+    """
+
+    load_after = Dependencies.messages_loader(user_id)
+    return await inbox_notifier.wait(
+        user_id,
+        after,
+        min(max(timeout, 0.0), INBOX_WAIT_MAX_TIMEOUT),
+        lambda: run_in_threadpool(load_after, after, 100)
+    )
+
+
+@app.websocket('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/messages/ws')
+async def messages_websocket(websocket: WebSocket, user_identifier: Union[int, str], after: Optional[int] = None):
+    """
+    Sends {"event": "message", "data": <message>} for every new message of the user
+    (and for stored messages with ids greater than "after") and {"event": "keepalive"} while there are none
+    """
+    try:
+        user_id = await run_in_threadpool(Dependencies.try_to_get_user_id, user_identifier)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    stream = message_stream(message_hub, Dependencies.messages_loader(user_id), user_id, after)
+    try:
+        async for message in stream:
+            if message is None:
+                await websocket.send_json({'event': 'keepalive'})
+            else:
+                await websocket.send_json({'event': 'message', 'data': message.dict()})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await stream.aclose()
+
+
+@app.get('/users/{' + Dependencies.RoutingConstants.user_identifier + '}/messages/events')
+async def messages_events(
+        after: Optional[int] = None,
+        last_event_id: Optional[int] = Header(None),
+        user_id: int = Depends(Dependencies.try_to_get_user_id)
+):
+    """
+    Server-sent events fallback of the WebSocket: resumes after the "Last-Event-ID" header or the "after" parameter
+    """
+    after_id = last_event_id if last_event_id is not None else after
+
+    async def events():
+        stream = message_stream(message_hub, Dependencies.messages_loader(user_id), user_id, after_id)
+        try:
+            async for message in stream:
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield f'id: {message.id}\nevent: message\ndata: {message.json()}\n\n'
+        finally:
+            await stream.aclose()
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 if __name__ == '__main__':
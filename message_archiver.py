@@ -0,0 +1,76 @@
+import threading
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from crud import archive_crud
+
+
+class MessageArchiver:
+    """
+    Background thread moving old read messages into the compressed archive in batches
+    (one short transaction each), so the messages table and its indexes stay small
+
+    Example::
+
+        archiver = MessageArchiver(SessionLocal, max_age=30 * 24 * 3600, batch_size=1000, interval=60)
+        archiver.start()
+        ...
+        archiver.stop()
+
+    :param session_factory: creates sessions of the archiver
+    :param max_age: age in seconds of messages to archive
+    :param batch_size: max count of messages moved in one transaction
+    :param interval: seconds to sleep when there is nothing to archive
+    """
+
+    def __init__(self,
+                 session_factory: Callable[[], Session],
+                 max_age: int = 30 * 24 * 3600,
+                 batch_size: int = 1000,
+                 interval: float = 60.0):
+        self.session_factory = session_factory
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.archived_messages = 0
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='message-archiver', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def archive(self) -> int:
+        """
+        Archives one batch of messages
+
+        :return: count of archived messages
+        """
+        with self.session_factory() as db:
+            archived = archive_crud.archive_messages(db, self.max_age, self.batch_size)
+        self.archived_messages += archived
+        return archived
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                archived = self.archive()
+            except Exception as e:
+                print(e)
+                archived = 0
+
+            if archived < self.batch_size:
+                self._stop.wait(self.interval)
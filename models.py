@@ -1,4 +1,6 @@
-from sqlalchemy import Column, ForeignKey, Integer, Text, BLOB, NVARCHAR, VARCHAR, Boolean
+import time
+
+from sqlalchemy import Column, ForeignKey, Integer, Text, BLOB, NVARCHAR, VARCHAR, Boolean, Index, text
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -12,10 +14,87 @@ class Message(Base):
     receiver_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     text = Column(NVARCHAR(256), nullable=False)
     status = Column(Integer, nullable=False, default=0)
+    # Unix time of creation, NULL for messages created before the column was added
+    created_at = Column(Integer, nullable=True, default=lambda: int(time.time()), index=True)
 
     receiver = relationship('User', back_populates='received_messages', foreign_keys='Message.receiver_id')
     sender = relationship('User', back_populates='sent_messages', foreign_keys='Message.sender_id')
 
+    __table_args__ = (
+        Index('ix_messages_receiver_sender_id', 'receiver_id', 'sender_id', 'id'),
+        Index('ix_messages_receiver_id_id', 'receiver_id', 'id'),
+        Index('ix_messages_sender_id', 'sender_id'),
+        # Ids of deleted and archived messages are never reused
+        {'sqlite_autoincrement': True},
+    )
+
+
+class MessageArchiveBlock(Base):
+    """
+    Compressed block of archived (old and read) messages of one conversation, see archive_crud
+    """
+    __tablename__ = 'message_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
+    receiver_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    sender_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    # zlib compressed json: [[id, text, status, created_at], ...] ordered by id
+    data = Column(BLOB, nullable=False)
+
+    __table_args__ = (
+        Index('ix_message_archive_receiver_last_id', 'receiver_id', 'last_id'),
+        Index('ix_message_archive_sender_id', 'sender_id'),
+    )
+
+
+class UnreadCounter(Base):
+    """
+    Count of unread messages of the receiver from the sender, maintained by message_crud
+    """
+    __tablename__ = 'unread_counters'
+
+    receiver_id = Column(Integer, ForeignKey('users.id'), primary_key=True, nullable=False)
+    sender_id = Column(Integer, ForeignKey('users.id'), primary_key=True, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class UserStats(Base):
+    """
+    Counters of messages of the user maintained by message_crud (archived messages are counted too).
+    last_message_* is the newest message sent or received by the user
+    """
+    __tablename__ = 'user_stats'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, nullable=False)
+    sent = Column(Integer, nullable=False, default=0)
+    received = Column(Integer, nullable=False, default=0)
+    unread = Column(Integer, nullable=False, default=0)
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(Integer, nullable=True)
+
+
+class IdempotencyRecord(Base):
+    """
+    Response stored by the Idempotency-Key of a POST request, see idempotency_crud
+    """
+    __tablename__ = 'idempotency_keys'
+
+    # blake2b digest (hex) of the client, the method, the path and the Idempotency-Key
+    key = Column(VARCHAR(320), primary_key=True, nullable=False)
+    # blake2b digest (16 bytes) of the request body
+    fingerprint = Column(BLOB, nullable=False)
+    # NULL while the request is processed
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(VARCHAR(64), nullable=True)
+    body = Column(BLOB, nullable=True)
+    # Unix time, the row is purged after it
+    expires_at = Column(Integer, nullable=False, index=True)
+
+    __table_args__ = {'sqlite_with_rowid': False}
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -25,9 +104,30 @@ class User(Base):
     fst_name = Column(NVARCHAR(length=16), nullable=True, default='')
     sec_name = Column(NVARCHAR(length=16), nullable=True, default='')
     status = Column(Integer, nullable=False, default=0)
+    # Tombstone of a soft deleted user, the row is removed by the reaper after messages of the user
+    deleted = Column(Boolean, nullable=False, default=False, server_default=text('0'), index=True)
 
     received_messages = relationship('Message', back_populates='receiver', foreign_keys='Message.receiver_id')
     sent_messages = relationship('Message', back_populates='sender', foreign_keys='Message.sender_id')
+    # Loaded with the user by a join
+    stats = relationship('UserStats', uselist=False, lazy='joined', viewonly=True)
+
+    @property
+    def sent_count(self) -> int:
+        return self.stats.sent if self.stats is not None else 0
+
+    @property
+    def received_count(self) -> int:
+        return self.stats.received if self.stats is not None else 0
 
+    @property
+    def unread_count(self) -> int:
+        return self.stats.unread if self.stats is not None else 0
 
+    @property
+    def last_message_id(self) -> int:
+        return (self.stats.last_message_id or 0) if self.stats is not None else 0
 
+    @property
+    def last_message_at(self) -> int:
+        return (self.stats.last_message_at or 0) if self.stats is not None else 0
@@ -0,0 +1,334 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+import schemas
+
+
+class Subscription:
+    """
+    Queue of messages of one subscriber.
+    If the subscriber doesn't keep up and its queue overflows, new messages are dropped
+    and the lagged flag is set: the subscriber has to reload messages after its last id from the database
+
+    :param receiver_id: id of a receiver of messages
+    :param queue_size: max count of messages in the queue
+    """
+
+    __slots__ = ('receiver_id', 'queue', 'lagged')
+
+    def __init__(self, receiver_id: int, queue_size: int):
+        self.receiver_id = receiver_id
+        self.queue: 'asyncio.Queue[schemas.Message.Get]' = asyncio.Queue(queue_size)
+        self.lagged = False
+
+    def put(self, message: schemas.Message.Get) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+    def reset(self) -> None:
+        """
+        Drops queued messages and the lagged flag (before a reload from the database)
+        """
+        self.lagged = False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class MessageHub:
+    """
+    In-process pub/sub hub of committed messages.
+    publish is thread-safe, subscribers live in the event loop the hub is started in
+
+    Other worker processes are reached without a broker: every started hub binds a unix datagram socket
+    in the peer_dir and sends published messages to sockets of the other hubs found there
+
+    Example::
+
+        hub = MessageHub(queue_size=256, peer_dir='dbs/hub')
+        message_crud.committed_listeners.append(hub.publish)
+        await hub.start()
+
+        subscription = hub.subscribe(receiver_id)
+        message = await subscription.queue.get()
+        hub.unsubscribe(subscription)
+
+    :param queue_size: max count of queued messages of each subscriber
+    :param peer_dir: directory of sockets of worker processes (None to fan out inside the process only)
+    """
+
+    PEER_CHUNK = 64
+    PEER_REFRESH = 1.0
+
+    def __init__(self, queue_size: int = 256, peer_dir: Optional[str] = None):
+        self.queue_size = queue_size
+        self.peer_dir = peer_dir
+
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._listeners: List[Callable[[List[schemas.Message.Get]], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._socket: Optional[socket.socket] = None
+        self._socket_path: Optional[str] = None
+        # Peers are refreshed and forgotten by publish, which is called from any thread
+        self._peers: List[str] = []
+        self._peers_checked = 0.0
+        self._peers_lock = threading.Lock()
+
+    # -----------
+    #  Lifecycle
+    # -----------
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+        if self.peer_dir is not None:
+            os.makedirs(self.peer_dir, exist_ok=True)
+            self._socket_path = os.path.join(self.peer_dir, f'{os.getpid()}.sock')
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._socket_path)
+            self._socket.setblocking(False)
+            self._loop.add_reader(self._socket.fileno(), self._receive_from_peers)
+
+    async def stop(self) -> None:
+        if self._socket is not None:
+            self._loop.remove_reader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+        self._loop = None
+
+    # -------------
+    #  Subscribers
+    # -------------
+    def subscribe(self, receiver_id: int) -> Subscription:
+        subscription = Subscription(receiver_id, self.queue_size)
+        self._subscriptions.setdefault(receiver_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscriptions = self._subscriptions.get(subscription.receiver_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.receiver_id]
+
+    def add_listener(self, listener: Callable[[List[schemas.Message.Get]], None]) -> None:
+        """
+        Adds a function called in the event loop with every delivered list of messages (local and from peers)
+        """
+        self._listeners.append(listener)
+
+    def subscribers_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    # ------------
+    #  Publishing
+    # ------------
+    def publish(self, messages: List[schemas.Message.Get]) -> None:
+        """
+        Delivers messages to subscribers of their receivers in this and other worker processes.
+        May be called from any thread
+
+        :param messages: committed messages
+        """
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._deliver, messages)
+        if self._socket is not None:
+            self._send_to_peers(messages)
+
+    def _deliver(self, messages: List[schemas.Message.Get]) -> None:
+        for message in messages:
+            for subscription in self._subscriptions.get(message.receiver_id, ()):
+                subscription.put(message)
+        for listener in self._listeners:
+            try:
+                listener(messages)
+            except Exception as e:
+                print(e)
+
+    def _refresh_peers(self) -> List[str]:
+        """
+        Returns socket paths of the other hubs, the directory is listed once per PEER_REFRESH seconds
+        """
+        with self._peers_lock:
+            now = time.monotonic()
+            if now - self._peers_checked >= self.PEER_REFRESH:
+                self._peers_checked = now
+                self._peers = [
+                    os.path.join(self.peer_dir, name)
+                    for name in os.listdir(self.peer_dir)
+                    if name.endswith('.sock') and os.path.join(self.peer_dir, name) != self._socket_path
+                ]
+            return list(self._peers)
+
+    def _forget_peer(self, peer: str) -> None:
+        with self._peers_lock:
+            if peer in self._peers:
+                self._peers.remove(peer)
+        try:
+            os.remove(peer)
+        except FileNotFoundError:
+            pass
+
+    def _send_to_peers(self, messages: List[schemas.Message.Get]) -> None:
+        peers = self._refresh_peers()
+        if not peers:
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            sender.setblocking(False)
+            for i in range(0, len(messages), self.PEER_CHUNK):
+                payload = json.dumps([message.dict() for message in messages[i:i + self.PEER_CHUNK]]).encode()
+                for peer in list(peers):
+                    try:
+                        sender.sendto(payload, peer)
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        # The worker is gone, its socket file is stale
+                        peers.remove(peer)
+                        self._forget_peer(peer)
+                    except BlockingIOError:
+                        # The peer doesn't read fast enough, the datagram is dropped (its clients get messages on resume)
+                        pass
+
+    def _receive_from_peers(self) -> None:
+        while True:
+            try:
+                payload = self._socket.recv(1 << 20)
+            except BlockingIOError:
+                return
+            try:
+                messages = [schemas.Message.Get(**data) for data in json.loads(payload)]
+            except Exception as e:
+                print(e)
+                continue
+            self._deliver(messages)
+
+
+class InboxNotifier:
+    """
+    Wakes up coroutines waiting for new messages of a receiver (long polling).
+    Must be used from the event loop, notify is added as a listener of MessageHub
+
+    Example::
+
+        notifier = InboxNotifier()
+        hub.add_listener(notifier.notify)
+
+        messages = await notifier.wait(receiver_id, after_id, timeout=30, check=load_stored_messages)
+    """
+
+    def __init__(self):
+        self._waiters: Dict[int, Set[Tuple[int, asyncio.Future]]] = {}
+
+    def notify(self, messages: List[schemas.Message.Get]) -> None:
+        for message in messages:
+            for after_id, future in list(self._waiters.get(message.receiver_id, ())):
+                if message.id > after_id and not future.done():
+                    future.set_result([
+                        other for other in messages
+                        if other.receiver_id == message.receiver_id and other.id > after_id
+                    ])
+
+    def waiters_count(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    async def wait(self,
+                   receiver_id: int,
+                   after_id: int,
+                   timeout: float,
+                   check: Callable[[], Awaitable[List[schemas.Message.Get]]]) -> List[schemas.Message.Get]:
+        """
+        Returns messages of the receiver with ids greater than after_id as soon as there are some
+
+        :param receiver_id: id of the receiver
+        :param after_id: id of the last message the client has got
+        :param timeout: seconds to wait
+        :param check: loads already stored messages, it is called once after the waiter is registered
+            so messages committed in between are not lost
+        :return: new messages or an empty list if there are none within the timeout
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (after_id, future)
+        self._waiters.setdefault(receiver_id, set()).add(waiter)
+        try:
+            stored = await check()
+            if stored:
+                return stored
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return []
+        finally:
+            waiters = self._waiters.get(receiver_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[receiver_id]
+
+
+async def message_stream(hub: MessageHub,
+                         load_after: Callable[[int, int], List[schemas.Message.Get]],
+                         receiver_id: int,
+                         after_id: Optional[int] = None,
+                         keepalive: float = 15.0,
+                         batch: int = 100) -> AsyncGenerator[Optional[schemas.Message.Get], None]:
+    """
+    Yields messages of the receiver in the id order: first stored messages with ids greater than after_id,
+    then live ones from the hub. Yields None every keepalive seconds without messages
+
+    If the subscriber lags behind, messages after the last yielded id are reloaded from the database
+
+    :param hub: started MessageHub
+    :param load_after: loads stored messages of the receiver, (after_id, limit) -> messages ordered by id
+        (called in the threadpool, e.g. Storage.get_messages_after)
+    :param receiver_id: id of the receiver
+    :param after_id: id of the last message the client has got (None to receive only new messages)
+    :param keepalive: seconds to wait for a message before yielding None
+    :param batch: count of messages loaded from the database at once
+    """
+
+    # Subscribe before loading stored messages so nothing is lost in between
+    subscription = hub.subscribe(receiver_id)
+    reload = after_id is not None
+    last_id = after_id or 0
+    sent_ids: Set[int] = set()
+    try:
+        while True:
+            while reload:
+                subscription.reset()
+                stored = await run_in_threadpool(load_after, last_id, batch)
+                for message in stored:
+                    sent_ids.add(message.id)
+                    last_id = max(last_id, message.id)
+                    yield message
+                reload = len(stored) == batch
+
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+
+            # Ids of the last batch are remembered: messages of concurrent commits may come out of the id order
+            if message.id > last_id - batch and message.id not in sent_ids:
+                sent_ids.add(message.id)
+                last_id = max(last_id, message.id)
+                yield message
+            if len(sent_ids) > 2 * batch:
+                sent_ids = {message_id for message_id in sent_ids if message_id > last_id - batch}
+            if subscription.lagged:
+                reload = True
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,269 @@
+import fcntl
+import hashlib
+import math
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class Limit(NamedTuple):
+    """
+    Token bucket: holds at most burst tokens and gets rate tokens per second, a request takes one token
+    """
+    rate: float
+    burst: int
+
+
+def _refill(tokens: float, updated: float, now: float, limit: Limit) -> float:
+    return min(float(limit.burst), tokens + max(now - updated, 0.0) * limit.rate)
+
+
+class InProcessBuckets:
+    """
+    Token buckets of one process. Buckets are plain lists [tokens, time of update, limit]
+    changed by the event loop thread only, so no lock is taken
+
+    :param max_keys: idle (full) buckets are dropped when there are more keys
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, List[float]] = {}
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        """
+        Takes a token from the bucket of the key
+
+        :return: (True if the token is taken, tokens left)
+        """
+        denied, tokens = self.take_all([(key, limit)])
+        return denied is None, tokens[0]
+
+    def take_all(self, checks: List[Tuple[str, Limit]]) -> Tuple[Optional[int], List[float]]:
+        """
+        Takes a token from every bucket if each of them has one, otherwise takes none
+
+        :param checks: [(key, limit)]
+        :return: (index of the first bucket without a token or None if tokens are taken, tokens left in buckets)
+        """
+        now = time.monotonic()
+        buckets = []
+        for key, limit in checks:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._evict(now)
+                bucket = self._buckets[key] = [float(limit.burst), now, limit]
+            buckets.append(bucket)
+
+        tokens = [_refill(bucket[0], bucket[1], now, limit) for bucket, (_, limit) in zip(buckets, checks)]
+        denied = next((index for index, bucket_tokens in enumerate(tokens) if bucket_tokens < 1.0), None)
+        if denied is None:
+            tokens = [bucket_tokens - 1.0 for bucket_tokens in tokens]
+        for bucket, bucket_tokens, (_, limit) in zip(buckets, tokens, checks):
+            bucket[0], bucket[1], bucket[2] = bucket_tokens, now, limit
+        return denied, tokens
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+    def _evict(self, now: float) -> None:
+        # Every bucket is judged by its own limit, buckets of slow routes refill later
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if _refill(bucket[0], bucket[1], now, bucket[2]) < bucket[2].burst}
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+
+class SharedMemoryBuckets:
+    """
+    Token buckets shared by worker processes: a fixed hash table in shared memory guarded by a file lock.
+    A slot is (hash of the key, tokens, time of update), a key probes a few slots and takes the least recently
+    updated one if all of them are used, so limits of evicted keys are reset
+
+    Example::
+
+        buckets = SharedMemoryBuckets('fastapi_test_rate_limit', 'dbs/rate_limit.lock')
+
+    :param name: name of the shared memory block (created by the first process)
+    :param lock_path: path of the lock file
+    :param slots: count of buckets in the table
+    :param probes: count of slots checked for a key
+    """
+
+    _SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, name: str, lock_path: str, slots: int = 65536, probes: int = 8):
+        self.slots = slots
+        self.probes = probes
+
+        size = slots * self._SLOT.size
+        try:
+            self._memory = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            self._memory = shared_memory.SharedMemory(name)
+        # The block outlives processes of workers, it is removed by unlink()
+        resource_tracker.unregister(self._memory._name, 'shared_memory')
+
+        self._lock_file = open(lock_path, 'a+b')
+        self._thread_lock = threading.Lock()
+
+    def _hash(self, key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') | 1
+
+    def _find_slot(self, key_hash: int, limit: Limit, now: float, used_offsets: List[int]) -> Tuple[int, float]:
+        """
+        Returns the offset of the slot of the key and its refilled tokens
+        (a new key takes the least recently updated slot not in used_offsets)
+        """
+        buffer = self._memory.buf
+        oldest_offset, oldest_updated = None, math.inf
+        for probe in range(self.probes):
+            slot_offset = ((key_hash + probe) % self.slots) * self._SLOT.size
+            slot_hash, slot_tokens, slot_updated = self._SLOT.unpack_from(buffer, slot_offset)
+            if slot_hash == key_hash:
+                return slot_offset, _refill(slot_tokens, slot_updated, now, limit)
+            if slot_updated < oldest_updated and slot_offset not in used_offsets:
+                oldest_offset, oldest_updated = slot_offset, slot_updated
+        return oldest_offset, float(limit.burst)
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        """
+        Takes a token from the bucket of the key
+
+        :return: (True if the token is taken, tokens left)
+        """
+        denied, tokens = self.take_all([(key, limit)])
+        return denied is None, tokens[0]
+
+    def take_all(self, checks: List[Tuple[str, Limit]]) -> Tuple[Optional[int], List[float]]:
+        """
+        Takes a token from every bucket if each of them has one, otherwise takes none
+
+        :param checks: [(key, limit)]
+        :return: (index of the first bucket without a token or None if tokens are taken, tokens left in buckets)
+        """
+        now = time.time()
+        key_hashes = [self._hash(key) for key, _ in checks]
+
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                offsets: List[int] = []
+                tokens: List[float] = []
+                for key_hash, (_, limit) in zip(key_hashes, checks):
+                    offset, bucket_tokens = self._find_slot(key_hash, limit, now, offsets)
+                    offsets.append(offset)
+                    tokens.append(bucket_tokens)
+
+                denied = next((index for index, bucket_tokens in enumerate(tokens) if bucket_tokens < 1.0), None)
+                if denied is None:
+                    tokens = [bucket_tokens - 1.0 for bucket_tokens in tokens]
+                for offset, key_hash, bucket_tokens in zip(offsets, key_hashes, tokens):
+                    self._SLOT.pack_into(self._memory.buf, offset, key_hash, bucket_tokens, now)
+                return denied, tokens
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self._memory.close()
+        self._lock_file.close()
+
+    def unlink(self) -> None:
+        # unlink() unregisters the block from the resource tracker
+        resource_tracker.register(self._memory._name, 'shared_memory')
+        self._memory.unlink()
+
+
+class RateLimitMiddleware:
+    """
+    Limits requests with token buckets: a bucket of every route and client address and a bucket of every
+    client address across all routes. A request takes a token from each of its buckets only if all of them have one.
+    Responses get RateLimit-Limit, RateLimit-Remaining and RateLimit-Reset headers of the route bucket
+    (of the client bucket for routes without limits), rejected requests get 429 with a Retry-After header
+
+    Example::
+
+        app.add_middleware(RateLimitMiddleware, route_limits={'get_users': Limit(rate=1, burst=5)},
+                           client_limit=Limit(rate=50, burst=100))
+
+    :param app: wrapped application
+    :param route_limits: limits of routes by names of their functions {route: limit}
+    :param client_limit: limit of a client address across all routes, None for no limit
+    :param backend: storage of buckets, InProcessBuckets by default
+    """
+
+    def __init__(self,
+                 app: ASGIApp,
+                 route_limits: Optional[Dict[str, Limit]] = None,
+                 client_limit: Optional[Limit] = None,
+                 backend=None):
+        self.app = app
+        self.route_limits: Dict[str, Limit] = dict(route_limits or {})
+        self.client_limit = client_limit
+        self.backend = backend if backend is not None else InProcessBuckets()
+
+    @staticmethod
+    def _match_route(scope: Scope) -> Optional[str]:
+        application = scope.get('app')
+        router = getattr(application, 'router', None)
+        for route in getattr(router, 'routes', ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, 'name', None)
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        address = scope['client'][0] if scope.get('client') else ''
+        route = self._match_route(scope)
+
+        checks: List[Tuple[str, Limit]] = []
+        route_limit = self.route_limits.get(route)
+        if route_limit is not None:
+            checks.append((f'{route}|ip:{address}', route_limit))
+        if self.client_limit is not None:
+            checks.append((f'*|ip:{address}', self.client_limit))
+
+        if not checks:
+            await self.app(scope, receive, send)
+            return
+
+        denied, tokens = self.backend.take_all(checks)
+        if denied is not None:
+            limit = checks[denied][1]
+            response = JSONResponse(
+                status_code=429,
+                content={'message': 'too many requests'},
+                headers={**self._headers(limit, tokens[denied]),
+                         'Retry-After': str(math.ceil((1.0 - tokens[denied]) / limit.rate))}
+            )
+            await response(scope, receive, send)
+            return
+
+        rate_limit_headers = [(name.lower().encode(), value.encode())
+                              for name, value in self._headers(checks[0][1], tokens[0]).items()]
+
+        async def send_with_headers(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + rate_limit_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    @staticmethod
+    def _headers(limit: Limit, tokens: float) -> Dict[str, str]:
+        return {
+            'RateLimit-Limit': str(limit.burst),
+            'RateLimit-Remaining': str(int(tokens)),
+            'RateLimit-Reset': str(math.ceil((limit.burst - tokens) / limit.rate)),
+        }
@@ -0,0 +1,228 @@
+import hashlib
+import hmac
+import itertools
+import math
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+
+def enable_wal(bind: Engine) -> None:
+    """
+    Switches the database to the WAL journal (it is stored in the file), so readers
+    (replicas opened on the same file) don't block the writer and vice versa
+    """
+    with bind.connect() as connection:
+        connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+
+class WritePin:
+    """
+    Pins a client which has just written something for pin_window seconds (read-your-writes):
+    the time of its last write is kept by the client (the COOKIE cookie), so the pin holds whichever
+    worker process serves the next request. The time is signed with secret, so a client can neither
+    pin itself for good nor skip the pin
+
+    Example::
+
+        # a write of the client
+        response.set_cookie(WritePin.COOKIE, write_pin.pin(), max_age=write_pin.pin_max_age())
+        # a read of the client
+        if write_pin.is_pinned(request.cookies.get(WritePin.COOKIE)):
+            ...
+
+    :param pin_window: seconds a client is pinned after its write
+    :param secret: key signing pins, the same in every worker process (a random key of this process if None)
+    """
+
+    COOKIE = 'last_write_at'
+
+    def __init__(self, pin_window: float = 5.0, secret: Optional[bytes] = None):
+        self.pin_window = pin_window
+        self._secret = secret if secret is not None else secrets.token_bytes(32)
+
+    def _sign(self, last_write_at: str) -> str:
+        return hmac.new(self._secret, last_write_at.encode(), hashlib.sha256).hexdigest()
+
+    def pin(self) -> str:
+        """
+        Returns the value of the COOKIE of a client writing now (signed unix time of the write)
+        """
+        last_write_at = f'{time.time():.3f}'
+        return f'{last_write_at}:{self._sign(last_write_at)}'
+
+    def pin_max_age(self) -> int:
+        return int(self.pin_window) + 1
+
+    def is_pinned(self, last_write_at: Optional[str]) -> bool:
+        """
+        :param last_write_at: value of the COOKIE of the client (None if it has not written)
+        """
+        if not last_write_at:
+            return False
+        written_at, _, signature = last_write_at.partition(':')
+        if not hmac.compare_digest(signature, self._sign(written_at)):
+            return False
+        try:
+            written_at = float(written_at)
+        except ValueError:
+            return False
+        now = time.time()
+        # A time in the future (more than the window, e.g. clocks of workers differ) is not trusted
+        return math.isfinite(written_at) and now - self.pin_window < written_at <= now + self.pin_window
+
+
+class ReplicaRouter:
+    """
+    Spreads read-only requests across replica databases round-robin.
+    A client which has just written something is pinned to the primary for pin_window seconds
+    (read-your-writes, see WritePin)
+
+    Replicas are either read-only connections to the primary file (WAL readers, always fresh),
+    e.g. 'sqlite:///file:dbs/test_db.sqlite3?mode=ro&uri=true',
+    or snapshot files refreshed from the primary every snapshot_interval seconds
+
+    Example::
+
+        router = ReplicaRouter(['sqlite:///dbs/replica_0.sqlite3'], primary_path='dbs/test_db.sqlite3',
+                               snapshot_interval=10)
+        router.start()
+
+        db = router.read_session(request.cookies.get(ReplicaRouter.PIN_COOKIE)) or SessionLocal()
+        ...
+        # a write of the client
+        response.set_cookie(ReplicaRouter.PIN_COOKIE, router.pin(), max_age=router.pin_max_age())
+
+    :param replica_urls: database urls of replicas
+    :param pin_window: seconds a client reads from the primary after its write
+    :param primary_path: path of the primary database file to snapshot into replica files
+        (None if replicas are WAL readers)
+    :param snapshot_interval: seconds between refreshes of snapshot replicas
+    :param secret: key signing pins, the same in every worker process (a random key of this process if None)
+    """
+
+    PIN_COOKIE = WritePin.COOKIE
+
+    def __init__(self,
+                 replica_urls: List[str],
+                 pin_window: float = 5.0,
+                 primary_path: Optional[str] = None,
+                 snapshot_interval: float = 30.0,
+                 secret: Optional[bytes] = None):
+        if not replica_urls:
+            raise ValueError(replica_urls, 'at least one replica is required')
+
+        self.replica_urls = replica_urls
+        self.write_pin = WritePin(pin_window, secret)
+        self.primary_path = primary_path
+        self.snapshot_interval = snapshot_interval
+
+        self.engines = [create_engine(url, connect_args={'check_same_thread': False}) for url in replica_urls]
+        self.sessions = [sessionmaker(autocommit=False, autoflush=False, bind=replica) for replica in self.engines]
+        self._next = itertools.cycle(range(len(self.sessions)))
+        self._next_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------
+    #  Routing
+    # ---------
+    @property
+    def pin_window(self) -> float:
+        return self.write_pin.pin_window
+
+    def _sign(self, last_write_at: str) -> str:
+        return self.write_pin._sign(last_write_at)
+
+    def pin(self) -> str:
+        return self.write_pin.pin()
+
+    def pin_max_age(self) -> int:
+        return self.write_pin.pin_max_age()
+
+    def is_pinned(self, last_write_at: Optional[str]) -> bool:
+        return self.write_pin.is_pinned(last_write_at)
+
+    def read_session(self, last_write_at: Optional[str]) -> Optional[Session]:
+        """
+        Returns a session of the next replica, or None if the client must read from the primary
+
+        :param last_write_at: value of the PIN_COOKIE of the client
+        """
+        if self.is_pinned(last_write_at):
+            return None
+        with self._next_lock:
+            index = next(self._next)
+        return self.sessions[index]()
+
+    # -----------
+    #  Snapshots
+    # -----------
+    def start(self) -> None:
+        if self.primary_path is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='replica-snapshots', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        for replica in self.engines:
+            replica.dispose()
+
+    def refresh(self) -> None:
+        """
+        Copies a consistent snapshot of the primary into every replica file (sqlite online backup)
+        """
+        source = sqlite3.connect(self.primary_path)
+        try:
+            for replica in self.engines:
+                target = sqlite3.connect(replica.url.database)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+
+    def repoint(self, previous_path: str, primary_path: str) -> None:
+        """
+        Points replicas to a new primary file (after a restore): snapshot replicas are refreshed from it right away,
+        WAL readers of previous_path are reopened on it. Sessions opened before finish on previous engines
+
+        :param previous_path: path of the previous primary file
+        :param primary_path: path of the new primary file
+        """
+        if self.primary_path is not None:
+            self.primary_path = primary_path
+            self.refresh()
+            return
+
+        for index, replica in enumerate(self.engines):
+            url = replica.url
+            prefix = 'file:' if url.database.startswith('file:') else ''
+            if os.path.abspath(url.database[len(prefix):]) != os.path.abspath(previous_path):
+                continue
+            self.engines[index] = create_engine(url.set(database=prefix + primary_path),
+                                                connect_args={'check_same_thread': False})
+            self.sessions[index].configure(bind=self.engines[index])
+            replica.dispose()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(e)
@@ -45,6 +45,69 @@ class Message(metaclass=MetaSchemaFactory):
         return status
 
 
+class MessageSearch(metaclass=MetaSchemaFactory):
+    """
+    Page of found messages
+
+    Fields::
+
+        :messages List[Message], found messages ordered by relevance
+        :next_cursor cursor of the next page, empty on the last page
+    """
+
+    messages = SchemaField(List[Message.Get], IK.GET)
+    next_cursor = SchemaField(str, IK.GET, default='')
+
+    @classmethod
+    @meta_constructor(IK.GET)
+    def init_get(cls, messages: List[Message.Get], next_cursor: str = ''):
+        return None
+
+
+class Broadcast(metaclass=MetaSchemaFactory):
+    """
+    One message text sent to many receivers
+
+    Fields::
+
+        :sender_id integer
+        :text message text
+        :receiver_ids List[int], receivers of the message (ignored if the broadcast goes to all users)
+        :message_ids List[int], ids of created messages in the order of receiver_ids
+        :missing_receiver_ids List[int], requested receivers which are not found
+    """
+
+    # --------
+    #  Fields
+    # --------
+    sender_id = SchemaField(int, IK.CREATE | IK.GET)
+    text = SchemaField(str, IK.CREATE | IK.GET)
+    receiver_ids = SchemaField(List[int], IK.CREATE | IK.GET)
+    message_ids = SchemaField(List[int], IK.GET)
+    missing_receiver_ids = SchemaField(List[int], IK.GET)
+
+    # --------------
+    #  Constructors
+    # --------------
+    @classmethod
+    @meta_constructor(IK.CREATE)
+    def init_create(cls, sender_id: int, text: str, receiver_ids: List[int]):
+        return None
+
+    @classmethod
+    @meta_constructor(IK.GET)
+    def init_get(cls, sender_id: int, text: str, receiver_ids: List[int],
+                 message_ids: List[int], missing_receiver_ids: List[int]):
+        return None
+
+    # ------------
+    #  Validators
+    # ------------
+    @meta_validator('text')
+    def check_text_message(cls, text: str):
+        return text
+
+
 class User(metaclass=MetaSchemaFactory):
     """
     Fields::
@@ -56,6 +119,8 @@ class User(metaclass=MetaSchemaFactory):
         :status acceptable values [0, 1]
         :received_messages List[Message], default is [],
         :sent_messages List[Message], default is [],
+        :sent_count, received_count, unread_count, last_message_id, last_message_at:
+            precomputed message statistics (see UserStats), default is 0
     """
 
     # --------
@@ -70,6 +135,12 @@ class User(metaclass=MetaSchemaFactory):
     received_messages = SchemaField(List[Message.Get], IK.GET)
     sent_messages = SchemaField(List[Message.Get], IK.GET)
 
+    sent_count = SchemaField(int, IK.GET, default=0)
+    received_count = SchemaField(int, IK.GET, default=0)
+    unread_count = SchemaField(int, IK.GET, default=0)
+    last_message_id = SchemaField(int, IK.GET, default=0)
+    last_message_at = SchemaField(int, IK.GET, default=0)
+
     # --------------
     #  Constructors
     # --------------
@@ -86,7 +157,9 @@ class User(metaclass=MetaSchemaFactory):
     @classmethod
     @meta_constructor(IK.GET)
     def init_edit(cls, id: int, nik_name: str, fst_name: str, sec_name: str,
-                  received_messages: List[Message.Get], sent_messages: List[Message.Get], status: int = 0):
+                  received_messages: List[Message.Get], sent_messages: List[Message.Get], status: int = 0,
+                  sent_count: int = 0, received_count: int = 0, unread_count: int = 0,
+                  last_message_id: int = 0, last_message_at: int = 0):
         return None
 
     # ------------
@@ -133,3 +206,75 @@ class User(metaclass=MetaSchemaFactory):
                 exc += f'value \'{status}\' must be in range (0, 1)'
 
         return status
+
+
+class UserBrief(metaclass=MetaSchemaFactory):
+    """
+    Lightweight projection of a user (without messages) for lists and typeahead
+
+    Fields::
+
+        :id integer
+        :nik_name nick name
+        :fst_name first name
+        :sec_name second name
+    """
+
+    id = SchemaField(int, IK.GET)
+    nik_name = SchemaField(str, IK.GET)
+    fst_name = SchemaField(str, IK.GET)
+    sec_name = SchemaField(str, IK.GET)
+
+    @classmethod
+    @meta_constructor(IK.GET)
+    def init_get(cls, id: int, nik_name: str, fst_name: str, sec_name: str):
+        return None
+
+
+class UserMessages(metaclass=MetaSchemaFactory):
+    """
+    Full message history of a user
+
+    Fields::
+
+        :user_id integer
+        :received_messages List[Message], ordered by id
+        :sent_messages List[Message], ordered by id
+    """
+
+    user_id = SchemaField(int, IK.GET)
+    received_messages = SchemaField(List[Message.Get], IK.GET)
+    sent_messages = SchemaField(List[Message.Get], IK.GET)
+
+    @classmethod
+    @meta_constructor(IK.GET)
+    def init_get(cls, user_id: int, received_messages: List[Message.Get], sent_messages: List[Message.Get]):
+        return None
+
+
+class UserStats(metaclass=MetaSchemaFactory):
+    """
+    Precomputed message statistics of a user
+
+    Fields::
+
+        :user_id integer
+        :sent count of sent messages
+        :received count of received messages
+        :unread count of unread received messages
+        :last_message_id id of the newest sent or received message, 0 if there are none
+        :last_message_at unix time of the newest message, 0 if it is unknown
+    """
+
+    user_id = SchemaField(int, IK.GET)
+    sent = SchemaField(int, IK.GET, default=0)
+    received = SchemaField(int, IK.GET, default=0)
+    unread = SchemaField(int, IK.GET, default=0)
+    last_message_id = SchemaField(int, IK.GET, default=0)
+    last_message_at = SchemaField(int, IK.GET, default=0)
+
+    @classmethod
+    @meta_constructor(IK.GET)
+    def init_get(cls, user_id: int, sent: int = 0, received: int = 0, unread: int = 0,
+                 last_message_id: int = 0, last_message_at: int = 0):
+        return None
@@ -0,0 +1,437 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar, Union
+
+from sqlalchemy import Column, Integer, VARCHAR, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, sessionmaker
+
+import models
+import schemas
+from crud import archive_crud, message_crud, search_crud, user_crud
+from crud.storage import SQLAlchemyStorage, Storage
+from database import init_db
+
+
+T = TypeVar('T')
+
+DirectoryBase = declarative_base()
+
+
+class UserDirectoryEntry(DirectoryBase):
+    """
+    Global directory of users: allocates ids of users unique across shards and maps nick names to ids
+    """
+    __tablename__ = 'user_directory'
+
+    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
+    nik_name = Column(VARCHAR(length=32), nullable=False, unique=True, index=True)
+
+
+class DeletedUserEntry(DirectoryBase):
+    """
+    Deleted user whose messages are still to be removed from all shards (see ShardRouter.purge_deleted_user)
+    """
+    __tablename__ = 'deleted_users'
+
+    id = Column(Integer, primary_key=True, autoincrement=False, nullable=False)
+
+
+class ShardRouter:
+    """
+    Partitions users across several sqlite files by a hash of the user id, messages are stored on the shard
+    of their receiver. Ids and nick names of users are kept in the global directory database.
+    Lists and counts fan out to all shards in parallel and are merged.
+    Ids of messages are unique across shards: the AUTOINCREMENT sequence of shard k starts at k << MESSAGE_ID_BITS
+
+    Example::
+
+        router = ShardRouter(['sqlite:///dbs/shard_0.sqlite3', 'sqlite:///dbs/shard_1.sqlite3'],
+                             'sqlite:///dbs/directory.sqlite3')
+        router.init_db()
+
+        user = router.post_user(schemas.User.Create(nik_name='@user', fst_name='Fst', sec_name='Sec'))
+        with router.session_for_user(user.id) as db:
+            ...
+
+    :param shard_urls: database urls of shards, their order must never change
+    :param directory_url: database url of the user directory
+    """
+
+    MESSAGE_ID_BITS = 40
+
+    def __init__(self, shard_urls: List[str], directory_url: str):
+        if not shard_urls:
+            raise ValueError(shard_urls, 'at least one shard is required')
+
+        self.engines = [
+            create_engine(url, connect_args={'check_same_thread': False}) for url in shard_urls
+        ]
+        self.sessions = [
+            sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in self.engines
+        ]
+        self.directory_engine = create_engine(directory_url, connect_args={'check_same_thread': False})
+        self.directory_session = sessionmaker(autocommit=False, autoflush=False, bind=self.directory_engine)
+
+        self._executor = ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix='shard')
+
+    def init_db(self) -> None:
+        for shard, shard_engine in enumerate(self.engines):
+            init_db(shard_engine)
+            with self.sessions[shard]() as db:
+                archive_crud.init_message_id_sequence(db, first_id=shard << self.MESSAGE_ID_BITS)
+            search_crud.init_message_fts(shard_engine)
+            search_crud.init_users_fts(shard_engine)
+        DirectoryBase.metadata.create_all(bind=self.directory_engine)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        for shard_engine in self.engines + [self.directory_engine]:
+            shard_engine.dispose()
+
+    # ---------
+    #  Routing
+    # ---------
+    def shard_of(self, user_id: int) -> int:
+        # Multiplicative hash, so consecutive ids don't follow a pattern of shards
+        return (user_id * 2654435761) % (1 << 32) % len(self.engines)
+
+    def session_for_user(self, user_id: int) -> Session:
+        return self.sessions[self.shard_of(user_id)]()
+
+    def fan_out(self, fun: Callable[[Session], T]) -> List[T]:
+        """
+        Calls fun with a session of every shard in parallel
+
+        :return: results in the order of shards
+        """
+
+        def call(shard_sessions):
+            with shard_sessions() as db:
+                return fun(db)
+
+        return list(self._executor.map(call, self.sessions))
+
+    def _group_by_shard(self, user_ids: Iterable[int]) -> Dict[int, List[int]]:
+        groups: Dict[int, List[int]] = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_of(user_id), []).append(user_id)
+        return groups
+
+    # -------
+    #  Users
+    # -------
+    def _load_users(self, user_ids: List[int]) -> List[schemas.User.Get]:
+        """
+        Loads users with received messages from their shards and sent messages from all shards,
+        with statistics summed from all shards
+        """
+        if not user_ids:
+            return []
+
+        users: Dict[int, models.User] = {}
+        received: Dict[int, List[schemas.Message.Get]] = {user_id: [] for user_id in user_ids}
+        sent: Dict[int, List[schemas.Message.Get]] = {user_id: [] for user_id in user_ids}
+
+        for shard, shard_user_ids in self._group_by_shard(user_ids).items():
+            with self.sessions[shard](expire_on_commit=False) as db:
+                for user in db.query(models.User).filter(models.User.id.in_(shard_user_ids),
+                                                         models.User.deleted == False):
+                    users[user.id] = user
+                    received[user.id] = [schemas.Message.Get.from_orm(message) for message in user.received_messages]
+
+        def load_sent(db: Session) -> List[schemas.Message.Get]:
+            return [schemas.Message.Get.from_orm(message)
+                    for message in db.query(models.Message).filter(models.Message.sender_id.in_(list(users)))]
+
+        for shard_messages in self.fan_out(load_sent):
+            for message in shard_messages:
+                sent[message.sender_id].append(message)
+
+        stats = self.get_users_stats(list(users))
+        return [
+            schemas.User.Get(
+                id=user.id, nik_name=user.nik_name, fst_name=user.fst_name, sec_name=user.sec_name,
+                status=user.status,
+                received_messages=received[user.id],
+                sent_messages=sorted(sent[user.id], key=lambda message: message.id),
+                sent_count=stats[user.id].sent,
+                received_count=stats[user.id].received,
+                unread_count=stats[user.id].unread,
+                last_message_id=stats[user.id].last_message_id,
+                last_message_at=stats[user.id].last_message_at
+            )
+            for user in (users[user_id] for user_id in user_ids if user_id in users)
+        ]
+
+    def get_users_stats(self, user_ids: List[int]) -> Dict[int, schemas.UserStats.Get]:
+        """
+        Sums message statistics of users from all shards (sent messages are stored on shards of their receivers)
+        """
+        stats = {user_id: schemas.UserStats.Get(user_id=user_id) for user_id in user_ids}
+        if not user_ids:
+            return stats
+
+        def load_stats(db: Session) -> list:
+            return db.query(models.UserStats.user_id, models.UserStats.sent, models.UserStats.received,
+                            models.UserStats.unread, models.UserStats.last_message_id,
+                            models.UserStats.last_message_at) \
+                .filter(models.UserStats.user_id.in_(user_ids)) \
+                .all()
+
+        for shard_stats in self.fan_out(load_stats):
+            for row in shard_stats:
+                user_stats = stats[row.user_id]
+                user_stats.sent += row.sent
+                user_stats.received += row.received
+                user_stats.unread += row.unread
+                if (row.last_message_id or 0) > user_stats.last_message_id:
+                    user_stats.last_message_id = row.last_message_id
+                    user_stats.last_message_at = row.last_message_at or 0
+        return stats
+
+    def get_user_stats(self, user_id: int) -> schemas.UserStats.Get:
+        return self.get_users_stats([user_id])[user_id]
+
+    def get_user(self, user_id: int) -> schemas.User.Get:
+        """
+        :except ValueError: occurs if user is not found by id
+        """
+        users = self._load_users([user_id])
+        if not users:
+            raise ValueError(user_id, f'user is not found by id')
+        return users[0]
+
+    def get_user_messages(self, user_id: int) -> schemas.UserMessages.Get:
+        """
+        Loads received messages of the user from its shard and sent messages from all shards
+
+        :except ValueError: occurs if user is not found by id
+        """
+        with self.session_for_user(user_id) as db:
+            user = user_crud.get_user(db, user_id)
+            received = [schemas.Message.Get.from_orm(message)
+                        for message in sorted(user.received_messages, key=lambda message: message.id)]
+
+        def load_sent(db: Session) -> List[schemas.Message.Get]:
+            return [schemas.Message.Get.from_orm(message)
+                    for message in db.query(models.Message).filter(models.Message.sender_id == user_id)]
+
+        sent = [message for shard_messages in self.fan_out(load_sent) for message in shard_messages]
+        return schemas.UserMessages.Get(user_id=user_id, received_messages=received,
+                                        sent_messages=sorted(sent, key=lambda message: message.id))
+
+    def get_user_id_by_nik_name(self, nik_name: str) -> int:
+        """
+        :except ValueError: occurs if user is not found by nick name
+        """
+        with self.directory_session() as directory:
+            entry = directory.query(UserDirectoryEntry).filter(UserDirectoryEntry.nik_name == nik_name).first()
+            if entry is None:
+                raise ValueError(nik_name, f'user is not found by nick name')
+            return entry.id
+
+    def get_users(self, skip: int = 0, limit: int = 100) -> List[schemas.User.Get]:
+        """
+        Returns users ordered by id in range of the skip and the limit (merged from all shards)
+        """
+
+        def load_ids(db: Session) -> List[int]:
+            return [row.id for row in db.query(models.User.id)
+                    .filter(models.User.deleted == False)
+                    .order_by(models.User.id)
+                    .limit(skip + limit)]
+
+        user_ids = list(heapq.merge(*self.fan_out(load_ids)))[skip:skip + limit]
+        return self._load_users(user_ids)
+
+    def get_users_count(self) -> int:
+        return sum(self.fan_out(user_crud.get_users_count))
+
+    def post_user(self, new_user_data: schemas.User.Create) -> schemas.User.Get:
+        """
+        Allocates the id and the nick name in the directory and creates the user on its shard
+
+        :except ValueError: occurs if user with the given nick name is already taken
+        """
+        with self.directory_session() as directory:
+            entry = UserDirectoryEntry(nik_name=new_user_data.nik_name)
+            directory.add(entry)
+            try:
+                directory.commit()
+            except Exception as e:
+                print(e)
+                directory.rollback()
+                raise ValueError(new_user_data, f'user with that nick name is already created')
+
+            try:
+                with self.session_for_user(entry.id) as db:
+                    user = models.User(id=entry.id, **new_user_data.dict())
+                    db.add(user)
+                    db.flush()
+                    search_crud.index_users(db, [(user.id, user.nik_name, user.fst_name, user.sec_name)])
+                    db.commit()
+            except Exception as e:
+                print(e)
+                directory.delete(entry)
+                directory.commit()
+                raise ValueError(new_user_data, f'user creation error')
+
+        return self.get_user(entry.id)
+
+    def put_user(self, user_id: int, new_user_data: schemas.User.Edit) -> schemas.User.Get:
+        """
+        Updates the nick name of the user in the directory, then the user on its shard.
+        The directory change is undone if the shard is not updated
+
+        :except ValueError: occurs if user is not found, the nick name is already taken or the update fails
+        """
+        with self.directory_session() as directory:
+            entry = directory.get(UserDirectoryEntry, user_id)
+            if entry is None:
+                raise ValueError(user_id, f'user is not found by id')
+            old_nik_name = entry.nik_name
+            entry.nik_name = new_user_data.nik_name
+            try:
+                directory.commit()
+            except Exception as e:
+                print(e)
+                raise ValueError(new_user_data, f'user with that nick name is already created')
+
+            try:
+                with self.session_for_user(user_id) as db:
+                    user_crud.put_user(db, user_crud.get_user(db, user_id), new_user_data)
+            except Exception:
+                entry.nik_name = old_nik_name
+                directory.commit()
+                raise
+
+        return self.get_user(user_id)
+
+    def forget_user(self, user_id: int) -> None:
+        """
+        Releases the nick name of a deleted user and queues removal of its messages from all shards
+        """
+        with self.directory_session() as directory:
+            directory.query(UserDirectoryEntry).filter(UserDirectoryEntry.id == user_id).delete()
+            directory.merge(DeletedUserEntry(id=user_id))
+            directory.commit()
+
+    def get_deleted_user_ids(self, limit: int = 10) -> List[int]:
+        """
+        Returns ids of deleted users waiting for the reaper
+        """
+        with self.directory_session() as directory:
+            return [row.id for row in directory.query(DeletedUserEntry.id).limit(limit)]
+
+    def purge_deleted_user(self, user_id: int, batch_size: int = 500) -> bool:
+        """
+        Removes one batch of messages of the deleted user on every shard (sent messages are stored on shards
+        of their receivers), and the user itself when there are no messages left
+
+        :return: True if the user is removed completely
+        """
+        purged = self.fan_out(lambda db: user_crud.purge_deleted_user(db, user_id, batch_size))
+        if not all(purged):
+            return False
+
+        with self.directory_session() as directory:
+            directory.query(DeletedUserEntry).filter(DeletedUserEntry.id == user_id).delete()
+            directory.commit()
+        return True
+
+    # ----------
+    #  Messages
+    # ----------
+    def user_exists(self, user_id: int) -> bool:
+        with self.session_for_user(user_id) as db:
+            return bool(message_crud.get_existing_user_ids(db, (user_id,)))
+
+    def post_message(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        """
+        Creates the message on the shard of its receiver
+
+        :except ValueError: occurs if the sender or the receiver is not found
+        """
+        if not self.user_exists(new_message_data.sender_id):
+            raise ValueError(new_message_data, f'sender or receiver is not found')
+
+        with self.session_for_user(new_message_data.receiver_id) as db:
+            messages = message_crud.post_messages(db, [new_message_data], check_senders=False)
+            if messages[0] is None:
+                raise ValueError(new_message_data, f'sender or receiver is not found')
+            return schemas.Message.Get.from_orm(messages[0])
+
+
+class ShardedStorage(Storage):
+    """
+    Storage over the shard router: users and lists go through the router, unread counters
+    and messages of a receiver are read from the shard of the receiver
+
+    :param router: router of the shards
+    """
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    def _receiver_call(self, receiver_id: int, fun: Callable[[Storage], T]) -> T:
+        with self.router.session_for_user(receiver_id) as db:
+            return fun(SQLAlchemyStorage(db))
+
+    # -------
+    #  Users
+    # -------
+    def get_user(self, user_id: int) -> schemas.User.Get:
+        return self.router.get_user(user_id)
+
+    def get_user_id(self, user_identifier: Union[int, str]) -> int:
+        if type(user_identifier) is not int:
+            return self.router.get_user_id_by_nik_name(user_identifier)
+        if not self.router.user_exists(user_identifier):
+            raise ValueError(user_identifier, f'user is not found by id')
+        return user_identifier
+
+    def get_users(self, skip: int = 0, limit: int = 100) -> List[schemas.User.Get]:
+        return self.router.get_users(skip, limit)
+
+    def get_users_count(self) -> int:
+        return self.router.get_users_count()
+
+    def post_user(self, new_user_data: schemas.User.Create) -> schemas.User.Get:
+        return self.router.post_user(new_user_data)
+
+    def put_user(self, user_id: int, new_user_data: schemas.User.Edit) -> schemas.User.Get:
+        return self.router.put_user(user_id, new_user_data)
+
+    def del_user(self, user_id: int) -> schemas.UserBrief.Get:
+        # Messages on other shards are removed by the reaper (see ShardRouter.purge_deleted_user)
+        deleted_user = self._receiver_call(user_id, lambda storage: storage.del_user(user_id))
+        self.router.forget_user(user_id)
+        return deleted_user
+
+    def get_user_stats(self, user_id: int) -> schemas.UserStats.Get:
+        return self.router.get_user_stats(user_id)
+
+    def get_user_messages(self, user_id: int) -> schemas.UserMessages.Get:
+        return self.router.get_user_messages(user_id)
+
+    # ----------
+    #  Messages
+    # ----------
+    def post_message(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        return self.router.post_message(new_message_data)
+
+    def get_unread_counts(self, receiver_id: int) -> Dict[int, int]:
+        return self._receiver_call(receiver_id, lambda storage: storage.get_unread_counts(receiver_id))
+
+    def mark_messages_read(self, receiver_id: int, sender_id: int, up_to_id: int) -> int:
+        return self._receiver_call(receiver_id,
+                                   lambda storage: storage.mark_messages_read(receiver_id, sender_id, up_to_id))
+
+    def get_messages_after(self, receiver_id: int, after_id: int, limit: int = 100) -> List[schemas.Message.Get]:
+        return self._receiver_call(receiver_id,
+                                   lambda storage: storage.get_messages_after(receiver_id, after_id, limit))
+
+    def get_inbox(self, receiver_id: int, before_id: Optional[int] = None, limit: int = 50) \
+            -> List[schemas.Message.Get]:
+        return self._receiver_call(receiver_id, lambda storage: storage.get_inbox(receiver_id, before_id, limit))
@@ -0,0 +1,119 @@
+"""
+Fixtures of API tests: every pytest (xdist) worker builds the schema once into a template file,
+copies it into its in-memory database, and every test runs in a transaction rolled back after it
+
+    python -m pytest -n auto tests
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import main  # noqa: E402
+from crud import search_crud  # noqa: E402
+
+
+def _sqlite_savepoints(bind: Engine) -> None:
+    # pysqlite begins transactions by itself and breaks SAVEPOINT, let SQLAlchemy emit BEGIN
+    @event.listens_for(bind, 'connect')
+    def do_connect(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(bind, 'begin')
+    def do_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+@pytest.fixture(scope='session')
+def template_path(tmp_path_factory) -> str:
+    """
+    sqlite file with the schema, full-text indexes and counters of the app (one per worker)
+    """
+    path = str(tmp_path_factory.mktemp('template') / 'template.sqlite3')
+    template_engine = create_engine(f'sqlite:///{path}')
+    main.init_database(template_engine)
+    template_engine.dispose()
+    return path
+
+
+@pytest.fixture(scope='session')
+def db_engine(template_path) -> Engine:
+    """
+    Engine of the in-memory database of the worker filled from the template
+    """
+    memory_engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    _sqlite_savepoints(memory_engine)
+
+    template = sqlite3.connect(template_path)
+    with memory_engine.connect() as connection:
+        template.backup(connection.connection.driver_connection)
+    template.close()
+
+    yield memory_engine
+    memory_engine.dispose()
+
+
+@pytest.fixture
+def db_connection(db_engine):
+    """
+    Connection in a transaction rolled back after the test. All sessions of the app are bound to it
+    and work in a savepoint, which is started again after every commit or rollback of a session
+    """
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    savepoint = [connection.begin_nested()]
+
+    def restart_savepoint(session, session_transaction):
+        if not savepoint[0].is_active:
+            savepoint[0] = connection.begin_nested()
+
+    database.SessionLocal.configure(bind=connection)
+    event.listen(database.SessionLocal, 'after_transaction_end', restart_savepoint)
+    try:
+        yield connection
+    finally:
+        event.remove(database.SessionLocal, 'after_transaction_end', restart_savepoint)
+        database.SessionLocal.configure(bind=database.engine)
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture
+def db(db_connection):
+    """
+    Session of the test transaction. Sessions share the savepoint, so end its transaction (commit)
+    before requests to the app
+    """
+    with database.SessionLocal() as session:
+        yield session
+
+
+@pytest.fixture
+def client(db_connection, monkeypatch):
+    """
+    Client of the app with sessions of the test transaction. Startup events are not run,
+    so background threads are not started and messages are written without the batcher
+    """
+
+    def get_test_db():
+        with database.SessionLocal() as session:
+            yield session
+
+    monkeypatch.setattr(main, 'message_write_batcher', None)
+    main.app.dependency_overrides[main.Dependencies.get_db] = get_test_db
+    main.app.dependency_overrides[main.Dependencies.get_read_db] = get_test_db
+    main.rate_limit_buckets.clear()
+    search_crud.typeahead_cache.clear()
+    main.profile_cache.clear()
+    try:
+        yield TestClient(main.app)
+    finally:
+        main.app.dependency_overrides.clear()
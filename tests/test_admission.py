@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Overloaded, Priority
+
+
+def test_waiters_leave_queue_by_priority():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=8, queue_timeout=1.0)
+        await controller.acquire('busy')
+        order = []
+
+        async def request(route, priority):
+            await controller.acquire(route, priority)
+            order.append(route)
+            controller.release(route)
+
+        tasks = [asyncio.create_task(request('low', Priority.LOW)),
+                 asyncio.create_task(request('high', Priority.HIGH)),
+                 asyncio.create_task(request('normal', Priority.NORMAL))]
+        await asyncio.sleep(0)
+        controller.release('busy')
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ['high', 'normal', 'low']
+
+
+def test_full_queue_sheds_or_evicts():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1.0)
+        await controller.acquire('busy')
+
+        low = asyncio.create_task(controller.acquire('low', Priority.LOW))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as shed:
+            await controller.acquire('other_low', Priority.LOW)
+        assert shed.value.reason == 'queue_full'
+
+        high = asyncio.create_task(controller.acquire('high', Priority.HIGH))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as evicted:
+            await low
+        assert evicted.value.reason == 'evicted'
+
+        controller.release('busy')
+        await high
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['in_flight'] == 1 and stats['queue_depth'] == 0
+    assert stats['routes']['low']['shed'] == 1 and stats['routes']['high']['admitted'] == 1
+
+
+def test_queue_timeout_and_route_limit():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=4, queue_timeout=0.01, route_limits={'write': 1})
+        await controller.acquire('write')
+        with pytest.raises(Overloaded) as timeout:
+            await controller.acquire('write')
+        assert timeout.value.reason == 'timeout'
+        # Other routes are not limited by the limit of the route
+        await controller.acquire('read')
+
+    asyncio.run(scenario())
+
+
+def test_admission_stats_route(client):
+    client.get('/users/count')
+    stats = client.get('/admission/stats').json()
+    assert stats['in_flight'] == 0
+    assert stats['routes']['get_users_count']['admitted'] >= 1
@@ -0,0 +1,120 @@
+import database
+import main
+
+
+def post_user(client, nik_name: str):
+    response = client.post('/users/', json={'nik_name': nik_name, 'fst_name': 'Fst', 'sec_name': 'Sec'})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def test_post_and_get_user(client):
+    user = post_user(client, '@alice')
+
+    assert client.get(f"/users/{user['id']}").json()['nik_name'] == '@alice'
+    assert client.get('/users/@alice').json()['id'] == user['id']
+
+
+def test_tests_are_isolated(client):
+    assert client.get('/users/count').json() == {'Count of users': 0}
+    post_user(client, '@alice')
+    assert client.get('/users/count').json() == {'Count of users': 1}
+
+
+def test_duplicate_nik_name(client):
+    post_user(client, '@bob')
+
+    response = client.post('/users/', json={'nik_name': '@bob', 'fst_name': 'Fst', 'sec_name': 'Sec'})
+    assert response.status_code == 400
+    # The failed insert is rolled back to the savepoint, not the whole test transaction
+    assert client.get('/users/count').json() == {'Count of users': 1}
+
+
+def test_user_is_not_found(client):
+    assert client.get('/users/100500').status_code == 404
+
+
+def test_post_message_and_unread(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+
+    response = client.post('/messages/',
+                           json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': 'hello'})
+    assert response.status_code == 201, response.text
+    message = response.json()
+
+    unread = client.get(f"/users/{receiver['id']}/unread").json()
+    assert unread['Count of unread messages'] == 1
+
+    response = client.put(f"/users/{receiver['id']}/messages/read",
+                          params={'sender_id': sender['id'], 'up_to_id': message['id']})
+    assert response.json() == {'Count of read messages': 1}
+    assert client.get(f"/users/{receiver['id']}/unread").json()['Count of unread messages'] == 0
+
+
+def test_idempotency_key_replays_response(client):
+    body = {'nik_name': '@carol', 'fst_name': 'Fst', 'sec_name': 'Sec'}
+
+    first = client.post('/users/', json=body, headers={'Idempotency-Key': 'key-1'})
+    second = client.post('/users/', json=body, headers={'Idempotency-Key': 'key-1'})
+
+    assert second.status_code == 201
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.json() == first.json()
+    assert client.get('/users/count').json() == {'Count of users': 1}
+
+
+def test_delete_user(client):
+    user = post_user(client, '@dave')
+
+    assert client.delete(f"/users/{user['id']}").status_code == 200
+    assert client.get(f"/users/{user['id']}").status_code == 404
+
+
+def test_user_stats(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    other = post_user(client, '@other')
+
+    client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': 'hello'})
+    response = client.post('/messages/broadcast',
+                           json={'sender_id': sender['id'], 'text': 'hi all',
+                                 'receiver_ids': [receiver['id'], other['id']]})
+    last_id = response.json()['message_ids'][-1]
+    client.put(f"/users/{receiver['id']}/messages/read", params={'sender_id': sender['id'], 'up_to_id': last_id})
+
+    stats = client.get(f"/users/{sender['id']}/stats").json()
+    assert (stats['sent'], stats['received'], stats['unread'], stats['last_message_id']) == (3, 0, 0, last_id)
+
+    receiver_profile = client.get(f"/users/{receiver['id']}").json()
+    assert (receiver_profile['received_count'], receiver_profile['unread_count']) == (2, 0)
+    assert client.get(f"/users/{other['id']}").json()['unread_count'] == 1
+
+
+def test_statement_cache_hits(client, monkeypatch):
+    monkeypatch.setattr(database, 'ADMIN_TOKEN', 'secret')
+    post_user(client, '@erin')
+    # Statements of the lookup are compiled by the first request (in every xdist worker)
+    assert client.get('/users/@erin').status_code == 200
+    main.statement_cache_stats.reset()
+
+    for _ in range(3):
+        assert client.get('/users/@erin').status_code == 200
+
+    stats = client.get('/admin/statements/stats', headers={'X-Admin-Token': 'secret'}).json()
+    assert stats['hits'] >= 3 and stats['misses'] == 0
+    assert client.get('/admin/statements/stats').status_code == 403
+
+
+def test_cached_profile_is_invalidated(client):
+    sender = post_user(client, '@frank')
+    receiver = post_user(client, '@grace')
+    profile = client.get(f"/users/{receiver['id']}").json()
+    assert profile['received_messages'] == [] and profile['received_count'] == 0
+
+    client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': 'hello'})
+    assert client.get(f"/users/{receiver['id']}").json()['unread_count'] == 1
+
+    client.put(f"/users/{receiver['id']}", json={'fst_name': 'Renamed'})
+    assert client.get(f"/users/{receiver['id']}").json()['fst_name'] == 'Renamed'
+    assert main.access_sketch.estimate(receiver['id']) >= 3
@@ -0,0 +1,100 @@
+from sqlalchemy import create_engine, inspect
+
+import database
+import models
+from crud import archive_crud, message_crud
+from message_archiver import MessageArchiver
+from test_api import post_user
+
+
+def send(client, sender, receiver, text):
+    return client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': text}).json()
+
+
+def test_archive_keeps_inbox_and_never_reuses_ids(client, db):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    sent = [send(client, sender, receiver, str(i)) for i in range(3)]
+    client.put(f"/users/{receiver['id']}/messages/read", params={'sender_id': sender['id'], 'up_to_id': sent[-1]['id']})
+    db.query(models.Message).update({models.Message.created_at: 0})
+    db.commit()
+
+    # The newest message is archived too
+    assert MessageArchiver(database.SessionLocal, batch_size=100).archive() == 3
+    assert db.query(models.Message).count() == 0
+    inbox = client.get(f"/users/{receiver['id']}/inbox").json()
+    assert [message['id'] for message in inbox] == [message['id'] for message in reversed(sent)]
+
+    new = send(client, sender, receiver, 'new')
+    assert new['id'] > sent[-1]['id']
+    with database.SessionLocal() as session:
+        message_crud.del_message(session, session.get(models.Message, new['id']))
+    assert send(client, sender, receiver, 'newer')['id'] > new['id']
+
+
+def test_existing_messages_table_gets_autoincrement(tmp_path):
+    bind = create_engine(f"sqlite:///{tmp_path / 'legacy.sqlite3'}")
+    with bind.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE messages (id INTEGER NOT NULL PRIMARY KEY, sender_id INTEGER NOT NULL, '
+                                   'receiver_id INTEGER NOT NULL, text NVARCHAR(256) NOT NULL, status INTEGER NOT NULL)')
+        connection.exec_driver_sql("INSERT INTO messages VALUES (1, 1, 2, 'old', 1), (2, 1, 2, 'older', 0)")
+    database.init_db(bind)
+    with database.SessionLocal(bind=bind) as db:
+        db.add(models.MessageArchiveBlock(receiver_id=2, sender_id=1, first_id=5, last_id=7, count=2, data=b''))
+        db.commit()
+        archive_crud.init_message_id_sequence(db)
+
+        assert [message.text for message in db.query(models.Message).order_by(models.Message.id)] == ['old', 'older']
+        assert 'ix_messages_receiver_id_id' in {index['name'] for index in inspect(bind).get_indexes('messages')}
+        db.add(models.Message(sender_id=1, receiver_id=2, text='new'))
+        db.commit()
+        assert db.query(models.Message).filter(models.Message.text == 'new').one().id == 8
+    bind.dispose()
+
+
+def test_deleted_user_archive_is_subtracted_from_stats(client, db):
+    gone = post_user(client, '@gone')
+    other = post_user(client, '@other')
+    for i in range(3):
+        send(client, gone, other, str(i))
+    send(client, other, gone, 'reply')
+    db.add_all([models.MessageArchiveBlock(receiver_id=other['id'], sender_id=gone['id'], first_id=1, last_id=2,
+                                           count=2, data=b''),
+                models.MessageArchiveBlock(receiver_id=other['id'], sender_id=gone['id'], first_id=3, last_id=3,
+                                           count=1, data=b'')])
+    db.commit()
+
+    with database.SessionLocal() as session:
+        archive_crud.delete_user_archive(session, gone['id'])
+        session.commit()
+    stats = client.get(f"/users/{other['id']}/stats").json()
+    assert (stats['sent'], stats['received']) == (1, 0)
+
+
+def test_profile_has_history_and_counts(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    message = send(client, sender, receiver, 'hi')
+
+    profile = client.get(f"/users/{receiver['id']}").json()
+    assert [item['id'] for item in profile['received_messages']] == [message['id']]
+    assert profile['received_count'] == 1
+    history = client.get(f"/users/{receiver['id']}/messages").json()
+    assert [item['id'] for item in history['received_messages']] == [message['id']]
+    assert client.get(f"/users/{sender['id']}/messages").json()['sent_messages'][0]['id'] == message['id']
+
+
+def test_search_covers_live_messages_only(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    old = send(client, sender, receiver, 'archived harbour')
+    client.put(f"/users/{receiver['id']}/messages/read", params={'sender_id': sender['id'], 'up_to_id': old['id']})
+    with database.SessionLocal() as session:
+        session.query(models.Message).update({models.Message.created_at: 0})
+        session.commit()
+    assert MessageArchiver(database.SessionLocal, batch_size=100).archive() == 1
+    live = send(client, sender, receiver, 'live harbour')
+
+    found = client.get('/messages/search', params={'q': 'harbour'}).json()['messages']
+    assert [message['id'] for message in found] == [live['id']]
+    assert old['id'] in [message['id'] for message in client.get(f"/users/{receiver['id']}/inbox").json()]
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+import backup
+import database
+import main
+from replicas import ReplicaRouter
+
+
+def test_snapshot_and_restore(tmp_path, monkeypatch):
+    database_path = str(tmp_path / 'db.sqlite3')
+    with sqlite3.connect(database_path) as connection:
+        connection.execute('CREATE TABLE items (value BLOB)')
+        connection.executemany('INSERT INTO items VALUES (randomblob(4000))', [()] * 100)
+
+    app_engine = database.engine
+    monkeypatch.setattr(database, 'DATABASE_URL_POINTER_PATH', str(tmp_path / 'current_database'))
+    monkeypatch.setattr(database, 'engine', create_engine(f'sqlite:///{database_path}'))
+    try:
+        result = backup.snapshot(database.engine, str(tmp_path / 'backups' / 'snapshot.sqlite3'), pages=10)
+        assert result['pages'] > 100
+
+        with database.engine.begin() as connection:
+            connection.exec_driver_sql('DELETE FROM items')
+
+        restored = backup.restore(result['path'], pages=10)
+        assert database.engine.url.database != database_path
+        with database.SessionLocal() as session:
+            assert session.execute('SELECT count(*) FROM items').scalar() == 100
+        with open(database.DATABASE_URL_POINTER_PATH) as pointer:
+            assert pointer.read() == restored['url']
+    finally:
+        database.engine.dispose()
+        database.SessionLocal.configure(bind=app_engine)
+
+
+def test_admin_routes_require_token(client, monkeypatch):
+    monkeypatch.setattr(database, 'ADMIN_TOKEN', None)
+    assert client.post('/admin/snapshot', headers={'X-Admin-Token': ''}).status_code == 403
+
+    monkeypatch.setattr(database, 'ADMIN_TOKEN', 'secret')
+    assert client.post('/admin/snapshot').status_code == 403
+    assert client.post('/admin/restore', params={'snapshot': 'x'}, headers={'X-Admin-Token': 'wrong'}).status_code == 403
+    response = client.post('/admin/restore', params={'snapshot': 'missing.sqlite3'}, headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 404
+
+
+def test_restore_offline_refuses_while_app_runs(tmp_path):
+    lock_path = str(tmp_path / 'app.lock')
+    app_lock = backup.hold_app_lock(lock_path)
+    try:
+        with pytest.raises(RuntimeError):
+            backup.restore_offline(str(tmp_path / 'snapshot.sqlite3'), lock_path=lock_path)
+    finally:
+        app_lock.close()
+
+    with pytest.raises(ValueError):
+        backup.restore_offline(str(tmp_path / 'snapshot.sqlite3'), lock_path=lock_path)
+
+
+def test_restore_online_refuses_while_other_workers_run(tmp_path, client, monkeypatch):
+    lock_path = str(tmp_path / 'app.lock')
+    worker_lock, other_worker_lock = backup.hold_app_lock(lock_path), backup.hold_app_lock(lock_path)
+    try:
+        with pytest.raises(RuntimeError):
+            backup.restore_online(str(tmp_path / 'snapshot.sqlite3'), worker_lock, lock_path=lock_path)
+        monkeypatch.setattr(database, 'ADMIN_TOKEN', 'secret')
+        monkeypatch.setattr(main, 'app_lock', worker_lock)
+        response = client.post('/admin/restore', params={'snapshot': 'x'}, headers={'X-Admin-Token': 'secret'})
+        assert response.status_code == 409
+
+        other_worker_lock.close()
+        with pytest.raises(ValueError):  # Not found after the lock is taken
+            backup.restore_online(str(tmp_path / 'snapshot.sqlite3'), worker_lock, lock_path=lock_path)
+        # The worker keeps its shared lock after both attempts
+        with pytest.raises(RuntimeError):
+            backup.restore_offline(str(tmp_path / 'snapshot.sqlite3'), lock_path=lock_path)
+    finally:
+        worker_lock.close()
+        other_worker_lock.close()
+
+
+def test_replicas_are_repointed(tmp_path):
+    previous_path, primary_path = str(tmp_path / 'previous.sqlite3'), str(tmp_path / 'primary.sqlite3')
+    for path, value in ((previous_path, 1), (primary_path, 2)):
+        with sqlite3.connect(path) as connection:
+            connection.execute('CREATE TABLE items (value INTEGER)')
+            connection.execute('INSERT INTO items VALUES (?)', (value,))
+
+    readers = ReplicaRouter([f'sqlite:///file:{previous_path}?mode=ro&uri=true'])
+    snapshots = ReplicaRouter([f'sqlite:///{tmp_path / "replica.sqlite3"}'], primary_path=previous_path)
+    try:
+        snapshots.refresh()
+        for router in (readers, snapshots):
+            router.repoint(previous_path, primary_path)
+            with router.read_session(None) as session:
+                assert session.execute('SELECT value FROM items').scalar() == 2
+    finally:
+        readers.stop()
+        snapshots.stop()
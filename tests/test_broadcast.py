@@ -0,0 +1,40 @@
+from test_api import post_user
+
+
+def test_broadcast_to_receivers(client):
+    sender = post_user(client, '@sender')
+    receivers = [post_user(client, f'@receiver{i}') for i in range(3)]
+    receiver_ids = [receiver['id'] for receiver in receivers]
+
+    response = client.post('/messages/broadcast', json={'sender_id': sender['id'], 'text': 'hi all',
+                                                        'receiver_ids': receiver_ids + [receiver_ids[0], 100500]})
+    assert response.status_code == 201, response.text
+    broadcast = response.json()
+
+    # Duplicates are sent once, ids of created messages are in the order of receivers
+    assert broadcast['receiver_ids'] == receiver_ids
+    assert broadcast['missing_receiver_ids'] == [100500]
+    for receiver_id, message_id in zip(receiver_ids, broadcast['message_ids']):
+        inbox = client.get(f'/users/{receiver_id}/inbox').json()
+        assert [message['id'] for message in inbox] == [message_id]
+
+
+def test_broadcast_to_all_with_status(client):
+    sender = post_user(client, '@sender')
+    active = post_user(client, '@active')
+    idle = post_user(client, '@idle')
+    client.put(f"/users/{active['id']}", json={'status': 1})
+
+    response = client.post('/messages/broadcast', params={'to_all': True, 'receiver_status': 1},
+                           json={'sender_id': sender['id'], 'text': 'news', 'receiver_ids': []})
+    assert response.json()['receiver_ids'] == [active['id']]
+    assert client.get(f"/users/{idle['id']}/unread").json()['Count of unread messages'] == 0
+
+
+def test_broadcast_from_missing_sender(client):
+    receiver = post_user(client, '@receiver')
+
+    response = client.post('/messages/broadcast',
+                           json={'sender_id': 100500, 'text': 'hi', 'receiver_ids': [receiver['id']]})
+    assert response.status_code == 400
+    assert client.get(f"/users/{receiver['id']}/inbox").json() == []
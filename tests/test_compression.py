@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from compression import CompressedCache, CompressionMiddleware
+
+
+def test_large_json_is_compressed_in_threadpool():
+    async def items(request):
+        return JSONResponse([{'id': i, 'text': 'hello'} for i in range(int(request.query_params['count']))])
+
+    middleware = CompressionMiddleware(Starlette(routes=[Route('/items', items)]), minimum_size=1024,
+                                       threadpool_size=4096)
+    threads = []
+    compress = middleware.compress
+
+    def recording_compress(encoding, body):
+        threads.append(threading.current_thread())
+        return compress(encoding, body)
+
+    middleware.compress = recording_compress
+    client = TestClient(middleware)
+
+    small = client.get('/items', params={'count': 2}, headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in small.headers
+
+    for count in (60, 400):
+        response = client.get('/items', params={'count': count}, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['content-encoding'] == 'gzip'
+        assert len(response.json()) == count
+    # The body under threadpool_size is compressed in the event loop thread, the larger one isn't
+    assert threads[0] is not threads[1]
+
+
+def test_event_stream_start_is_not_delayed():
+    first_chunk = asyncio.Event()
+    messages = []
+
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8')]})
+        await first_chunk.wait()
+        await send({'type': 'http.response.body', 'body': b'x' * 4096, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def send(message):
+        messages.append(message)
+        first_chunk.set()
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/events', 'headers': [(b'accept-encoding', b'gzip')]}
+    asyncio.run(asyncio.wait_for(CompressionMiddleware(app, minimum_size=1024)(scope, receive, send), 1.0))
+
+    assert messages[0]['type'] == 'http.response.start'
+    assert b'content-encoding' not in dict(messages[0]['headers'])
+    assert messages[1]['body'] == b'x' * 4096
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = CompressedCache(max_bytes=100)
+    for index in range(5):
+        cache.put(('gzip', bytes([index])), b'x' * 40)
+    assert cache.size == 80 and cache.get(('gzip', bytes([0]))) is None and cache.get(('gzip', bytes([4])))
+    cache.put(('gzip', b'large'), b'x' * 101)
+    assert cache.size == 80 and cache.get(('gzip', b'large')) is None
+
+    middleware = CompressionMiddleware(Starlette(), cache_max_body=2048)
+    middleware.compress('gzip', b'a' * 4096)
+    middleware.compress('gzip', b'b' * 1024)
+    assert len(middleware.cache._items) == 1
@@ -0,0 +1,105 @@
+import asyncio
+
+import database
+import models
+from crud import idempotency_crud
+from idempotency import IdempotencyMiddleware
+from test_api import post_user
+
+
+def post_message(client, sender, receiver, client_id):
+    return client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': 'hi'},
+                       headers={'Idempotency-Key': 'same-key', 'X-Client-Id': client_id})
+
+
+def test_keys_are_scoped_by_client(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+
+    first = post_message(client, sender, receiver, 'first-client')
+    retry = post_message(client, sender, receiver, 'first-client')
+    other = post_message(client, sender, receiver, 'second-client')
+
+    assert retry.headers['Idempotent-Replayed'] == 'true' and retry.json() == first.json()
+    assert 'Idempotent-Replayed' not in other.headers and other.json()['id'] != first.json()['id']
+
+    # The same key on another route isn't a replay of the message
+    user = client.post('/users/', json={'nik_name': '@third', 'fst_name': 'Fst', 'sec_name': 'Sec'},
+                       headers={'Idempotency-Key': 'same-key', 'X-Client-Id': 'first-client'})
+    assert user.status_code == 201 and user.json()['nik_name'] == '@third'
+
+
+def test_claim_is_held_while_request_runs(db_connection):
+    claims = []
+    now = [1000000.0]
+
+    async def slow_app(scope, receive, send):
+        # The request runs for twice the pending_ttl of the clock while the key is renewed
+        for _ in range(4):
+            now[0] += 1.0
+            await asyncio.sleep(0.02)
+        # Another worker tries the same key after the pending_ttl
+        with database.SessionLocal() as db:
+            claims.append(idempotency_crud.claim_key(db, key, b'fingerprint', 2, int(now[0])))
+        await send({'type': 'http.response.start', 'status': 201, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'done'})
+
+    middleware = IdempotencyMiddleware(slow_app, session_factory=database.SessionLocal, pending_ttl=2,
+                                       renew_interval=0.005, clock=lambda: now[0])
+    scope = {'type': 'http', 'method': 'POST', 'path': '/users/', 'client': ('127.0.0.1', 1),
+             'headers': [(b'idempotency-key', b'slow')]}
+    key = middleware._scoped_key(scope, 'slow')
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'{}', 'more_body': False}
+
+    async def send(_):
+        pass
+
+    asyncio.run(middleware(scope, receive, send))
+
+    # The claim was still pending, and the response is stored now
+    assert claims[0] is not None and claims[0].status_code is None
+    with database.SessionLocal() as db:
+        assert db.get(models.IdempotencyRecord, key).status_code == 201
+
+
+def test_claim_expires_without_renewals(db_connection):
+    with database.SessionLocal() as db:
+        assert idempotency_crud.claim_key(db, 'crashed', b'fingerprint', 2, now=1000) is None
+        assert idempotency_crud.claim_key(db, 'crashed', b'other', 2, now=1001) is not None
+        assert idempotency_crud.claim_key(db, 'crashed', b'other', 2, now=1002) is None
+
+
+def test_responses_are_kept_in_process_without_database():
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope['path'])
+        await send({'type': 'http.response.start', 'status': 201, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': str(len(calls)).encode()})
+
+    middleware = IdempotencyMiddleware(app, session_factory=None)
+    scope = {'type': 'http', 'method': 'POST', 'path': '/users/', 'client': ('127.0.0.1', 1),
+             'headers': [(b'idempotency-key', b'key')]}
+
+    async def request(body):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await middleware(scope, receive, send)
+        return messages
+
+    first = asyncio.run(request(b'{}'))
+    retry = asyncio.run(request(b'{}'))
+    other_body = asyncio.run(request(b'{"other": 1}'))
+
+    assert calls == ['/users/']
+    assert first[-1]['body'] == b'1' and retry[-1]['body'] == b'1'
+    assert (b'idempotent-replayed', b'true') in retry[0]['headers']
+    assert other_body[0]['status'] == 422
@@ -0,0 +1,41 @@
+import asyncio
+
+import schemas
+from pubsub import InboxNotifier
+from test_api import post_user
+
+
+def message(message_id: int, receiver_id: int = 2) -> schemas.Message.Get:
+    return schemas.Message.Get(id=message_id, sender_id=1, receiver_id=receiver_id, text='hi', status=0)
+
+
+def test_inbox_notifier_wakes_waiter():
+    async def scenario():
+        notifier = InboxNotifier()
+
+        async def nothing_stored():
+            return []
+
+        waiter = asyncio.create_task(notifier.wait(2, after_id=1, timeout=1.0, check=nothing_stored))
+        await asyncio.sleep(0)
+        notifier.notify([message(1), message(2), message(3, receiver_id=3)])
+        woken = await waiter
+        timed_out = await notifier.wait(2, after_id=5, timeout=0.01, check=nothing_stored)
+        return woken, timed_out, notifier.waiters_count()
+
+    woken, timed_out, waiters = asyncio.run(scenario())
+    assert [item.id for item in woken] == [2]
+    assert timed_out == [] and waiters == 0
+
+
+def test_wait_inbox_returns_stored_or_times_out(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    message_id = client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'],
+                                                 'text': 'hello'}).json()['id']
+
+    stored = client.get(f"/users/{receiver['id']}/inbox/wait", params={'after': 0, 'timeout': 5}).json()
+    assert [item['id'] for item in stored] == [message_id]
+
+    empty = client.get(f"/users/{receiver['id']}/inbox/wait", params={'after': message_id, 'timeout': 0.05})
+    assert empty.json() == []
@@ -0,0 +1,121 @@
+import pytest
+
+import schemas
+from crud.memory_storage import MemoryStorage
+
+
+def create_user(storage: MemoryStorage, nik_name: str) -> schemas.User.Get:
+    return storage.post_user(schemas.User.Create(nik_name=nik_name, fst_name='Fst', sec_name='Sec'))
+
+
+def test_users_and_messages():
+    storage = MemoryStorage()
+    sender = create_user(storage, '@sender')
+    receiver = create_user(storage, '@receiver')
+
+    with pytest.raises(ValueError):
+        create_user(storage, '@sender')
+    assert storage.get_user_id('@receiver') == receiver.id
+
+    message = storage.post_message(schemas.Message.Create(sender_id=sender.id, receiver_id=receiver.id, text='hi'))
+    assert storage.get_unread_counts(receiver.id) == {sender.id: 1}
+    assert storage.mark_messages_read(receiver.id, sender.id, message.id) == 1
+    assert storage.get_unread_counts(receiver.id) == {}
+
+    profile = storage.get_user(receiver.id)
+    assert [received.id for received in storage.get_user_messages(receiver.id).received_messages] == [message.id]
+    assert (profile.received_count, profile.unread_count, profile.last_message_id) == (1, 0, message.id)
+
+    storage.del_user(sender.id)
+    assert storage.get_users_count() == 1
+    assert storage.get_user_messages(receiver.id).received_messages == []
+
+
+def test_log_is_replayed(tmp_path):
+    log_path = str(tmp_path / 'memory.log')
+    storage = MemoryStorage(log_path=log_path)
+    user = create_user(storage, '@user')
+    storage.put_user(user.id, schemas.User.Edit(nik_name='@renamed', fst_name='Fst', sec_name='Sec', status=1))
+    storage.post_message(schemas.Message.Create(sender_id=user.id, receiver_id=user.id, text='note'))
+    storage.close()
+
+    restored = MemoryStorage(log_path=log_path)
+    assert restored.get_user(user.id) == storage.get_user(user.id)
+    assert restored.get_user_id('@renamed') == user.id
+    assert create_user(restored, '@next').id == user.id + 1
+
+
+def test_delete_and_partial_read_keep_counters():
+    storage = MemoryStorage()
+    first = create_user(storage, '@first')
+    second = create_user(storage, '@second')
+    third = create_user(storage, '@third')
+
+    to_second = [storage.post_message(schemas.Message.Create(sender_id=first.id, receiver_id=second.id, text=str(i)))
+                 for i in range(5)]
+    kept = storage.post_message(schemas.Message.Create(sender_id=third.id, receiver_id=second.id, text='kept'))
+    storage.post_message(schemas.Message.Create(sender_id=second.id, receiver_id=first.id, text='reply'))
+
+    assert storage.mark_messages_read(second.id, first.id, to_second[1].id) == 2
+    assert storage.mark_messages_read(second.id, first.id, to_second[1].id) == 0
+    assert storage.get_unread_counts(second.id) == {first.id: 3, third.id: 1}
+
+    storage.del_user(first.id)
+    assert storage.get_unread_counts(second.id) == {third.id: 1}
+    stats = storage.get_user_stats(second.id)
+    assert (stats.sent, stats.received, stats.unread) == (0, 1, 1)
+    assert [message.id for message in storage.get_inbox(second.id)] == [kept.id]
+
+
+def test_inbox_and_messages_after():
+    storage = MemoryStorage()
+    sender = create_user(storage, '@sender')
+    receiver = create_user(storage, '@receiver')
+    ids = [storage.post_message(schemas.Message.Create(sender_id=sender.id, receiver_id=receiver.id, text=str(i))).id
+           for i in range(5)]
+
+    assert [message.id for message in storage.get_messages_after(receiver.id, ids[1], limit=2)] == ids[2:4]
+    assert [message.id for message in storage.get_inbox(receiver.id, before_id=ids[3], limit=2)] == [ids[2], ids[1]]
+    assert storage.get_inbox(sender.id) == []
+
+
+def test_whole_database_routes_are_not_available(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, 'memory_storage', MemoryStorage())
+
+    assert client.get('/users/search', params={'q': 'a'}).status_code == 501
+    assert client.get('/messages/search', params={'q': 'a'}).status_code == 501
+    assert client.post('/messages/broadcast', json={'sender_id': 1, 'text': 'hi'}).status_code == 501
+
+
+def test_torn_write_is_cut_off_the_log(tmp_path):
+    log_path = str(tmp_path / 'memory.log')
+    storage = MemoryStorage(log_path=log_path)
+    create_user(storage, '@first')
+    storage.close()
+    with open(log_path, 'a', encoding='utf-8') as log:
+        log.write('{"op":"user","id":2,"nik_na')
+
+    restarted = MemoryStorage(log_path=log_path)
+    create_user(restarted, '@second')
+    restarted.close()
+
+    restarted_again = MemoryStorage(log_path=log_path)
+    assert restarted_again.get_users_count() == 2
+    assert restarted_again.get_user_id('@second') == 2
+    create_user(restarted_again, '@third')
+    restarted_again.close()
+    assert MemoryStorage(log_path=log_path).get_users_count() == 3
+
+
+def test_startup_does_not_open_the_database(monkeypatch):
+    import main
+
+    def fail(*_, **__):
+        raise AssertionError('the database is opened')
+
+    monkeypatch.setattr(main, 'memory_storage', MemoryStorage())
+    monkeypatch.setattr(main.backup, 'hold_app_lock', fail)
+    monkeypatch.setattr(main, 'init_database', fail)
+    main.start_database()
+    assert main.app_lock is None
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import socket
+
+import database
+import schemas
+from crud.storage import SQLAlchemyStorage
+from pubsub import MessageHub, message_stream
+from test_api import post_user
+
+
+def message(message_id: int, receiver_id: int = 2) -> schemas.Message.Get:
+    return schemas.Message.Get(id=message_id, sender_id=1, receiver_id=receiver_id, text='hi', status=0)
+
+
+def test_hub_delivers_to_subscribers_and_listeners():
+    async def scenario():
+        hub = MessageHub(queue_size=4)
+        delivered = []
+        hub.add_listener(delivered.extend)
+        await hub.start()
+
+        subscription = hub.subscribe(2)
+        other = hub.subscribe(3)
+        hub.publish([message(1), message(2)])
+        received = [await subscription.queue.get(), await subscription.queue.get()]
+
+        hub.publish([message(i) for i in range(3, 10)])
+        await asyncio.sleep(0)
+        hub.unsubscribe(subscription)
+        hub.unsubscribe(other)
+        await hub.stop()
+        return received, other.queue.empty(), subscription.lagged, len(delivered), hub.subscribers_count()
+
+    received, other_is_empty, lagged, delivered, subscribers = asyncio.run(scenario())
+    assert [item.id for item in received] == [1, 2]
+    assert other_is_empty and lagged
+    assert delivered == 9 and subscribers == 0
+
+
+def test_stale_peer_is_forgotten(tmp_path):
+    peer_dir = str(tmp_path)
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(os.path.join(peer_dir, 'stale.sock'))
+    stale.close()
+
+    async def scenario():
+        hub = MessageHub(peer_dir=peer_dir)
+        await hub.start()
+        hub.publish([message(1)])
+        await hub.stop()
+
+    asyncio.run(scenario())
+    assert os.listdir(peer_dir) == []
+
+
+def test_message_stream_resumes_and_skips_duplicates(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    stored_ids = [
+        client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': str(i)})
+        .json()['id']
+        for i in range(3)
+    ]
+
+    def load_after(after_id, limit):
+        with database.SessionLocal() as db:
+            return SQLAlchemyStorage(db).get_messages_after(receiver['id'], after_id, limit)
+
+    async def scenario():
+        hub = MessageHub()
+        await hub.start()
+        stream = message_stream(hub, load_after, receiver['id'], after_id=stored_ids[0], batch=2)
+        ids = [(await stream.__anext__()).id for _ in range(2)]
+
+        # A stored message published again and a new one
+        hub.publish([message(stored_ids[2], receiver['id']), message(stored_ids[2] + 1, receiver['id'])])
+        ids.append((await stream.__anext__()).id)
+        await stream.aclose()
+        await hub.stop()
+        return ids
+
+    assert asyncio.run(scenario()) == stored_ids[1:] + [stored_ids[2] + 1]
+
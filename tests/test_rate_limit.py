@@ -0,0 +1,84 @@
+import asyncio
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from rate_limit import InProcessBuckets, Limit, RateLimitMiddleware, SharedMemoryBuckets
+
+
+def test_tokens_are_taken_only_if_all_buckets_have_them():
+    buckets = InProcessBuckets()
+    route, client = ('get_users|ip:1', Limit(rate=0.001, burst=1)), ('*|ip:1', Limit(rate=0.001, burst=3))
+
+    assert buckets.take_all([route, client])[0] is None
+    denied, tokens = buckets.take_all([route, client])
+    assert denied == 0
+    # The rejected request didn't spend the token of the client bucket
+    assert int(tokens[1]) == 2
+    assert buckets.take_all([('other|ip:1', Limit(rate=0.001, burst=1)), client])[0] is None
+
+
+def test_route_bucket_is_keyed_by_caller():
+    async def get_user(_):
+        return PlainTextResponse('user')
+
+    app = Starlette(routes=[Route('/users/{user_identifier}', get_user, name='get_user')])
+    middleware = RateLimitMiddleware(app, route_limits={'get_user': Limit(rate=0.001, burst=1)})
+
+    def request(path, address):
+        statuses = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                 'query_string': b'', 'headers': [], 'client': (address, 1), 'server': ('testserver', 80),
+                 'scheme': 'http', 'http_version': '1.1', 'app': app}
+        asyncio.run(middleware(scope, receive, send))
+        return statuses[0]
+
+    assert request('/users/1', '10.0.0.1') == 200
+    # Other users are not a way around the limit of the caller
+    assert request('/users/2', '10.0.0.1') == 429
+    assert request('/users/1', '10.0.0.2') == 200
+
+
+def test_idle_buckets_are_evicted_by_their_own_limit():
+    buckets = InProcessBuckets(max_keys=2)
+    slow, fast = Limit(rate=0.001, burst=1), Limit(rate=1000.0, burst=1)
+    buckets.take('slow|ip:1', slow)
+    buckets.take('fast|ip:1', fast)
+    time.sleep(0.01)
+
+    # The fast bucket is full again, the slow one is not and keeps its state
+    buckets.take('new|ip:1', fast)
+    assert buckets.take('slow|ip:1', slow)[0] is False
+
+
+def test_shared_memory_buckets_are_shared_between_instances(tmp_path):
+    name = f'fastapi_test_rate_limit_{uuid.uuid4().hex[:8]}'
+    first = SharedMemoryBuckets(name, str(tmp_path / 'rate_limit.lock'), slots=64)
+    second = SharedMemoryBuckets(name, str(tmp_path / 'rate_limit.lock'), slots=64)
+    limit = Limit(rate=0.001, burst=2)
+    try:
+        assert first.take('get_users|ip:1', limit)[0]
+        assert second.take('get_users|ip:1', limit)[0]
+        assert not first.take('get_users|ip:1', limit)[0]
+        assert second.take('get_users|ip:2', limit)[0]
+
+        denied, _ = second.take_all([('get_users|ip:2', limit), ('*|ip:1', limit)])
+        assert denied is None
+        assert first.take_all([('get_users|ip:2', limit), ('*|ip:1', limit)])[0] == 0
+        # The rejected request didn't spend the token of the client bucket
+        assert first.take('*|ip:1', limit)[0]
+    finally:
+        second.close()
+        first.close()
+        first.unlink()
@@ -0,0 +1,34 @@
+import database
+import models
+from test_api import post_user
+from user_reaper import UserReaper
+
+
+def test_deleted_nik_name_is_released(client):
+    user = post_user(client, '@dave')
+    assert client.delete(f"/users/{user['id']}").json()['nik_name'] == '@dave'
+
+    again = post_user(client, '@dave')
+    assert again['id'] != user['id']
+    assert client.get('/users/@dave').json()['id'] == again['id']
+
+
+def test_reaper_removes_user_and_messages_in_batches(client, db):
+    user = post_user(client, '@gone')
+    other = post_user(client, '@other')
+    for i in range(5):
+        client.post('/messages/', json={'sender_id': user['id'], 'receiver_id': other['id'], 'text': str(i)})
+    client.post('/messages/', json={'sender_id': other['id'], 'receiver_id': user['id'], 'text': 'reply'})
+    client.delete(f"/users/{user['id']}")
+
+    reaper = UserReaper(database.SessionLocal, batch_size=2)
+    rounds = 0
+    while reaper.reap():
+        rounds += 1
+    assert rounds >= 3 and reaper.purged_users == 1
+
+    assert db.get(models.User, user['id']) is None
+    assert db.query(models.Message).count() == 0
+    assert client.get(f"/users/{other['id']}/unread").json()['Count of unread messages'] == 0
+    stats = client.get(f"/users/{other['id']}/stats").json()
+    assert (stats['sent'], stats['received']) == (0, 0)
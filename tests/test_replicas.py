@@ -0,0 +1,64 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+import database
+import main
+from replicas import ReplicaRouter
+from test_api import post_user
+
+
+@pytest.fixture
+def replica_client(client, tmp_path, monkeypatch):
+    """
+    Client reading from an empty snapshot replica unless it has written recently
+    """
+    replica_path = tmp_path / 'replica.sqlite3'
+    replica_engine = create_engine(f'sqlite:///{replica_path}')
+    main.init_database(replica_engine)
+    replica_engine.dispose()
+
+    router = ReplicaRouter([f'sqlite:///{replica_path}'], pin_window=60.0)
+    monkeypatch.setattr(main, 'replica_router', router)
+    monkeypatch.setattr(main, 'write_pin', router.write_pin)
+    main.app.dependency_overrides.pop(main.Dependencies.get_read_db)
+    yield client
+    router.stop()
+
+
+def test_pin_by_last_write_time():
+    router = ReplicaRouter(['sqlite://'], pin_window=5.0)
+    assert router.is_pinned(router.pin())
+    assert not router.is_pinned(f'{time.time() - 10:.3f}')
+    assert not router.is_pinned(None) and not router.is_pinned('garbage')
+
+    # Unsigned, forged or far future times don't pin
+    last_write_at = f'{time.time():.3f}'
+    assert not router.is_pinned(last_write_at)
+    assert not router.is_pinned(f'{last_write_at}:{"0" * 64}')
+    for forged in ('1e12', 'inf', 'nan'):
+        assert not router.is_pinned(f'{forged}:{router._sign(forged)}')
+    assert not ReplicaRouter(['sqlite://'], pin_window=5.0).is_pinned(router.pin())
+    assert router.read_session(router.pin()) is None
+    with router.read_session(None) as db:
+        assert db.get_bind() is router.engines[0]
+
+
+def test_writer_reads_its_writes_from_primary(replica_client):
+    user = post_user(replica_client, '@writer')
+    assert ReplicaRouter.PIN_COOKIE in replica_client.cookies
+    assert replica_client.get(f"/users/{user['id']}").status_code == 200
+
+    # Without the cookie the user is resolved on the replica, which doesn't have it yet
+    replica_client.cookies.clear()
+    assert replica_client.get(f"/users/{user['id']}").status_code == 404
+    assert replica_client.get('/users/@writer/stats').status_code == 404
+
+
+def test_secret_is_shared_through_the_file(tmp_path, monkeypatch):
+    monkeypatch.delenv('FASTAPI_TEST_PIN_SECRET', raising=False)
+    monkeypatch.setattr(database, 'READ_YOUR_WRITES_SECRET_PATH', str(tmp_path / 'pin_secret'))
+    secret = database.read_your_writes_secret()
+    assert len(secret) == 32 and database.read_your_writes_secret() == secret
+    assert ReplicaRouter(['sqlite://'], secret=secret).is_pinned(ReplicaRouter(['sqlite://'], secret=secret).pin())
@@ -0,0 +1,34 @@
+from test_api import post_user
+
+
+def send(client, sender_id: int, receiver_id: int, text: str) -> int:
+    return client.post('/messages/', json={'sender_id': sender_id, 'receiver_id': receiver_id, 'text': text}).json()['id']
+
+
+def test_message_search_pages_with_cursor(client):
+    sender = post_user(client, '@sender')
+    receiver = post_user(client, '@receiver')
+    other = post_user(client, '@other')
+    matching = [send(client, sender['id'], receiver['id'], f'meeting number {i}') for i in range(5)]
+    send(client, sender['id'], receiver['id'], 'lunch')
+    send(client, sender['id'], other['id'], 'meeting elsewhere')
+
+    found, cursor = [], None
+    while True:
+        params = {'q': 'meet', 'receiver_id': receiver['id'], 'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        page = client.get('/messages/search', params=params).json()
+        found += [message['id'] for message in page['messages']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert sorted(found) == matching and len(found) == len(set(found))
+    whole_words = client.get('/messages/search', params={'q': 'meet', 'prefix': False}).json()
+    assert whole_words['messages'] == []
+
+
+def test_message_search_errors(client):
+    assert client.get('/messages/search', params={'q': 'word', 'cursor': 'broken'}).status_code == 400
+    assert client.get('/messages/search', params={'q': '"*'}).json() == {'messages': [], 'next_cursor': ''}
@@ -0,0 +1,94 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import models
+import sharding
+from sharding import DeletedUserEntry, ShardRouter
+from test_api import post_user
+from user_reaper import UserReaper
+
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    shard_router = ShardRouter([f"sqlite:///{tmp_path / f'shard_{shard}.sqlite3'}" for shard in range(2)],
+                               f"sqlite:///{tmp_path / 'directory.sqlite3'}")
+    shard_router.init_db()
+    monkeypatch.setattr(main, 'shard_router', shard_router)
+    # Shards write messages themselves, there is no batcher with shards
+    monkeypatch.setattr(main, 'message_write_batcher', None)
+    main.rate_limit_buckets.clear()
+    main.profile_cache.clear()
+    yield shard_router
+    shard_router.close()
+
+
+@pytest.fixture
+def sharded_client(router):
+    return TestClient(main.app)
+
+
+def send(client, sender, receiver, text):
+    response = client.post('/messages/', json={'sender_id': sender['id'], 'receiver_id': receiver['id'], 'text': text})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def test_messages_are_routed_to_shards_of_receivers(router, sharded_client):
+    first = post_user(sharded_client, '@first')
+    second = post_user(sharded_client, '@second')
+    assert router.shard_of(first['id']) != router.shard_of(second['id'])
+
+    to_second = send(sharded_client, first, second, 'hi')
+    to_first = send(sharded_client, second, first, 'hello')
+    # Sequences of shards don't overlap
+    assert to_second['id'] != to_first['id']
+    assert {to_second['id'] >> ShardRouter.MESSAGE_ID_BITS, to_first['id'] >> ShardRouter.MESSAGE_ID_BITS} == {0, 1}
+
+    unread = sharded_client.get(f"/users/{first['id']}/unread").json()
+    assert unread['Senders'] == {str(second['id']): 1}
+    assert [message['id'] for message in sharded_client.get(f"/users/{first['id']}/inbox").json()] == [to_first['id']]
+    marked = sharded_client.put(f"/users/{first['id']}/messages/read",
+                                params={'sender_id': second['id'], 'up_to_id': to_first['id']})
+    assert marked.json() == {'Count of read messages': 1}
+    assert sharded_client.get(f"/users/{first['id']}/unread").json()['Count of unread messages'] == 0
+
+    waited = sharded_client.get(f"/users/{second['id']}/inbox/wait", params={'timeout': 0})
+    assert [message['id'] for message in waited.json()] == [to_second['id']]
+
+    assert sharded_client.post('/messages/broadcast', json={'sender_id': first['id'], 'text': 'all',
+                                                            'receiver_ids': [second['id']]}).status_code == 501
+
+
+def test_failed_shard_update_keeps_directory_nik_name(router, sharded_client, monkeypatch):
+    user = post_user(sharded_client, '@user')
+
+    def fail(*_, **__):
+        raise ValueError(None, 'update user with a data error')
+
+    monkeypatch.setattr(sharding.user_crud, 'put_user', fail)
+    assert sharded_client.put(f"/users/{user['id']}", json={'nik_name': '@renamed'}).status_code == 400
+    assert router.get_user_id_by_nik_name('@user') == user['id']
+    with pytest.raises(ValueError):
+        router.get_user_id_by_nik_name('@renamed')
+
+
+def test_reaper_removes_messages_of_deleted_user_from_all_shards(router, sharded_client):
+    gone = post_user(sharded_client, '@gone')
+    other = post_user(sharded_client, '@other')
+    send(sharded_client, gone, other, 'sent')
+    send(sharded_client, other, gone, 'received')
+    sharded_client.delete(f"/users/{gone['id']}")
+
+    reaper = UserReaper(None, batch_size=10, shard_router=router)
+    while reaper.reap():
+        pass
+    assert reaper.purged_users == 1
+
+    for session in router.sessions:
+        with session() as db:
+            assert db.query(models.Message).count() == 0
+            assert db.get(models.User, gone['id']) is None
+    with router.directory_session() as directory:
+        assert directory.query(DeletedUserEntry).count() == 0
+    assert router.get_user_stats(other['id']).sent == 0
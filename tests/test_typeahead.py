@@ -0,0 +1,39 @@
+from crud import search_crud
+from crud.search_crud import _prefix_upper_bound
+from test_api import post_user
+
+
+def nik_names(client, **params):
+    return [user['nik_name'] for user in client.get('/users/search', params=params).json()]
+
+
+def test_prefix_and_fuzzy_search(client):
+    for nik_name in ('@anna', '@annette', '@bob', '@joanna'):
+        post_user(client, nik_name)
+
+    assert nik_names(client, q='ann') == ['@anna', '@annette']
+    assert nik_names(client, q='@ann', limit=1) == ['@anna']
+    assert nik_names(client, q='anna', fuzzy=True) == ['@anna', '@joanna']
+    assert nik_names(client, q='') == []
+
+
+def test_cache_is_cleared_by_changes(client):
+    post_user(client, '@anna')
+    assert nik_names(client, q='an') == ['@anna']
+
+    user = post_user(client, '@andrew')
+    assert nik_names(client, q='an') == ['@andrew', '@anna']
+    client.delete(f"/users/{user['id']}")
+    assert nik_names(client, q='an') == ['@anna']
+
+
+def test_prefix_upper_bound_edges(client, db):
+    assert _prefix_upper_bound('@ab') == '@ac'
+    assert _prefix_upper_bound('@a\U0010FFFF') == '@b'
+    assert _prefix_upper_bound('@a\ud7ff') == '@a\ue000'
+    assert _prefix_upper_bound('\U0010FFFF') is None
+
+    post_user(client, '@anna')
+    assert nik_names(client, q='a\U0010FFFF') == []
+    assert nik_names(client, q='a\ud7ff') == []
+    assert search_crud.search_users_by_prefix(db, 'a\ud800') == []
@@ -0,0 +1,43 @@
+import models
+from crud import message_crud
+from test_api import post_user
+
+
+def send(client, sender_id: int, receiver_id: int, text: str = 'hello') -> int:
+    response = client.post('/messages/', json={'sender_id': sender_id, 'receiver_id': receiver_id, 'text': text})
+    assert response.status_code == 201, response.text
+    return response.json()['id']
+
+
+def test_unread_counts_per_sender_and_partial_read(client):
+    receiver = post_user(client, '@receiver')
+    first = post_user(client, '@first')
+    second = post_user(client, '@second')
+    first_ids = [send(client, first['id'], receiver['id']) for _ in range(3)]
+    send(client, second['id'], receiver['id'])
+
+    unread = client.get(f"/users/{receiver['id']}/unread").json()
+    assert unread == {'Count of unread messages': 4, 'Senders': {str(first['id']): 3, str(second['id']): 1}}
+
+    response = client.put(f"/users/{receiver['id']}/messages/read",
+                          params={'sender_id': first['id'], 'up_to_id': first_ids[1]})
+    assert response.json() == {'Count of read messages': 2}
+    # Messages are read once
+    response = client.put(f"/users/{receiver['id']}/messages/read",
+                          params={'sender_id': first['id'], 'up_to_id': first_ids[1]})
+    assert response.json() == {'Count of read messages': 0}
+
+    unread = client.get(f"/users/{receiver['id']}/unread").json()
+    assert unread == {'Count of unread messages': 2, 'Senders': {str(first['id']): 1, str(second['id']): 1}}
+
+
+def test_counters_match_rebuild(client, db):
+    receiver = post_user(client, '@receiver')
+    sender = post_user(client, '@sender')
+    message_ids = [send(client, sender['id'], receiver['id']) for _ in range(3)]
+    client.put(f"/users/{receiver['id']}/messages/read", params={'sender_id': sender['id'], 'up_to_id': message_ids[0]})
+
+    counters = {(row.receiver_id, row.sender_id): row.count for row in db.query(models.UnreadCounter)}
+    message_crud.rebuild_unread_counters(db)
+    assert {(row.receiver_id, row.sender_id): row.count for row in db.query(models.UnreadCounter)} == counters
+    assert counters[(receiver['id'], sender['id'])] == 2
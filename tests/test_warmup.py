@@ -0,0 +1,74 @@
+import random
+
+import database
+import main
+import models
+from test_api import post_user
+from warmup import AccessSketch, ProfileCache
+
+
+def test_access_sketch_top_and_persistence(tmp_path):
+    path = str(tmp_path / 'access_sketch.json')
+    sketch = AccessSketch(path, width=256, depth=4, top_n=3)
+    for user_id, reads in ((1, 2), (2, 40), (3, 10), (4, 30), (5, 1)):
+        for _ in range(reads):
+            sketch.record(user_id)
+
+    assert sketch.top() == [2, 4, 3]
+    assert sketch.estimate(2) >= 40
+    sketch.stop()
+
+    restored = AccessSketch(path, width=256, depth=4, top_n=3)
+    assert restored.top(2) == [2, 4]
+    assert restored.estimate(2) >= 20  # Counts are halved on load
+
+
+def test_access_sketch_evicts_the_least_read():
+    sketch = AccessSketch(width=65536, depth=4, top_n=10)
+    reads = {}
+    generator = random.Random(1)
+    for _ in range(5000):
+        user_id = int(generator.paretovariate(1.2))
+        reads[user_id] = reads.get(user_id, 0) + 1
+        sketch.record(user_id)
+
+    assert len(sketch._top_heap) <= 2 * sketch.top_n
+    assert sketch.top(3) == sorted(reads, key=reads.get, reverse=True)[:3]
+
+
+def test_profile_cache_skips_puts_older_than_invalidations():
+    cache = ProfileCache(max_size=2)
+    version = cache.version()
+    cache.invalidate([1])
+    cache.put(1, 'stale', version)
+    cache.put(2, 'fresh', version)
+    assert (cache.get(1), cache.get(2)) == (None, 'fresh')
+
+    # Keys dropped from the invalidation log are treated as invalidated at the oldest kept version
+    version = cache.version()
+    cache.invalidate([3])
+    cache.invalidate([4])
+    cache.invalidate([5])
+    cache.put(1, 'loaded before', version)
+    assert cache.get(1) is None
+    cache.put(1, 'loaded after', cache.version())
+    assert cache.get(1) == 'loaded after'
+
+
+def test_pinned_client_skips_profile_cache(client, monkeypatch):
+    user = post_user(client, '@user')
+    client.cookies.clear()
+    assert client.get(f"/users/{user['id']}").json()['fst_name'] == 'Fst'
+
+    # Another worker updates the user, the cache of this worker is not invalidated
+    with database.SessionLocal() as session:
+        session.query(models.User).filter(models.User.id == user['id']).update({models.User.fst_name: 'Renamed'})
+        session.commit()
+    assert client.get(f"/users/{user['id']}").json()['fst_name'] == 'Fst'
+    # The writer is pinned by the cookie of the other worker
+    client.cookies.set(main.WritePin.COOKIE, main.write_pin.pin())
+    assert client.get(f"/users/{user['id']}").json()['fst_name'] == 'Renamed'
+
+    assert client.get('/admin/profiles/stats').status_code == 403
+    monkeypatch.setattr(database, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/profiles/stats', headers={'X-Admin-Token': 'secret'}).json()['size'] >= 1
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import database
+import main
+import models
+import schemas
+from write_batcher import MessageWriteBatcher
+
+
+@pytest.fixture
+def file_engine(tmp_path):
+    bind = create_engine(f"sqlite:///{tmp_path / 'batcher.sqlite3'}", connect_args={'check_same_thread': False},
+                         poolclass=StaticPool)
+    main.init_database(bind)
+    with database.SessionLocal(bind=bind) as db:
+        db.add_all([models.User(nik_name='@sender', fst_name='Fst', sec_name='Sec'),
+                    models.User(nik_name='@receiver', fst_name='Fst', sec_name='Sec')])
+        db.commit()
+    yield bind
+    bind.dispose()
+
+
+def test_concurrent_sends_are_group_committed(file_engine):
+    batcher = MessageWriteBatcher(sessionmaker(autocommit=False, autoflush=False, bind=file_engine), max_batch=64,
+                                  max_delay=0.05, synchronous='OFF')
+    batcher.start()
+    try:
+        with ThreadPoolExecutor(16) as pool:
+            messages = list(pool.map(
+                batcher.send, [schemas.Message.Create(sender_id=1, receiver_id=2, text=str(i)) for i in range(32)]
+            ))
+        with pytest.raises(ValueError):
+            batcher.send(schemas.Message.Create(sender_id=1, receiver_id=100500, text='nobody'))
+    finally:
+        batcher.stop()
+
+    assert sorted(message.id for message in messages) == list(range(1, 33))
+    assert batcher.messages == 32 and batcher.batches < 32
+
+    # The pragma of the writer is not left on the pooled connection
+    with file_engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 2
+
+
+def test_post_message_is_admitted(client):
+    for nik_name in ('@sender', '@receiver'):
+        client.post('/users/', json={'nik_name': nik_name, 'fst_name': 'Fst', 'sec_name': 'Sec'})
+    client.post('/messages/', json={'sender_id': 1, 'receiver_id': 2, 'text': 'hello'})
+
+    assert client.get('/admission/stats').json()['routes']['post_message']['admitted'] >= 1
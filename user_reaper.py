@@ -0,0 +1,97 @@
+import threading
+from typing import Callable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from crud import user_crud
+from sharding import ShardRouter
+
+
+class UserReaper:
+    """
+    Background thread removing soft deleted users: messages of a user are deleted in bounded batches
+    (one short transaction each), then the user row itself
+
+    Example::
+
+        reaper = UserReaper(SessionLocal, batch_size=500, interval=1.0)
+        reaper.start()
+        ...
+        reaper.stop()
+
+    :param session_factory: creates sessions of the reaper
+    :param batch_size: max count of messages deleted in one transaction
+    :param interval: seconds to sleep when there is nothing to remove
+    :param shard_router: removes users deleted from the directory on all shards instead of the session_factory database
+    """
+
+    def __init__(self,
+                 session_factory: Callable[[], Session],
+                 batch_size: int = 500,
+                 interval: float = 1.0,
+                 shard_router: Optional[ShardRouter] = None):
+        self.session_factory = session_factory
+        self.shard_router = shard_router
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.purged_users = 0
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='user-reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def wake(self) -> None:
+        """
+        Makes the reaper check soft deleted users without waiting for the interval
+        """
+        self._wake.set()
+
+    def reap(self) -> bool:
+        """
+        Processes one batch of every soft deleted user found
+
+        :return: True if there is something left to remove
+        """
+        if self.shard_router is not None:
+            return self._purge(self.shard_router.get_deleted_user_ids(),
+                               lambda user_id: self.shard_router.purge_deleted_user(user_id, self.batch_size))
+
+        with self.session_factory() as db:
+            return self._purge(user_crud.get_deleted_user_ids(db),
+                               lambda user_id: user_crud.purge_deleted_user(db, user_id, self.batch_size))
+
+    def _purge(self, user_ids: List[int], purge_user: Callable[[int], bool]) -> bool:
+        for user_id in user_ids:
+            if self._stop.is_set():
+                return True
+            if purge_user(user_id):
+                self.purged_users += 1
+        return bool(user_ids)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                busy = self.reap()
+            except Exception as e:
+                print(e)
+                busy = False
+
+            if not busy:
+                self._wake.wait(self.interval)
+                self._wake.clear()
@@ -0,0 +1,278 @@
+import heapq
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from fastapi import FastAPI
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import configure_mappers
+
+import schemas
+
+
+class AccessSketch:
+    """
+    Approximate read counts of user profiles: a count-min sketch (depth rows of width counters)
+    and the top_n most read ids with their estimates. Memory doesn't grow with the count of users.
+    The least read of the top ids is found by a heap of (estimate, id) with outdated entries dropped lazily
+    With path the sketch is loaded on creation (counts are halved, so old popularity fades)
+    and saved every save_interval seconds by a background thread and on stop.
+    Worker processes share the file, the last saved sketch wins
+
+    Example::
+
+        sketch = AccessSketch('dbs/access_sketch.json', top_n=100)
+        sketch.start()
+        sketch.record(user_id)
+        sketch.top(10)  # the most read user ids
+
+    :param path: path of the saved sketch, None to keep it in memory only
+    :param width: counters per row
+    :param depth: rows (hash functions)
+    :param top_n: count of tracked most read ids
+    :param save_interval: seconds between saves
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 width: int = 4096,
+                 depth: int = 4,
+                 top_n: int = 100,
+                 save_interval: float = 60.0):
+        self.path = path
+        self.width = width
+        self.depth = depth
+        self.top_n = top_n
+        self.save_interval = save_interval
+
+        # Fixed coefficients, so hashes of a saved sketch are the same in every process
+        self._hashes = [(0x9E3779B97F4A7C15 * (row + 1) % self._PRIME, 0x632BE59BD9B4E019 * (row + 1) % self._PRIME)
+                        for row in range(depth)]
+        self._rows: List[List[int]] = [[0] * width for _ in range(depth)]
+        self._top: Dict[int, int] = {}
+        self._top_heap: List[Tuple[int, int]] = []
+        self._lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                self._load(path)
+            except (ValueError, KeyError) as e:  # A damaged or an incompatible sketch is started over
+                print(e)
+
+    # ----------
+    #  Counting
+    # ----------
+    def _columns(self, key: int) -> List[int]:
+        return [((a * key + b) % self._PRIME) % self.width for a, b in self._hashes]
+
+    def record(self, key: int) -> None:
+        with self._lock:
+            estimate = None
+            for row, column in zip(self._rows, self._columns(key)):
+                row[column] += 1
+                estimate = row[column] if estimate is None else min(estimate, row[column])
+
+            if key not in self._top and len(self._top) >= self.top_n:
+                # Estimates only grow, so an entry is outdated if its id has another estimate now
+                while self._top.get(self._top_heap[0][1]) != self._top_heap[0][0]:
+                    heapq.heappop(self._top_heap)
+                if estimate <= self._top_heap[0][0]:
+                    return
+                del self._top[heapq.heappop(self._top_heap)[1]]
+
+            self._top[key] = estimate
+            heapq.heappush(self._top_heap, (estimate, key))
+            if len(self._top_heap) > 2 * self.top_n:
+                self._rebuild_heap()
+
+    def _rebuild_heap(self) -> None:
+        self._top_heap = [(count, key) for key, count in self._top.items()]
+        heapq.heapify(self._top_heap)
+
+    def estimate(self, key: int) -> int:
+        with self._lock:
+            return min(row[column] for row, column in zip(self._rows, self._columns(key)))
+
+    def top(self, n: Optional[int] = None) -> List[int]:
+        """
+        Returns the most read ids, the most read first
+        """
+        with self._lock:
+            keys = sorted(self._top, key=self._top.get, reverse=True)
+        return keys if n is None else keys[:n]
+
+    # -------------
+    #  Persistence
+    # -------------
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            data = {'width': self.width, 'depth': self.depth, 'rows': self._rows,
+                    'top': [[key, count] for key, count in self._top.items()]}
+            encoded = json.dumps(data, separators=(',', ':'))
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(encoded)
+        os.replace(temporary_path, self.path)
+
+    def _load(self, path: str) -> None:
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+        if data['width'] != self.width or data['depth'] != self.depth:
+            raise ValueError(path, 'sketch has other dimensions')
+
+        self._rows = [[count // 2 for count in row] for row in data['rows']]
+        top = sorted(((key, count // 2) for key, count in data['top']), key=lambda item: item[1], reverse=True)
+        self._top = dict(top[:self.top_n])
+        self._rebuild_heap()
+
+    def start(self) -> None:
+        if self.path is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='access-sketch', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        try:
+            self.save()
+        except OSError as e:
+            print(e)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.save_interval):
+            try:
+                self.save()
+            except OSError as e:
+                print(e)
+
+
+class ProfileCache:
+    """
+    Thread-safe LRU cache of user profiles (schemas.User.Get) with a time to live.
+    Profiles are invalidated by writes of this worker, the ttl bounds staleness after writes of other workers.
+    A profile loaded concurrently with an invalidation must not be put back: take version() before the load
+    and pass it to put(), which is skipped if the key was invalidated since then
+
+    Example::
+
+        version = cache.version()
+        profile = load(user_id)
+        cache.put(user_id, profile, version)
+
+    :param max_size: max count of cached profiles
+    :param ttl: seconds a profile is valid
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        # Versions of the last invalidations of recently invalidated keys (at most max_size of them),
+        # keys dropped from it count as invalidated at _invalidated_floor
+        self._version = 0
+        self._invalidated: 'OrderedDict[Hashable, int]' = OrderedDict()
+        self._invalidated_floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def put(self, key: Hashable, value: Any, version: Optional[int] = None) -> None:
+        """
+        :param version: version() taken before the value was loaded, None to put unconditionally
+        """
+        with self._lock:
+            if version is not None and self._invalidated.get(key, self._invalidated_floor) > version:
+                return
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._items.pop(key, None)
+                self._invalidated[key] = self._version
+                self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_size:
+                self._invalidated_floor = self._invalidated.popitem(last=False)[1]
+
+    def invalidate_messages(self, messages: List[schemas.Message.Get]) -> None:
+        """
+        Invalidates profiles of senders and receivers of the messages (a listener of committed messages)
+        """
+        self.invalidate({user_id for message in messages for user_id in (message.sender_id, message.receiver_id)})
+
+    def clear(self) -> None:
+        with self._lock:
+            self._version += 1
+            self._items.clear()
+            self._invalidated.clear()
+            self._invalidated_floor = self._version
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+def prime_os_page_cache(bind: Engine, max_bytes: int = 64 * 1024 * 1024, chunk_size: int = 1024 * 1024) -> int:
+    """
+    Reads the beginning of the database file, so its pages are in the page cache of the OS
+    before the first requests. The page cache of SQLite itself is not warmed: it belongs to a connection,
+    and connections of sqlite file engines are not pooled (NullPool), so every session starts with an empty one
+
+    :param bind: engine of the (sqlite file) database
+    :param max_bytes: max count of bytes to read
+    :return: count of read bytes
+    """
+    path = bind.url.database
+    if not path or path == ':memory:' or not os.path.isfile(path):
+        return 0
+
+    read = 0
+    with open(path, 'rb', buffering=0) as file:
+        while read < max_bytes:
+            chunk = file.read(min(chunk_size, max_bytes - read))
+            if not chunk:
+                break
+            read += len(chunk)
+    return read
+
+
+def prebuild_schemas(app: FastAPI) -> None:
+    """
+    Configures ORM mappers and builds the OpenAPI schema (json schemas of all request and response models),
+    which are otherwise built by the first query and the first request of the docs
+    """
+    configure_mappers()
+    app.openapi()
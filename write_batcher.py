@@ -0,0 +1,206 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import schemas
+from admission import Overloaded
+from crud import message_crud
+
+
+class MessageWriteBatcher:
+    """
+    Write-behind batcher of message sends (group commit).
+    Callers put messages into a queue, a single writer thread inserts everything collected
+    during max_delay seconds (or max_batch messages) in one transaction, so one commit (one fsync)
+    is paid for the whole batch
+
+    Example::
+
+        batcher = MessageWriteBatcher(SessionLocal, max_batch=512, max_delay=0.002)
+        batcher.start()
+
+        message = batcher.send(schemas.Message.Create(sender_id=1, receiver_id=2, text='hi'))
+        # or from a coroutine
+        message = await batcher.send_async(new_message_data)
+
+        batcher.stop()
+
+    :param session_factory: creates sessions of the writer
+    :param max_batch: max count of messages to commit in one transaction
+    :param max_delay: seconds the writer waits for other messages before a commit of a batch
+    :param max_wait: seconds a caller waits for a commit of its message, the message is dropped
+        if it was not taken by the writer within that time
+    :param max_pending: max count of messages in the queue, others are rejected with Overloaded
+    :param synchronous: value of sqlite "PRAGMA synchronous" of the writer connection:
+        FULL - fsync on each commit, NORMAL - survives crashes of the app (in WAL mode), OFF - no fsync at all
+    """
+
+    SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self,
+                 session_factory: Callable[..., Session],
+                 max_batch: int = 256,
+                 max_delay: float = 0.005,
+                 max_wait: float = 2.0,
+                 max_pending: int = 10000,
+                 synchronous: str = 'FULL'):
+        if synchronous.upper() not in self.SYNCHRONOUS_MODES:
+            raise ValueError(synchronous, f'synchronous must be one of {self.SYNCHRONOUS_MODES}')
+
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.synchronous = synchronous.upper()
+
+        self._queue: 'queue.Queue[Optional[Tuple[schemas.Message.Create, Future]]]' = queue.Queue(max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+        self.batches = 0
+        self.messages = 0
+
+    # -----------
+    #  Lifecycle
+    # -----------
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='message-write-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Commits already queued messages and stops the writer
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    # ---------
+    #  Callers
+    # ---------
+    def submit(self, new_message_data: schemas.Message.Create) -> Future:
+        """
+        Puts the message into the queue
+
+        :param new_message_data: data of a message to create
+        :return: future of schemas.Message.Get resolved when the batch of the message is committed
+        :except Overloaded: occurs if the queue is full
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((new_message_data, future))
+        except queue.Full:
+            raise Overloaded('post_message', 'queue_full', 1)
+        return future
+
+    def _result(self, future: Future) -> schemas.Message.Get:
+        try:
+            return future.result(timeout=self.max_wait)
+        except FutureTimeoutError:
+            # The message isn't taken by the writer yet, drop it; otherwise its batch is already committing
+            if future.cancel():
+                raise TimeoutError('message is not committed within max_wait')
+            return future.result()
+
+    def send(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        """
+        Puts the message into the queue and waits for its commit
+
+        :param new_message_data: data of a message to create
+        :return: created message
+        :except ValueError: occurs if a sender or a receiver of the message is not found
+        :except TimeoutError: occurs if the message is not committed within max_wait
+        :except Overloaded: occurs if the queue is full
+        """
+        return self._result(self.submit(new_message_data))
+
+    async def send_async(self, new_message_data: schemas.Message.Create) -> schemas.Message.Get:
+        """
+        Same as send but doesn't block a thread of the caller
+        """
+        future = self.submit(new_message_data)
+        wrapped = asyncio.wrap_future(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(wrapped), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.cancel():
+                raise TimeoutError('message is not committed within max_wait')
+            return await wrapped
+
+    # --------
+    #  Writer
+    # --------
+    def _collect(self, first: Tuple[schemas.Message.Create, Future]) -> Tuple[List, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch: List[Tuple[schemas.Message.Create, Future]]) -> None:
+        # Drop messages whose callers have already given up
+        batch = [(data, future) for data, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            with self.session_factory() as db:
+                bind = db.get_bind()
+            # The pragma is set on a connection of the writer only and restored before it goes back to the pool
+            with bind.connect() as connection:
+                synchronous = connection.exec_driver_sql('PRAGMA synchronous').scalar()
+                connection.exec_driver_sql(f'PRAGMA synchronous = {self.synchronous}')
+                try:
+                    with self.session_factory(bind=connection, expire_on_commit=False) as db:
+                        messages = message_crud.post_messages(db, [data for data, _ in batch])
+                finally:
+                    connection.exec_driver_sql(f'PRAGMA synchronous = {synchronous}')
+        except Exception as e:
+            print(e)
+            for data, future in batch:
+                future.set_exception(ValueError(data, 'message creation error'))
+            return
+
+        self.batches += 1
+        self.messages += sum(message is not None for message in messages)
+        for (data, future), message in zip(batch, messages):
+            if message is None:
+                future.set_exception(ValueError(data, 'sender or receiver is not found'))
+            else:
+                future.set_result(schemas.Message.Get.from_orm(message))
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._collect(first)
+            self._write(batch)
+
+        # Flush whatever was queued before the stop
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                rest.append(item)
+        for i in range(0, len(rest), self.max_batch):
+            self._write(rest[i:i + self.max_batch])